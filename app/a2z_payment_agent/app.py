@@ -1,4 +1,5 @@
 import asyncio
+import httpx
 import requests
 import traceback
 import stripe
@@ -51,6 +52,10 @@ STATIC_DIR = "web/static"
 TEMPLATES_DIR = "web/templates"
 PLUGIN_DIR = "web/plugin"
 
+## background task expiring unpaid orders, started in startup_event
+order_sweeper_task = None
+order_reconciler_task = None
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     print("Application startup...")
@@ -61,9 +66,29 @@ async def lifespan(app: FastAPI):
 
 async def startup_event():
     print("Application startup...")
+    ## Load the tokenizer BPE tables once, before the first quote needs them
+    try:
+        await asyncio.get_running_loop().run_in_executor(
+            None, TokenizerRegistry.prewarm, [payment_agent.tokenizer.encoding_name])
+    except Exception as e:
+        logger.error(f"startup_event tokenizer prewarm failed with error {e}")
+    ## Expire unpaid orders and release their events, so payment_agent.orders stays bounded
+    global order_sweeper_task
+    order_sweeper_task = asyncio.create_task(payment_agent.run_order_sweeper())
+    ## Settle the pending orders whose payment webhook was lost, from the providers' side
+    global order_reconciler_task
+    order_reconciler_task = asyncio.create_task(payment_agent.run_order_reconciler())
 
 async def shutdown_event():
     print("Application end...")
+    if order_sweeper_task is not None:
+        order_sweeper_task.cancel()
+    if order_reconciler_task is not None:
+        order_reconciler_task.cancel()
+    ## commit the queued order writes of a persistent order store
+    payment_agent.orders.close()
+    payment_agent.http_client.close()
+    await payment_agent.async_http_client.aclose()
 
 def get_base_path(request):
     """
@@ -213,11 +238,12 @@ async def response_generator(chunk_list):
 # ---------------------------------------------------------
 
 import agent_a2z_payment
-from agent_a2z_payment.core import get_payment_sdk, PaymentWaitingMode, Environment
-from agent_a2z_payment.core import _get_paypal_access_token
+from agent_a2z_payment.core import get_payment_sdk, PaymentWaitingMode, Environment, TokenizerRegistry, OrderStatus
+from agent_a2z_payment.paypal_auth import paypal_base_url, apaypal_request
 
 environment = Environment.SANDBOX.value
-payment_agent = get_payment_sdk(env=environment)
+## lazy checkout cards create the payment of the selected method through /api/checkout/select
+payment_agent = get_payment_sdk(env=environment, checkout_select_url=f"{PRODUCTION_URL_PREFIX}/api/checkout/select")
 
 # ---------------------------------------------------------
 # CHAT LOOP — LLM → Payment Gate → LLM,
@@ -253,6 +279,16 @@ async def chat(messages: list = Body(...)
         raise HTTPException(status_code=400, detail=f"Unknown payment flow: {payment_flow}")
     return StreamingResponse(generator, media_type="text/event-stream")
 
+@app.post(f"{PRODUCTION_URL_PREFIX}/api/checkout/select")
+async def checkout_select(order_id: str = Body(...), payment_method: str = Body(...)):
+    """
+    Lazy checkout card: creates the Stripe PaymentIntent or the PayPal order of the method the
+    user selected, returns its client_secret or payment_url.
+    """
+    if not payment_agent.orders.get(order_id):
+        raise HTTPException(status_code=404, detail="Order not found")
+    return await payment_agent.aselect_payment_method(order_id, payment_method)
+
 # --- NEW ASYNC GENERATOR FUNCTION ---
 async def payment_stream_generator(order_id, message_id, chunk_list, orders):
     """
@@ -364,23 +400,21 @@ async def stripe_webhook(request: Request):
     # -----------------------------
     # Payment succeeded
     # -----------------------------
-    if event["type"] == "payment_intent.succeeded":
-        intent = event["data"]["object"]
-        order_id = intent["metadata"]["order_id"]
-
-        ## update the order status of the agent
-        order = payment_agent.orders[order_id]
+    if event["type"] in ["payment_intent.succeeded", "checkout.session.completed"]:
+        ## the verified payload as plain dicts, a StripeObject has no dict .get
+        intent = json.loads(payload)["data"]["object"]
+        if event["type"] == "checkout.session.completed" and intent.get("payment_status") != "paid":
+            return {"status": "ok"}
+        ## metadata of our PaymentIntents and Checkout Sessions, else the provider id index
+        order_id = (intent.get("metadata") or {}).get("order_id") or payment_agent.orders.find_order_id(intent.get("id"))
+
+        ## update the order status of the agent, the order event of the waiting stream is set by the store listener
+        order = payment_agent.orders.get(order_id) if order_id else None
         if order:
-            order["status"] = "paid"
-            print(f"INFO: ORDER {order_id} PAID.")
-
-            ## Add Post Request to Status Update
-            payment_event = order.get("event")
-            if payment_event:
-                payment_event.set()
-                print(f"INFO: EVENT SET for Order {order_id}. Streaming response should resume immediately.")
+            if await payment_agent.orders.atransition(order_id, OrderStatus.PAID):
+                print(f"INFO: ORDER {order_id} PAID.")
             else:
-                print(f"WARNING: Event not found for Order {order_id}. Streaming may fall back to timeout.")
+                print(f"INFO: Duplicate event {event['type']} for Order {order_id} in status {order.get('status')} ignored.")
         else:
             print (f"Error: Error for Order {order_id} Order Not Found in Payment Agent Dict")
 
@@ -462,8 +496,8 @@ async def paypal_webhook(request: Request):
         if LOG_ENABLE:
             print (f"DEBUG: Parsing From resource {resource} Reference ID {reference_id}")
 
-        # Assuming our internal ID is the PayPal Order ID
-        order_id = reference_id
+        # Our internal ID is the reference ID, else resolve the PayPal Order ID in the provider id index
+        order_id = reference_id or payment_agent.orders.find_order_id(paypal_order_id)
         if not order_id:
             logging.warning(f"PayPal event {event_type} missing reference order ID.")
             return {"status": "ok"}  # Return 200 OK for logging, no action taken
@@ -479,58 +513,39 @@ async def paypal_webhook(request: Request):
 
         if event_type == "CHECKOUT.ORDER.COMPLETED":
 
-            # Only update status and set event if it hasn't been paid already (idempotency check)
-            if order.get("status") != "paid":
-                order["status"] = "paid"
+            # Compare-and-swap transition, a duplicate COMPLETED event is a no-op (idempotency check)
+            if await payment_agent.orders.atransition(order_id, OrderStatus.PAID):
                 logging.info(f"ORDER {order_id} status updated to PAID via PayPal.")
-
-                payment_event = order.get("event")
-                if payment_event:
-                    payment_event.set()
-                    logging.info(f"EVENT SET for Order {order_id}. Streaming response resumed.")
-                else:
-                    logging.warning(f"Event missing for Order {order_id}.")
             else:
                 logging.info(
                     f"Idempotent: Order {order_id} already marked as paid. Ignoring duplicate COMPLETED event.")
 
         elif event_type == "CHECKOUT.ORDER.APPROVED":
-            # Log the approval but do not change the status or set the event (we wait for COMPLETED)
+            # Only the delivery that moves the order to approved captures, duplicates do not capture twice
+            if not await payment_agent.orders.atransition(order_id, OrderStatus.APPROVED):
+                logging.info(f"Idempotent: Order {order_id} in status {order.get('status')}. Ignoring duplicate APPROVED event.")
+                return {"status": "ok"}
             logging.info(f"Order {order_id} successfully APPROVED by user. Waiting for COMPLETED event.")
             # tell paypal to move the money
             if await _capture_paypal_order(paypal_order_id, paypal_client_id, paypal_secret, environment):
                 print("Capture initiated. Waiting for COMPLETED webhook...")
 
-                ## update order status
-                if order.get("status") != "paid":
-                    order["status"] = "paid"
+                ## update order status, the store listener sets the event of the waiting stream
+                if await payment_agent.orders.atransition(order_id, OrderStatus.PAID):
                     logging.info(f"ORDER {order_id} status updated to PAID via PayPal.")
 
-                ## If order is complete, set the loop
-                ## Add Post Request to Status Update
-                payment_event = order.get("event")
-                if payment_event:
-                    payment_event.set()
-                    print(f"INFO: EVENT SET for Order {order_id}. Streaming response should resume immediately.")
-                else:
-                    print(f"WARNING: Event not found for Order {order_id}. Streaming may fall back to timeout.")
-
             else:
                 print("Capture failed. Manual review needed.")
 
     elif event_type == "PAYMENT.CAPTURE.COMPLETED":
+        ## the capture resource carries the PayPal Order ID only
+        paypal_order_id = resource.get("supplementary_data", {}).get("related_ids", {}).get("order_id", "")
+        order_id = payment_agent.orders.find_order_id(paypal_order_id) or ""
+        order = payment_agent.orders.get(order_id) if order_id else None
         if order_id != "" and order is not None:
 
-            if order.get("status") != "paid":
-                order["status"] = "paid"
+            if await payment_agent.orders.atransition(order_id, OrderStatus.PAID):
                 logging.info(f"ORDER {order_id} status updated to PAID via PayPal.")
-
-            payment_event = order.get("event")
-            if payment_event:
-                payment_event.set()
-                print(f"INFO: EVENT SET for Order {order_id}. Streaming response should resume immediately.")
-            else:
-                print(f"WARNING: Event not found for Order {order_id}. Streaming may fall back to timeout.")
         else:
             print(f"WARNING: Event PAYMENT.CAPTURE.COMPLETE Order {order_id} {order}")
     else:
@@ -548,13 +563,7 @@ async def _verify_paypal_webhook(request: Request, client_id: str, client_secret
     PayPal's verification API. Returns True if the event is verified, False otherwise.
     """
     try:
-        # 1. Get Access Token (needed to authorize the verification API call)
-        access_token = _get_paypal_access_token(client_id, client_secret, environment)
-        if not access_token:
-            logging.error("Failed to get PayPal access token for verification.")
-            return False
-
-        # 2. Prepare Verification Payload
+        # 1. Prepare Verification Payload, the access token comes from the shared token cache
         webhook_payload = await request.json()
 
         verification_payload = {
@@ -568,22 +577,23 @@ async def _verify_paypal_webhook(request: Request, client_id: str, client_secret
             "webhook_event": webhook_payload,  # The entire body of the webhook event
         }
 
-        base_url = "https://api-m.sandbox.paypal.com" if environment == Environment.SANDBOX.value else "https://api-m.paypal.com"
-        verify_url = f"{base_url}/v1/notifications/verify-webhook-signature"
+        verify_url = f"{paypal_base_url(environment, payment_agent.config.paypal_base_url)}/v1/notifications/verify-webhook-signature"
 
-        # 3. Send Verification Request to PayPal
+        # 2. Send Verification Request to PayPal, a 401 refreshes the token and retries once
         if LOG_ENABLE:
             print(f"DEBUG: _verify_paypal_webhook verify_url is {verify_url}")
-            print(f"DEBUG: _verify_paypal_webhook access_token generated is {access_token}")
             print(f"DEBUG: _verify_paypal_webhook webhook_payload is {webhook_payload}")
             print(f"DEBUG: _verify_paypal_webhook verification_payload generated is {verification_payload}")
 
-        response = requests.post(
+        response = await apaypal_request(
+            "POST",
             verify_url,
-            headers={
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {access_token}"
-            },
+            client_id,
+            client_secret,
+            environment,
+            http_client=payment_agent.async_http_client,
+            base_url=payment_agent.config.paypal_base_url,
+            headers={"Content-Type": "application/json"},
             data=json.dumps(verification_payload)
         )
         response.raise_for_status()
@@ -594,7 +604,7 @@ async def _verify_paypal_webhook(request: Request, client_id: str, client_secret
 
         return result.get("verification_status") == "SUCCESS"
 
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         logging.error(f"PayPal Webhook Verification Failed (Request Error): {e}")
         return False
     except Exception as e:
@@ -616,26 +626,22 @@ async def _capture_paypal_order(order_id: str, client_id: str, client_secret: st
         True if the capture request was successful and the status is 'COMPLETED', False otherwise.
     """
     try:
-        # 1. Get the required access token
-        access_token = _get_paypal_access_token(client_id, client_secret, environment)
-        if not access_token:
-            logging.error(f"Failed to get PayPal access token to capture order {order_id}.")
-            return False
-
-        # 2. Construct the API URL
-        base_url = "https://api-m.sandbox.paypal.com" if environment == Environment.SANDBOX.value else "https://api-m.paypal.com"
+        # 1. Construct the API URL
         # The endpoint for capturing an order is /v2/checkout/orders/{id}/capture
-        capture_url = f"{base_url}/v2/checkout/orders/{order_id}/capture"
+        capture_url = f"{paypal_base_url(environment, payment_agent.config.paypal_base_url)}/v2/checkout/orders/{order_id}/capture"
 
         logging.info(f"Attempting to CAPTURE PayPal Order: {order_id} at {capture_url}")
 
-        # 3. Send the Capture Request
-        response = requests.post(
+        # 2. Send the Capture Request with the cached access token, a 401 refreshes it and retries once
+        response = await apaypal_request(
+            "POST",
             capture_url,
-            headers={
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {access_token}"
-            },
+            client_id,
+            client_secret,
+            environment,
+            http_client=payment_agent.async_http_client,
+            base_url=payment_agent.config.paypal_base_url,
+            headers={"Content-Type": "application/json"},
             # An empty body {} is sufficient for a simple capture request
             json={}
         )
@@ -643,7 +649,7 @@ async def _capture_paypal_order(order_id: str, client_id: str, client_secret: st
 
         capture_data = response.json()
 
-        # 4. Check Final Capture Status
+        # 3. Check Final Capture Status
         final_status = capture_data.get("status")
 
         if final_status == "COMPLETED":
@@ -658,9 +664,9 @@ async def _capture_paypal_order(order_id: str, client_id: str, client_secret: st
                 f"Capture request succeeded, but final status was unexpected: {final_status}. Full response: {capture_data}")
             return False
 
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         error_details = f"PayPal Capture Request Failed for Order {order_id}. Error: {e}"
-        if e.response is not None:
+        if isinstance(e, httpx.HTTPStatusError):
             error_details += f" | Response: {e.response.text}"
         logging.error(error_details)
         return False
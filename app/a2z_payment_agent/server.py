@@ -66,7 +66,7 @@ def create_order(amount: float, currency: str) -> dict:
     Create an order with amount and currency.
     """
     try:
-        return payment_agent.create_order(amount, currency)
+        return payment_agent.create_order(amount, currency).to_dict()
     except Exception as e:
         logging.error(f"Error in create_order: {str(e)}")
         return {"order_id": "-1", "message": "Failed to create_order for the amount and currency. Please check the agent healthy"}
@@ -1,10 +1,11 @@
-import uuid
+from agent_a2z_payment.ids import new_uuid7
 
 def get_new_message_id():
-    return str(uuid.uuid4())
+    ## UUIDv7, same format as uuid4 and sorted by creation time
+    return new_uuid7()
 
 def get_new_trace_id():
-    return str(uuid.uuid4())
+    return new_uuid7()
 
 def assembly_message(type, format, content, **kwargs):
     """
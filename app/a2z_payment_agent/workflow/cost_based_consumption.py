@@ -23,7 +23,8 @@ async def run_cost_based_consumption_loop(
     message_id = get_new_message_id()
 
     # 1. LLM/Agent decides cost
-    output = payment_agent.calculate_payment(messages)  # Mocking: actual cost calculation based on expected tokens/APIs
+    ## session_id scopes the token accounting, earlier turns of the same chat are not counted again
+    output = await payment_agent.acalculate_payment(messages, conversation_id=kwargs.get("session_id"))  # Mocking: actual cost calculation based on expected tokens/APIs
     amount = output.get(AMOUNT, 1.0)
     currency = output.get(CURRENCY, "USD")
 
@@ -38,12 +39,11 @@ async def run_cost_based_consumption_loop(
                          section="", message_id=message_id, template=TEMPLATE_STREAMING_CONTENT_TYPE))
 
     # 2. Create order and insert db
-    order = payment_agent.create_order(amount, currency)
+    order = await payment_agent.acreate_order(amount, currency)
     order_id = order.get(ORDER_ID, str(uuid.uuid4()))
-    payment_agent.orders[order_id]["event"] = asyncio.Event()
 
     # 3. Create payment intent and return checkout card html/js
-    checkout_result = payment_agent.checkout(payment_method="all", order_id=order_id, amount=amount, currency=currency)
+    checkout_result = await payment_agent.acheckout(payment_method="all", order_id=order_id, amount=amount, currency=currency)
     checkout_html = checkout_result.get("checkout_html", "")
     checkout_js = checkout_result.get("checkout_js", "")
 
@@ -40,12 +40,11 @@ async def run_ecommerce_checkout_loop(
                          message_id=message_id, template=TEMPLATE_STREAMING_CONTENT_TYPE))
 
     # 2. Create order and payment intent, focusing on immediate A2Z/Unified Payment
-    order = payment_agent.create_order(amount, currency)
+    order = await payment_agent.acreate_order(amount, currency)
     order_id = order.get(ORDER_ID, str(uuid.uuid4()))
-    payment_agent.orders[order_id]["event"] = asyncio.Event()
 
     # Focus on 'agenta2z' or 'all' for this checkout scenario
-    checkout_result = payment_agent.checkout(payment_method="all", order_id=order_id, amount=amount, currency=currency)
+    checkout_result = await payment_agent.acheckout(payment_method="all", order_id=order_id, amount=amount, currency=currency)
     checkout_html = checkout_result.get("checkout_html", "")
     checkout_js = checkout_result.get("checkout_js", "")
 
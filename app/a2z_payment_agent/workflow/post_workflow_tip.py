@@ -36,12 +36,13 @@ async def run_post_workflow_tip_loop(
     currency = default_currency
 
     # 3. Create a voluntary order and get the tip card HTML/JS
-    order = payment_agent.create_order(amount, currency)
+    order = await payment_agent.acreate_order(amount, currency)
     order_id = order.get(ORDER_ID, str(uuid.uuid4()))
-    payment_agent.orders[order_id]["event"] = asyncio.Event()
 
     # Get a specific "Tipping" checkout card if available, otherwise "all"
-    checkout_result = payment_agent.checkout(payment_method="all", order_id=order_id, amount=amount, currency=currency)
+    # Most tip cards are never clicked, the lazy card creates a provider payment only for the method selected
+    checkout_result = await payment_agent.acheckout(payment_method="all", order_id=order_id, amount=amount, currency=currency,
+                                                    checkout_mode="lazy")
     checkout_html = checkout_result.get("checkout_html", "")
     checkout_js = checkout_result.get("checkout_js", "")
 
@@ -38,12 +38,10 @@ async def run_preview_to_pay_loop(
                          section="", message_id=message_id, template=TEMPLATE_STREAMING_CONTENT_TYPE))
 
     # 3. Create order and payment intent (server-side)
-    order = payment_agent.create_order(amount, currency)
+    order = await payment_agent.acreate_order(amount, currency)
     order_id = order.get(ORDER_ID, str(uuid.uuid4()))
-    ## Add Event to Hold Until Notify by Payment Server
-    payment_agent.orders[order_id]["event"] = asyncio.Event()
 
-    checkout_result = payment_agent.checkout(payment_method="all", order_id=order_id, amount=amount, currency=currency)
+    checkout_result = await payment_agent.acheckout(payment_method="all", order_id=order_id, amount=amount, currency=currency)
     checkout_html = checkout_result.get("checkout_html", "")
     checkout_js = checkout_result.get("checkout_js", "")
 
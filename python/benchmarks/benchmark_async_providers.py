@@ -0,0 +1,127 @@
+"""
+Event loop responsiveness during checkouts: PaymentAgent.checkout called directly in a
+coroutine (blocking Stripe and PayPal calls on the loop) against await PaymentAgent.acheckout
+(async Stripe and PayPal adapters).
+
+Stripe and PayPal are a local mock server answering after --provider_ms. Ticker coroutines
+stand in for other open chat streams and record how late they wake up.
+
+Usage:
+    python benchmarks/benchmark_async_providers.py --checkouts 20 --provider_ms 100
+"""
+import argparse
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import stripe
+
+from agent_a2z_payment import paypal_auth
+from agent_a2z_payment.constants import ORDER_ID
+from agent_a2z_payment.core import AgentPaymentConfig, PaymentAgent
+
+
+def make_handler(provider_seconds: float, paypal_seconds: float = None):
+    """
+    Mock Stripe and PayPal API, answering after provider_seconds, PayPal after paypal_seconds if set.
+    """
+    paypal_seconds = provider_seconds if paypal_seconds is None else paypal_seconds
+
+    class Handler(BaseHTTPRequestHandler):
+        disable_nagle_algorithm = True
+        protocol_version = "HTTP/1.1"
+
+        def _reply(self, body: dict):
+            data = json.dumps(body).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if self.path == "/v1/oauth2/token":
+                self._reply({"access_token": "mock_token", "expires_in": 32400})
+                return
+            time.sleep(paypal_seconds if self.path.startswith("/v2/") else provider_seconds)
+            object_id = f"{time.time_ns()}"
+            if self.path == "/v1/payment_intents":
+                self._reply({"id": f"pi_{object_id}", "object": "payment_intent",
+                             "client_secret": f"pi_{object_id}_secret"})
+            elif self.path == "/v2/checkout/orders":
+                self._reply({"id": object_id, "status": "CREATED",
+                             "links": [{"rel": "approve", "href": f"https://paypal.mock/approve?token={object_id}"}]})
+            else:
+                self._reply({})
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+async def ticker(stop: asyncio.Event, tick_seconds: float, lags: list):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(tick_seconds)
+        lags.append(time.perf_counter() - start - tick_seconds)
+
+
+async def run(mode: str, payment_agent: PaymentAgent, num_checkouts: int, num_streams: int, tick_seconds: float):
+    order_ids = [payment_agent.create_order(5.0 + i, "USD")[ORDER_ID] for i in range(num_checkouts + 1)]
+
+    async def one(order_id):
+        if mode == "sync":
+            return payment_agent.checkout(payment_method="all", order_id=order_id, amount=5.0, currency="USD")
+        return await payment_agent.acheckout(payment_method="all", order_id=order_id, amount=5.0, currency="USD")
+
+    ## warm up, the first Stripe call loads the client and the PayPal token is fetched
+    await one(order_ids.pop())
+    stop = asyncio.Event()
+    lags = []
+    tickers = [asyncio.create_task(ticker(stop, tick_seconds, lags)) for _ in range(num_streams)]
+    await asyncio.sleep(tick_seconds * 2)
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*[one(order_id) for order_id in order_ids])
+    checkout_seconds = time.perf_counter() - start
+
+    await asyncio.sleep(tick_seconds * 2)
+    stop.set()
+    await asyncio.gather(*tickers)
+    await payment_agent.async_http_client.aclose()
+    ## checkouts rendering both the Stripe client secret and the PayPal approval link
+    rendered = sum(1 for result in results if "_secret" in result["checkout_js"] and "paypal.mock" in result["checkout_html"])
+    return checkout_seconds, lags, rendered
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--checkouts", type=int, default=20)
+    parser.add_argument("--provider_ms", type=float, default=100.0)
+    parser.add_argument("--streams", type=int, default=20)
+    parser.add_argument("--tick_ms", type=float, default=10.0)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(args.provider_ms / 1000.0))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    mock_url = f"http://127.0.0.1:{server.server_address[1]}"
+    stripe.api_base = mock_url
+    paypal_auth.PAYPAL_BASE_URL_SANDBOX = mock_url
+
+    print(f"{'mode':>6} | {'checkouts':>9} | {'total ms':>9} | {'max stream lag ms':>17} | {'mean stream lag ms':>18} | rendered")
+    for mode in ["sync", "async"]:
+        payment_agent = PaymentAgent(AgentPaymentConfig(stripe_secret_key="sk_test_mock", stripe_publishable_key="pk_test_mock",
+                                                        paypal_client_id="mock_client", paypal_secret="mock_secret"))
+        checkout_seconds, lags, rendered = asyncio.run(
+            run(mode, payment_agent, args.checkouts, args.streams, args.tick_ms / 1000.0))
+        print(f"{mode:>6} | {args.checkouts:>9} | {checkout_seconds * 1000:>9.1f} | {max(lags) * 1000:>17.1f} | "
+              f"{sum(lags) / len(lags) * 1000:>18.2f} | {rendered}")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Event loop responsiveness while a large quote runs: PaymentAgent.calculate_payment called
+directly in a coroutine (blocks the loop) against await PaymentAgent.acalculate_payment
+(runs in the bounded quote executor).
+
+A set of ticker coroutines stand in for other open chat streams. Each one sleeps
+--tick_ms in a loop and records how late it wakes up; the report shows the worst lag.
+
+Exits with status 1 if a stream lags more than --max_lag_ms behind during the async quote,
+i.e. the quote blocks the loop again, or if the async quote counts other tokens than the sync one.
+
+Usage:
+    python benchmarks/benchmark_async_quote.py --messages 5000 --streams 20 --max_lag_ms 50
+"""
+import argparse
+import asyncio
+import sys
+import time
+
+from agent_a2z_payment.core import AgentPaymentConfig, PaymentAgent
+
+from benchmark_token_count import build_messages
+
+
+async def ticker(stop: asyncio.Event, tick_seconds: float, lags: list):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(tick_seconds)
+        lags.append(time.perf_counter() - start - tick_seconds)
+
+
+async def run(mode: str, payment_agent: PaymentAgent, messages, num_streams: int, tick_seconds: float):
+    stop = asyncio.Event()
+    lags = []
+    tickers = [asyncio.create_task(ticker(stop, tick_seconds, lags)) for _ in range(num_streams)]
+    await asyncio.sleep(tick_seconds * 2)
+
+    start = time.perf_counter()
+    if mode == "sync":
+        output = payment_agent.calculate_payment(messages)
+    else:
+        output = await payment_agent.acalculate_payment(messages)
+    quote_seconds = time.perf_counter() - start
+
+    await asyncio.sleep(tick_seconds * 2)
+    stop.set()
+    await asyncio.gather(*tickers)
+    return output, quote_seconds, lags
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--streams", type=int, default=20)
+    parser.add_argument("--tick_ms", type=float, default=10.0)
+    parser.add_argument("--max_lag_ms", type=float, default=50.0)
+    args = parser.parse_args()
+
+    messages = build_messages(args.messages)
+    print(f"{'mode':>6} | {'quote ms':>9} | {'max stream lag ms':>17} | {'mean stream lag ms':>18} | tokens")
+    results = {}
+    for mode in ["sync", "async"]:
+        ## fresh agent without token cache, so both modes encode the whole transcript
+        payment_agent = PaymentAgent(AgentPaymentConfig(token_cache_max_entries=0))
+        output, quote_seconds, lags = asyncio.run(run(mode, payment_agent, messages, args.streams, args.tick_ms / 1000.0))
+        print(f"{mode:>6} | {quote_seconds * 1000:>9.1f} | {max(lags) * 1000:>17.1f} | "
+              f"{sum(lags) / len(lags) * 1000:>18.2f} | {output['estimated_tokens']}")
+        results[mode] = (output['estimated_tokens'], max(lags) * 1000)
+
+    failures = []
+    if results["async"][1] > args.max_lag_ms:
+        failures.append(f"async max stream lag {results['async'][1]:.1f} ms > {args.max_lag_ms} ms")
+    if results["async"][0] != results["sync"][0]:
+        failures.append(f"async tokens {results['async'][0]} != sync tokens {results['sync'][0]}")
+    if failures:
+        print(f"FAILED: {', '.join(failures)}")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Latency of checkout(payment_method="all") with the Stripe and PayPal setups run concurrently,
+each one bounded by its deadline, against the sum of both providers (the former sequential
+checkout).
+
+Stripe and PayPal are a local mock server answering after --stripe_ms and --paypal_ms. The
+second case makes PayPal slower than its deadline: the card renders without PayPal at the
+deadline and provider_timings reports the timeout.
+
+Usage:
+    python benchmarks/benchmark_checkout_fanout.py --stripe_ms 300 --paypal_ms 600 --deadline 1.0
+"""
+import argparse
+import asyncio
+import threading
+import time
+from http.server import ThreadingHTTPServer
+
+import stripe
+
+from agent_a2z_payment import paypal_auth
+from agent_a2z_payment.constants import *
+from agent_a2z_payment.core import AgentPaymentConfig, PaymentAgent
+
+from benchmark_async_providers import make_handler
+
+
+def run_case(name: str, stripe_ms: float, paypal_ms: float, deadline: float, rounds: int):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(stripe_ms / 1000.0, paypal_ms / 1000.0))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    mock_url = f"http://127.0.0.1:{server.server_address[1]}"
+    stripe.api_base = mock_url
+    paypal_auth.PAYPAL_BASE_URL_SANDBOX = mock_url
+    payment_agent = PaymentAgent(AgentPaymentConfig(
+        stripe_secret_key="sk_test_mock", stripe_publishable_key="pk_test_mock",
+        paypal_client_id="mock_client", paypal_secret="mock_secret",
+        checkout_provider_deadlines={PAYMENT_METHOD_CREDIT_CARD: deadline, PAYMENT_METHOD_PAYPAL: deadline}))
+
+    async def acheckout_all():
+        order = payment_agent.create_order(5.0, "USD")
+        return await payment_agent.acheckout(payment_method=PAYMENT_METHOD_ALL, order_id=order[ORDER_ID], amount=5.0, currency="USD")
+
+    async def main():
+        ## warm up the Stripe client and the PayPal token
+        await acheckout_all()
+        rows = []
+        for _ in range(rounds):
+            start = time.perf_counter()
+            result = await acheckout_all()
+            rows.append(((time.perf_counter() - start) * 1000, result))
+        await payment_agent.async_http_client.aclose()
+        return rows
+
+    rows = [("async", elapsed_ms, result) for elapsed_ms, result in asyncio.run(main())]
+    ## the sync checkout runs the same fan-out on the provider executor
+    order = payment_agent.create_order(5.0, "USD")
+    start = time.perf_counter()
+    result = payment_agent.checkout(payment_method=PAYMENT_METHOD_ALL, order_id=order[ORDER_ID], amount=5.0, currency="USD")
+    rows.append(("sync", (time.perf_counter() - start) * 1000, result))
+    server.shutdown()
+
+    sequential_ms = stripe_ms + paypal_ms
+    for mode, elapsed_ms, result in rows:
+        timings = result[KEY_PROVIDER_TIMINGS]
+        paypal_shown = 'id="opt-paypal" class="pm-option" style="display: block;' in result[KEY_CHECKOUT_HTML]
+        print(f"{name:>12} | {mode:>5} | checkout {elapsed_ms:>7.1f} ms | sequential {sequential_ms:>7.1f} ms | "
+              f"card {timings[PAYMENT_METHOD_CREDIT_CARD]} | paypal {timings[PAYMENT_METHOD_PAYPAL]} | "
+              f"paypal shown {paypal_shown}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stripe_ms", type=float, default=300.0)
+    parser.add_argument("--paypal_ms", type=float, default=600.0)
+    parser.add_argument("--deadline", type=float, default=1.0)
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    run_case("both in time", args.stripe_ms, args.paypal_ms, args.deadline, args.rounds)
+    run_case("paypal late", args.stripe_ms, args.deadline * 3000, args.deadline, args.rounds)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""
+Checkout latency while PayPal is down, with and without the provider circuit breakers.
+
+Stripe and PayPal are a local mock server, Stripe answers after --provider_ms, PayPal hangs
+past its checkout deadline (--paypal_deadline) until it recovers. Without breakers (a breaker
+that never opens) every "all" checkout waits for the PayPal deadline, with breakers the
+circuit opens after a few failures and the checkouts render the card without PayPal at
+Stripe latency. After PayPal recovers, the probe call closes the circuit again.
+
+Usage:
+    python benchmarks/benchmark_circuit_breaker.py --checkouts 20 --provider_ms 100
+"""
+import argparse
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import stripe
+
+from agent_a2z_payment import paypal_auth
+from agent_a2z_payment.constants import *
+from agent_a2z_payment.core import AgentPaymentConfig, PaymentAgent
+
+
+class MockProviders:
+    def __init__(self, provider_seconds: float, paypal_down_seconds: float):
+        self.provider_seconds = provider_seconds
+        self.paypal_down_seconds = paypal_down_seconds
+        self.paypal_down = True
+        self.paypal_requests = 0
+
+
+def make_handler(mock: MockProviders):
+    class Handler(BaseHTTPRequestHandler):
+        disable_nagle_algorithm = True
+        protocol_version = "HTTP/1.1"
+
+        def _reply(self, body: dict):
+            data = json.dumps(body).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if self.path == "/v1/oauth2/token":
+                self._reply({"access_token": "mock_token", "expires_in": 32400})
+                return
+            object_id = f"{time.time_ns()}"
+            if self.path.startswith("/v2/"):
+                mock.paypal_requests += 1
+                time.sleep(mock.paypal_down_seconds if mock.paypal_down else mock.provider_seconds)
+                self._reply({"id": object_id, "status": "CREATED",
+                             "links": [{"rel": "approve", "href": f"https://paypal.mock/approve?token={object_id}"}]})
+                return
+            time.sleep(mock.provider_seconds)
+            self._reply({"id": f"pi_{object_id}", "object": "payment_intent", "client_secret": f"pi_{object_id}_secret"})
+
+        def handle_one_request(self):
+            try:
+                super().handle_one_request()
+            except (BrokenPipeError, ConnectionResetError):
+                ## the checkout gave up on a PayPal call past its deadline
+                self.close_connection = True
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+async def run(payment_agent: PaymentAgent, mock: MockProviders, num_checkouts: int, reset_seconds: float):
+    async def one():
+        order_id = payment_agent.create_order(5.0, "USD")[ORDER_ID]
+        start = time.perf_counter()
+        result = await payment_agent.acheckout(payment_method=PAYMENT_METHOD_ALL, order_id=order_id, amount=5.0, currency="USD")
+        return time.perf_counter() - start, result
+
+    mock.paypal_down = False
+    await one()
+    mock.paypal_down = True
+    mock.paypal_requests = 0
+    latencies = []
+    paypal_statuses = []
+    for _ in range(num_checkouts):
+        seconds, result = await one()
+        latencies.append(seconds)
+        paypal_statuses.append(result[KEY_PROVIDER_TIMINGS][PAYMENT_METHOD_PAYPAL][STATUS])
+    paypal_requests = mock.paypal_requests
+
+    ## PayPal recovers, the first checkout after reset_seconds probes it
+    mock.paypal_down = False
+    await asyncio.sleep(reset_seconds)
+    _, recovered = await one()
+    await payment_agent.async_http_client.aclose()
+    return latencies, paypal_statuses, paypal_requests, recovered
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--checkouts", type=int, default=20)
+    parser.add_argument("--provider_ms", type=float, default=100.0)
+    parser.add_argument("--paypal_deadline", type=float, default=1.0)
+    parser.add_argument("--reset_seconds", type=float, default=2.0)
+    args = parser.parse_args()
+
+    mock = MockProviders(args.provider_ms / 1000.0, args.paypal_deadline * 3)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(mock))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    mock_url = f"http://127.0.0.1:{server.server_address[1]}"
+    stripe.api_base = mock_url
+    paypal_auth.PAYPAL_BASE_URL_SANDBOX = mock_url
+
+    print(f"{'breakers':>8} | {'checkouts':>9} | {'total s':>7} | {'mean ms':>8} | {'last 10 mean ms':>15} | "
+          f"{'paypal calls':>12} | paypal statuses | after recovery")
+    for breakers in [False, True]:
+        payment_agent = PaymentAgent(AgentPaymentConfig(
+            stripe_secret_key="sk_test_mock", stripe_publishable_key="pk_test_mock",
+            paypal_client_id="mock_client", paypal_secret="mock_secret",
+            checkout_provider_deadlines={PAYMENT_METHOD_PAYPAL: args.paypal_deadline},
+            ## a breaker needing more calls than its window never opens
+            circuit_min_calls=CIRCUIT_MIN_CALLS_DEFAULT if breakers else CIRCUIT_WINDOW_SIZE_DEFAULT + 1,
+            circuit_reset_seconds=args.reset_seconds))
+        latencies, paypal_statuses, paypal_requests, recovered = asyncio.run(
+            run(payment_agent, mock, args.checkouts, args.reset_seconds))
+        statuses = {status: paypal_statuses.count(status) for status in dict.fromkeys(paypal_statuses)}
+        recovered_status = recovered[KEY_PROVIDER_TIMINGS][PAYMENT_METHOD_PAYPAL][STATUS]
+        print(f"{'on' if breakers else 'off':>8} | {args.checkouts:>9} | {sum(latencies):>7.2f} | "
+              f"{sum(latencies) / len(latencies) * 1000:>8.1f} | {sum(latencies[-10:]) / len(latencies[-10:]) * 1000:>15.1f} | "
+              f"{paypal_requests:>12} | {statuses} | paypal {recovered_status}, "
+              f"circuit {payment_agent.provider_metrics()[PAYMENT_METHOD_PAYPAL]['state']}")
+        if breakers:
+            print(f"provider_metrics paypal {payment_agent.provider_metrics()[PAYMENT_METHOD_PAYPAL]}")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
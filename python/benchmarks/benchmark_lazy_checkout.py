@@ -0,0 +1,103 @@
+"""
+Time to first card and provider objects created: eager checkout (Stripe PaymentIntent and
+PayPal order created with every card) against lazy checkout (card rendered without provider
+calls, the payment created by aselect_payment_method when the user selects a method).
+
+Stripe and PayPal are a local mock server answering after --provider_ms and counting the
+payments created. --select_ratio of the lazy cards are clicked, each on one method.
+
+Usage:
+    python benchmarks/benchmark_lazy_checkout.py --cards 50 --select_ratio 0.1
+"""
+import argparse
+import asyncio
+import threading
+import time
+from http.server import ThreadingHTTPServer
+
+import stripe
+
+from agent_a2z_payment import paypal_auth
+from agent_a2z_payment.constants import *
+from agent_a2z_payment.core import AgentPaymentConfig, PaymentAgent
+
+from benchmark_async_providers import make_handler
+
+
+def counting_handler(provider_seconds: float, counter: dict):
+    base = make_handler(provider_seconds)
+
+    class Handler(base):
+        def do_POST(self):
+            if self.path in ("/v1/payment_intents", "/v2/checkout/orders"):
+                with counter["lock"]:
+                    counter["created"] += 1
+            super().do_POST()
+
+    return Handler
+
+
+async def run(mode: str, payment_agent: PaymentAgent, num_cards: int, select_ratio: float):
+    ## warm up the Stripe client and the PayPal token
+    warm_up = payment_agent.create_order(5.0, "USD")
+    await payment_agent.acheckout(payment_method=PAYMENT_METHOD_ALL, order_id=warm_up[ORDER_ID], amount=5.0, currency="USD")
+    card_ms = []
+    order_ids = []
+    for _ in range(num_cards):
+        order = payment_agent.create_order(5.0, "USD")
+        start = time.perf_counter()
+        result = await payment_agent.acheckout(payment_method=PAYMENT_METHOD_ALL, order_id=order[ORDER_ID], amount=5.0,
+                                               currency="USD", checkout_mode=mode)
+        card_ms.append((time.perf_counter() - start) * 1000)
+        assert result[KEY_CHECKOUT_HTML] and result[KEY_CHECKOUT_JS]
+        order_ids.append(order[ORDER_ID])
+
+    select_ms = []
+    if mode == CHECKOUT_MODE_LAZY:
+        selected = order_ids[:int(num_cards * select_ratio)]
+        for index, order_id in enumerate(selected):
+            method = PAYMENT_METHOD_CREDIT_CARD if index % 2 == 0 else PAYMENT_METHOD_PAYPAL
+            start = time.perf_counter()
+            payment = await payment_agent.aselect_payment_method(order_id, method)
+            select_ms.append((time.perf_counter() - start) * 1000)
+            assert payment[KEY_SUCCESS], payment
+    await payment_agent.async_http_client.aclose()
+    return card_ms, select_ms
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cards", type=int, default=50)
+    parser.add_argument("--select_ratio", type=float, default=0.1)
+    parser.add_argument("--provider_ms", type=float, default=300.0)
+    args = parser.parse_args()
+
+    counter = {"created": 0, "lock": threading.Lock()}
+    server = ThreadingHTTPServer(("127.0.0.1", 0), counting_handler(args.provider_ms / 1000.0, counter))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    mock_url = f"http://127.0.0.1:{server.server_address[1]}"
+    stripe.api_base = mock_url
+    paypal_auth.PAYPAL_BASE_URL_SANDBOX = mock_url
+
+    async def run_modes():
+        ## one event loop for both modes, Stripe's async client is process wide
+        print(f"{'mode':>6} | {'cards':>5} | {'mean card ms':>12} | {'max card ms':>11} | {'selects':>7} | {'mean select ms':>14} | provider payments")
+        for mode in [CHECKOUT_MODE_EAGER, CHECKOUT_MODE_LAZY]:
+            payment_agent = PaymentAgent(AgentPaymentConfig(stripe_secret_key="sk_test_mock", stripe_publishable_key="pk_test_mock",
+                                                            paypal_client_id="mock_client", paypal_secret="mock_secret",
+                                                            checkout_select_url="/api/checkout/select"))
+            with counter["lock"]:
+                counter["created"] = 0
+            card_ms, select_ms = await run(mode, payment_agent, args.cards, args.select_ratio)
+            ## minus the 2 payments of the warm up checkout
+            created = counter["created"] - 2
+            mean_select = f"{sum(select_ms) / len(select_ms):.1f}" if select_ms else "-"
+            print(f"{mode:>6} | {args.cards:>5} | {sum(card_ms) / len(card_ms):>12.1f} | {max(card_ms):>11.1f} | "
+                  f"{len(select_ms):>7} | {mean_select:>14} | {created}")
+
+    asyncio.run(run_modes())
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+SQLite insert throughput of the orders table with random order ids (order_<uuid4 hex>, the
+former create_order format) against k-sortable ids (order_<ULID>, the current one).
+
+Random keys land all over the order_id B-tree, so once the index outgrows the page cache
+most inserts touch a page that is not cached. Sortable keys always append to the right
+edge of the index. --cache_kb keeps the page cache small to reach that regime quickly.
+
+Usage:
+    python benchmarks/benchmark_order_id_insert.py --rows 1000000 --batch 1000
+"""
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+import uuid
+
+from agent_a2z_payment.ids import new_ulid
+from agent_a2z_payment.order_store import CREATE_ORDERS_TABLE_SQL, UPSERT_ORDER_SQL
+
+
+def random_order_id():
+    return f"order_{uuid.uuid4().hex[:16]}"
+
+
+def sortable_order_id():
+    return f"order_{new_ulid()}"
+
+
+def run(name, make_id, rows: int, batch: int, cache_kb: int, report_every: int):
+    db_path = os.path.join(tempfile.mkdtemp(), f"orders_{name}.db")
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA journal_mode=WAL;")
+    conn.execute("PRAGMA synchronous=NORMAL;")
+    conn.execute(f"PRAGMA cache_size=-{cache_kb};")
+    conn.execute(CREATE_ORDERS_TABLE_SQL)
+    conn.commit()
+
+    now = int(time.time())
+    total_seconds = 0.0
+    window_seconds = 0.0
+    for start in range(0, rows, batch):
+        params = [(make_id(), 4.25, "USD", "", "pending", now, now + 120, now) for _ in range(batch)]
+        t0 = time.perf_counter()
+        with conn:
+            conn.executemany(UPSERT_ORDER_SQL, params)
+        elapsed = time.perf_counter() - t0
+        total_seconds += elapsed
+        window_seconds += elapsed
+        if (start + batch) % report_every == 0:
+            print(f"{name:>8} | {start + batch:>9} rows | {report_every / window_seconds:>10.0f} rows/s (last {report_every})")
+            window_seconds = 0.0
+    conn.close()
+    size_mb = os.path.getsize(db_path) / 2 ** 20
+    print(f"{name:>8} | total {rows / total_seconds:>10.0f} rows/s | db {size_mb:.1f} MB")
+    return rows / total_seconds
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--batch", type=int, default=1000)
+    parser.add_argument("--cache_kb", type=int, default=2000)
+    parser.add_argument("--report_every", type=int, default=200000)
+    args = parser.parse_args()
+
+    random_rate = run("random", random_order_id, args.rows, args.batch, args.cache_kb, args.report_every)
+    sortable_rate = run("sortable", sortable_order_id, args.rows, args.batch, args.cache_kb, args.report_every)
+    print(f"sortable / random throughput: {sortable_rate / random_rate:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Memory benchmark of open orders in PaymentAgent.orders: the former dict per order
+against the slotted Order record, measured with tracemalloc.
+
+Usage:
+    python benchmarks/benchmark_order_memory.py --sizes 100000,1000000
+"""
+import argparse
+import gc
+import time
+import tracemalloc
+import uuid
+
+from agent_a2z_payment.constants import *
+from agent_a2z_payment.order import Order, OrderStatus, to_minor_units
+
+
+def build_dict_orders(n: int, now: int):
+    orders = {}
+    for i in range(n):
+        order_id = f"order_{uuid.uuid4().hex[:16]}"
+        orders[order_id] = {
+            ORDER_ID: order_id,
+            AMOUNT: 4.25 + i % 100,
+            CURRENCY: CURRENCY_USD,
+            DESCRIPTION: "",
+            STATUS: STATUS_PENDING,
+            CREATED: now + i,
+            EXPIRES: now + i + ORDER_EXPIRE_SECONDS_DEFAULT,
+            EVENT: None
+        }
+    return orders
+
+
+def build_slotted_orders(n: int, now: int):
+    orders = {}
+    for i in range(n):
+        order_id = f"order_{uuid.uuid4().hex[:16]}"
+        orders[order_id] = Order(order_id, amount_minor=to_minor_units(4.25 + i % 100), currency=CURRENCY_USD,
+                                 description="", status=OrderStatus.PENDING, created=now + i,
+                                 expires=now + i + ORDER_EXPIRE_SECONDS_DEFAULT, event=None)
+    return orders
+
+
+def measure(build, n: int):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    orders = build(n, int(time.time()))
+    seconds = time.perf_counter() - start
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del orders
+    return current, seconds
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="100000,1000000")
+    args = parser.parse_args()
+
+    print(f"{'orders':>8} | {'layout':>7} | {'total MB':>9} | {'bytes/order':>11} | {'build s':>7}")
+    for size in [int(s) for s in args.sizes.split(",")]:
+        results = {}
+        for name, build in [("dict", build_dict_orders), ("slotted", build_slotted_orders)]:
+            current, seconds = measure(build, size)
+            results[name] = current
+            print(f"{size:>8} | {name:>7} | {current / 2 ** 20:>9.1f} | {current / size:>11.1f} | {seconds:>7.2f}")
+        print(f"{size:>8} | saving  | {(results['dict'] - results['slotted']) / 2 ** 20:>9.1f} | "
+              f"{(results['dict'] - results['slotted']) / size:>11.1f} | {results['dict'] / results['slotted']:>6.2f}x")
+
+
+if __name__ == "__main__":
+    main()
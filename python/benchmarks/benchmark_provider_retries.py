@@ -0,0 +1,166 @@
+"""
+Failed cards and checkout tail latency on flaky providers: no retries, retries with jittered
+backoff, retries plus hedged requests.
+
+Stripe and PayPal are a local mock server. Each provider request answers 503 with probability
+--fail_rate, stalls for --slow_ms with probability --slow_rate, and answers after --provider_ms
+otherwise. As Stripe and PayPal do, the mock returns the object of the first request for a
+repeated Idempotency-Key / PayPal-Request-Id, so a retried or hedged request creates no second
+payment. A card failed if it is missing the credit card or PayPal payment.
+
+Usage:
+    python benchmarks/benchmark_provider_retries.py --checkouts 200 --concurrency 10
+"""
+import argparse
+import asyncio
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import stripe
+
+from agent_a2z_payment import paypal_auth
+from agent_a2z_payment.constants import *
+from agent_a2z_payment.core import AgentPaymentConfig, PaymentAgent
+
+
+class FlakyProviders:
+    def __init__(self, provider_seconds: float, fail_rate: float, slow_rate: float, slow_seconds: float, seed: int):
+        self.provider_seconds = provider_seconds
+        self.fail_rate = fail_rate
+        self.slow_rate = slow_rate
+        self.slow_seconds = slow_seconds
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.objects = {}
+        self.requests = 0
+        self.unkeyed = 0
+
+    def reset(self, seed: int):
+        with self.lock:
+            self.random.seed(seed)
+            self.objects = {}
+            self.requests = 0
+            self.unkeyed = 0
+
+
+def make_handler(mock: FlakyProviders):
+    class Handler(BaseHTTPRequestHandler):
+        disable_nagle_algorithm = True
+        protocol_version = "HTTP/1.1"
+
+        def _reply(self, status: int, body: dict):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if self.path == "/v1/oauth2/token":
+                self._reply(200, {"access_token": "mock_token", "expires_in": 32400})
+                return
+            key = self.headers.get("Idempotency-Key") or self.headers.get("PayPal-Request-Id")
+            with mock.lock:
+                mock.requests += 1
+                mock.unkeyed += 0 if key else 1
+                draw = mock.random.random()
+            if draw < mock.fail_rate:
+                time.sleep(mock.provider_seconds / 4)
+                self._reply(503, {"error": {"type": "api_error", "message": "Service Unavailable"}})
+                return
+            time.sleep(mock.slow_seconds if draw < mock.fail_rate + mock.slow_rate else mock.provider_seconds)
+            with mock.lock:
+                if key not in mock.objects:
+                    object_id = f"{time.time_ns()}"
+                    if self.path == "/v1/payment_intents":
+                        mock.objects[key] = {"id": f"pi_{object_id}", "object": "payment_intent",
+                                             "client_secret": f"pi_{object_id}_secret"}
+                    else:
+                        mock.objects[key] = {"id": object_id, "status": "CREATED",
+                                             "links": [{"rel": "approve", "href": f"https://paypal.mock/approve?token={object_id}"}]}
+                body = mock.objects[key]
+            self._reply(200, body)
+
+        def handle_one_request(self):
+            try:
+                super().handle_one_request()
+            except (BrokenPipeError, ConnectionResetError):
+                ## the losing request of a hedge was cancelled
+                self.close_connection = True
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+async def run(payment_agent: PaymentAgent, num_checkouts: int, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            order_id = payment_agent.create_order(5.0, "USD")[ORDER_ID]
+            start = time.perf_counter()
+            result = await payment_agent.acheckout(payment_method=PAYMENT_METHOD_ALL, order_id=order_id, amount=5.0, currency="USD")
+            timings = result[KEY_PROVIDER_TIMINGS]
+            failed = any(timing[STATUS] not in (PROVIDER_STATUS_OK, PROVIDER_STATUS_CACHED) for timing in timings.values())
+            return time.perf_counter() - start, failed
+
+    results = await asyncio.gather(*[one() for _ in range(num_checkouts)])
+    await payment_agent.async_http_client.aclose()
+    return results
+
+
+def percentile(values, quantile):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * quantile))]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--checkouts", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--provider_ms", type=float, default=100.0)
+    parser.add_argument("--fail_rate", type=float, default=0.05)
+    parser.add_argument("--slow_rate", type=float, default=0.02)
+    parser.add_argument("--slow_ms", type=float, default=2000.0)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    mock = FlakyProviders(args.provider_ms / 1000.0, args.fail_rate, args.slow_rate, args.slow_ms / 1000.0, args.seed)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(mock))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    mock_url = f"http://127.0.0.1:{server.server_address[1]}"
+    stripe.api_base = mock_url
+    paypal_auth.PAYPAL_BASE_URL_SANDBOX = mock_url
+
+    print(f"{'policy':>13} | {'checkouts':>9} | {'failed cards':>12} | {'p50 ms':>7} | {'p95 ms':>7} | {'p99 ms':>7} | "
+          f"{'requests':>8} | {'payments':>8} | {'unkeyed':>7} | retries/hedges/wins")
+    policies = [("no retries", 1, False), ("retries", 3, False), ("retries+hedge", 3, True)]
+    for name, max_attempts, hedge in policies:
+        mock.reset(args.seed)
+        payment_agent = PaymentAgent(AgentPaymentConfig(
+            stripe_secret_key="sk_test_mock", stripe_publishable_key="pk_test_mock",
+            paypal_client_id="mock_client", paypal_secret="mock_secret",
+            provider_max_attempts=max_attempts, provider_hedge=hedge,
+            ## flaky, not down, keep the circuits closed
+            circuit_failure_rate=1.0))
+        results = asyncio.run(run(payment_agent, args.checkouts, args.concurrency))
+        latencies = [seconds * 1000 for seconds, _ in results]
+        failed = sum(1 for _, card_failed in results if card_failed)
+        metrics = payment_agent.provider_metrics()
+        counters = "/".join(str(sum(metrics[method][counter] for method in CHECKOUT_SELECT_METHODS))
+                            for counter in (PROVIDER_COUNTER_RETRIES, PROVIDER_COUNTER_HEDGES, PROVIDER_COUNTER_HEDGE_WINS))
+        print(f"{name:>13} | {args.checkouts:>9} | {failed:>12} | {percentile(latencies, 0.5):>7.1f} | "
+              f"{percentile(latencies, 0.95):>7.1f} | {percentile(latencies, 0.99):>7.1f} | {mock.requests:>8} | "
+              f"{len(mock.objects):>8} | {mock.unkeyed:>7} | {counters}")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
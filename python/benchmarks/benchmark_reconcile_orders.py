@@ -0,0 +1,161 @@
+"""
+Reconciliation of the orders whose payment webhook was lost: per order status polling against the
+bulk OrderReconciler, on the local mock provider server (agent_a2z_payment.mock_providers).
+
+Every order gets an "all" checkout (credit card PaymentIntent and PayPal order),
+then --paid_rate of the buyers pay one of them at the mock. The mock sends no webhooks, so all
+orders stay pending. Per order polling retrieves the provider objects of each pending order (card, Checkout
+Session, PayPal, until one is paid), the reconciler pages the Stripe lists and fetches
+only the PayPal orders Stripe did not settle, captures the approved ones and marks the orders
+paid, which must set the events the payment streams wait on.
+
+Usage:
+    python benchmarks/benchmark_reconcile_orders.py --orders 1000 --paid_rate 0.5
+"""
+import argparse
+import asyncio
+import random
+import time
+
+import stripe
+
+from agent_a2z_payment.constants import *
+from agent_a2z_payment.core import AgentPaymentConfig, PaymentAgent
+from agent_a2z_payment.mock_providers import LatencyDistribution, MockProviderServer
+from agent_a2z_payment.order import OrderStatus
+from agent_a2z_payment.paypal_auth import apaypal_request, paypal_base_url
+
+
+async def create_orders(payment_agent: PaymentAgent, mock: MockProviderServer, num_orders: int, paid_rate: float,
+                        rng: random.Random):
+    """
+    :return: order id -> the method the buyer paid, None if unpaid.
+    """
+    semaphore = asyncio.Semaphore(50)
+
+    async def one():
+        async with semaphore:
+            order = await payment_agent.acreate_order(5.0 + rng.randint(0, 100), "USD")
+            await payment_agent.acheckout(payment_method=PAYMENT_METHOD_ALL, order_id=order.order_id, amount=order.amount, currency="USD")
+        return order.order_id
+
+    paid = {}
+    for order_id in await asyncio.gather(*[one() for _ in range(num_orders)]):
+        paid[order_id] = None
+        if rng.random() >= paid_rate:
+            continue
+        method = rng.choice(CHECKOUT_SELECT_METHODS)
+        payment = payment_agent.orders.get_payment(order_id, method)
+        if payment is None:
+            continue
+        if method == PAYMENT_METHOD_CREDIT_CARD:
+            object_id = payment[KEY_STRIPE_CLIENT_SECRET].split("_secret")[0]
+        elif method == PAYMENT_METHOD_STRIPE:
+            object_id = payment[KEY_PAYMENT_URL].rsplit("/", 1)[1]
+        else:
+            object_id = payment[KEY_PAYPAL_ORDER_ID]
+        if mock.pay(object_id):
+            paid[order_id] = method
+    return paid
+
+
+async def poll_per_order(payment_agent: PaymentAgent, concurrency: int):
+    """
+    Baseline, the provider objects of every pending order one by one, as polling /status per order would.
+
+    :return: (orders found paid, api calls, seconds).
+    """
+    config = payment_agent.config
+    semaphore = asyncio.Semaphore(concurrency)
+    calls = {"count": 0}
+
+    async def one(order_id):
+        async with semaphore:
+            card = payment_agent.orders.get_payment(order_id, PAYMENT_METHOD_CREDIT_CARD)
+            if card:
+                calls["count"] += 1
+                intent = await stripe.PaymentIntent.retrieve_async(card[KEY_STRIPE_CLIENT_SECRET].split("_secret")[0])
+                if intent["status"] == STRIPE_PAYMENT_INTENT_SUCCEEDED:
+                    return True
+            checkout = payment_agent.orders.get_payment(order_id, PAYMENT_METHOD_STRIPE)
+            if checkout:
+                calls["count"] += 1
+                session = await stripe.checkout.Session.retrieve_async(checkout[KEY_PAYMENT_URL].rsplit("/", 1)[1])
+                if session["payment_status"] == STRIPE_CHECKOUT_SESSION_PAID:
+                    return True
+            paypal = payment_agent.orders.get_payment(order_id, PAYMENT_METHOD_PAYPAL)
+            if paypal:
+                calls["count"] += 1
+                url = f"{paypal_base_url(config.environment.value, config.paypal_base_url)}/v2/checkout/orders/{paypal[KEY_PAYPAL_ORDER_ID]}"
+                response = await apaypal_request("GET", url, config.paypal_client_id, config.paypal_secret,
+                                                 config.environment.value, http_client=payment_agent.async_http_client,
+                                                 base_url=config.paypal_base_url)
+                return response.json().get("status") in (PAYPAL_ORDER_APPROVED, PAYPAL_ORDER_COMPLETED)
+            return False
+
+    start = time.perf_counter()
+    pending = payment_agent.orders.list_orders(status=OrderStatus.PENDING)
+    found = await asyncio.gather(*[one(order.order_id) for order in pending])
+    return sum(found), calls["count"], time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--orders", type=int, default=1000)
+    parser.add_argument("--paid_rate", type=float, default=0.5)
+    parser.add_argument("--stripe_latency", default="lognormal:150:0.4")
+    parser.add_argument("--paypal_latency", default="lognormal:250:0.4")
+    parser.add_argument("--paypal_concurrency", type=int, default=RECONCILE_PAYPAL_CONCURRENCY)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    ## fast providers while the orders are created, no webhook endpoint: every webhook is lost
+    mock = MockProviderServer(stripe_latency="fixed:2", paypal_latency="fixed:2", token_latency="fixed:2", seed=args.seed)
+    mock_url = mock.start()
+    payment_agent = PaymentAgent(AgentPaymentConfig(
+        stripe_secret_key="sk_test_mock", stripe_publishable_key="pk_test_mock",
+        paypal_client_id="mock_client", paypal_secret="mock_secret",
+        stripe_api_base=mock_url, paypal_base_url=mock_url))
+    payment_agent.reconciler.paypal_concurrency = args.paypal_concurrency
+
+    async def run():
+        rng = random.Random(args.seed)
+        paid = await create_orders(payment_agent, mock, args.orders, args.paid_rate, rng)
+        ## the reconciler checks the orders created before this second
+        await asyncio.sleep(1.1)
+        mock.latencies["stripe"] = LatencyDistribution.parse(args.stripe_latency)
+        mock.latencies["paypal"] = LatencyDistribution.parse(args.paypal_latency)
+        polled = await poll_per_order(payment_agent, args.paypal_concurrency)
+        first = await payment_agent.areconcile_orders(min_age_seconds=0)
+        ## the events are set on the loop
+        await asyncio.sleep(0.1)
+        second = await payment_agent.areconcile_orders(min_age_seconds=0)
+        await payment_agent.async_http_client.aclose()
+        return paid, polled, first, second
+
+    paid, polled, first, second = asyncio.run(run())
+    paid_orders = [order_id for order_id, method in paid.items() if method]
+    settled = [order_id for order_id in paid_orders if payment_agent.orders.get(order_id).status == OrderStatus.PAID]
+    released = [order_id for order_id in settled if payment_agent.orders.get(order_id).event.is_set()]
+    wrongly_paid = [order_id for order_id, method in paid.items()
+                    if not method and payment_agent.orders.get(order_id).status != OrderStatus.PENDING]
+    by_method = {method: sum(1 for paid_method in paid.values() if paid_method == method) for method in CHECKOUT_SELECT_METHODS}
+
+    print(f"orders {args.orders} | paid at the providers {len(paid_orders)} {by_method} | webhooks lost, all pending")
+    print(f"stripe {args.stripe_latency} | paypal {args.paypal_latency} | concurrency {args.paypal_concurrency}")
+    print(f"{'run':>17} | {'orders':>6} | {'paid':>5} | {'api calls':>9} | {'calls/order':>11} | {'seconds':>7} | {'orders/s':>8}")
+    found, calls, seconds = polled
+    print(f"{'per order polling':>17} | {args.orders:>6} | {found:>5} | {calls:>9} | {calls / args.orders:>11.3f} | "
+          f"{seconds:>7.2f} | {args.orders / seconds:>8.1f}")
+    for name, report in (("reconciler", first), ("reconciler again", second)):
+        calls = sum(report["api_calls"].values())
+        print(f"{name:>17} | {report['checked']:>6} | {report['paid']:>5} | {calls:>9} | {report['api_calls_per_order']:>11.3f} | "
+              f"{report['seconds']:>7.2f} | {report['orders_per_second']:>8.1f}   {report['api_calls']} errors {report['errors']}")
+    print(f"paid orders settled {len(settled)}/{len(paid_orders)} | streams released {len(released)}/{len(settled)} | "
+          f"unpaid orders changed {len(wrongly_paid)}")
+    print(f"reconcile_metrics {payment_agent.reconcile_metrics()}")
+    mock.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Benchmark of PaymentAgent token counting: the per-message count_tokens loop
+against the batched TiktokenAgent.count_tokens_batch, without and with the
+token count cache (the cached run re-quotes the same transcript).
+
+Usage:
+    python benchmarks/benchmark_token_count.py --repeat 20
+"""
+import argparse
+import random
+import statistics
+import time
+
+from agent_a2z_payment.core import TiktokenAgent
+
+SAMPLE_SENTENCES = [
+    "Please summarize the quarterly report and list the three biggest risks.",
+    "The user asked for a 4K version of the generated image after seeing the preview.",
+    "def calculate_payment(messages):\n    return sum(len(m) for m in messages)\n",
+    "支付成功后，智能体将继续运行并返回完整的结果。",
+    "Tool call result: {\"status\": \"ok\", \"items\": [1, 2, 3], \"next_page\": null}",
+]
+
+
+def build_messages(n: int, seed: int = 42):
+    rnd = random.Random(seed)
+    messages = []
+    for i in range(n):
+        content = " ".join(rnd.choice(SAMPLE_SENTENCES) for _ in range(rnd.randint(2, 20)))
+        messages.append({"role": "user" if i % 2 == 0 else "assistant", "content": content})
+    return messages
+
+
+def run_loop(tokenizer, contents):
+    return sum(tokenizer.count_tokens(content) for content in contents)
+
+
+def run_batch(tokenizer, contents):
+    return sum(tokenizer.count_tokens_batch(contents))
+
+
+def timed(fn, *args, repeat=10):
+    durations = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(*args)
+        durations.append(time.perf_counter() - start)
+    return result, durations
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_name", default="gpt-4")
+    parser.add_argument("--sizes", default="10,100,1000")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--num_threads", type=int, default=8)
+    args = parser.parse_args()
+
+    tokenizer = TiktokenAgent(args.model_name, num_threads=args.num_threads, cache_max_entries=0)
+    cached_tokenizer = TiktokenAgent(args.model_name, num_threads=args.num_threads, cache_max_entries=100000)
+    print(f"{'messages':>8} | {'loop p50 ms':>11} | {'loop max ms':>11} | {'batch p50 ms':>12} | {'batch max ms':>12} | speedup | {'cached p50 ms':>13}")
+    for size in [int(s) for s in args.sizes.split(",")]:
+        contents = [m["content"] for m in build_messages(size)]
+        loop_total, loop_durations = timed(run_loop, tokenizer, contents, repeat=args.repeat)
+        batch_total, batch_durations = timed(run_batch, tokenizer, contents, repeat=args.repeat)
+        cached_total, cached_durations = timed(run_batch, cached_tokenizer, contents, repeat=args.repeat)
+        assert loop_total == batch_total == cached_total, f"token count mismatch {loop_total} {batch_total} {cached_total}"
+
+        loop_p50 = statistics.median(loop_durations) * 1000
+        batch_p50 = statistics.median(batch_durations) * 1000
+        loop_max = max(loop_durations) * 1000
+        batch_max = max(batch_durations) * 1000
+        cached_p50 = statistics.median(cached_durations) * 1000
+        print(f"{size:>8} | {loop_p50:>11.3f} | {loop_max:>11.3f} | {batch_p50:>12.3f} | {batch_max:>12.3f} | {loop_p50 / batch_p50:>6.2f}x | {cached_p50:>13.3f}")
+    print(f"cache stats: {cached_tokenizer.cache_stats()}")
+    tokenizer.close()
+    cached_tokenizer.close()
+
+
+if __name__ == "__main__":
+    main()
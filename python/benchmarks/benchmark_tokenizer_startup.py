@@ -0,0 +1,61 @@
+"""
+Startup time and RSS of creating PaymentAgents with the shared, lazily loaded
+TokenizerRegistry, against eager loading at construction (the previous behaviour,
+emulated with TokenizerRegistry.prewarm() before the agents are created).
+
+Every mode runs in a fresh interpreter so the numbers do not leak into each other.
+
+Usage:
+    python benchmarks/benchmark_tokenizer_startup.py --agents 8
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+CHILD_CODE = """
+import json, resource, sys, time
+start = time.perf_counter()
+from agent_a2z_payment.core import AgentPaymentConfig, PaymentAgent, TokenizerRegistry
+import_seconds = time.perf_counter() - start
+
+mode, num_agents = sys.argv[1], int(sys.argv[2])
+start = time.perf_counter()
+if mode == "eager":
+    TokenizerRegistry.prewarm()
+agents = [PaymentAgent(AgentPaymentConfig(model_name="gpt-4")) for _ in range(num_agents)]
+startup_seconds = time.perf_counter() - start
+startup_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+start = time.perf_counter()
+agents[0].tokenizer.count_tokens("first quote after startup")
+first_count_seconds = time.perf_counter() - start
+final_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({
+    "mode": mode,
+    "import_ms": import_seconds * 1000,
+    "startup_ms": startup_seconds * 1000,
+    "first_count_ms": first_count_seconds * 1000,
+    "startup_rss_mb": startup_rss_kb / 1024,
+    "final_rss_mb": final_rss_kb / 1024,
+    "loaded": TokenizerRegistry.loaded_encodings(),
+}))
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--agents", type=int, default=8)
+    args = parser.parse_args()
+
+    print(f"{'mode':>6} | {'import ms':>9} | {'startup ms':>10} | {'first count ms':>14} | {'startup RSS MB':>14} | {'final RSS MB':>12} | loaded")
+    for mode in ["eager", "lazy"]:
+        output = subprocess.run([sys.executable, "-c", CHILD_CODE, mode, str(args.agents)],
+                                check=True, capture_output=True, text=True).stdout
+        r = json.loads(output.strip().splitlines()[-1])
+        print(f"{r['mode']:>6} | {r['import_ms']:>9.1f} | {r['startup_ms']:>10.1f} | {r['first_count_ms']:>14.1f} "
+              f"| {r['startup_rss_mb']:>14.1f} | {r['final_rss_mb']:>12.1f} | {','.join(r['loaded'])}")
+
+
+if __name__ == "__main__":
+    main()
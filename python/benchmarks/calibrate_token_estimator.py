@@ -0,0 +1,138 @@
+"""
+Calibration of the TiktokenAgent.estimate_tokens heuristic.
+
+For every encoding the exact tiktoken counts of a corpus are fitted with
+    tokens ~= char_coef * characters + extra_byte_coef * (utf-8 bytes - characters)
+by least squares, then the script prints an accuracy and speed report and the
+calibration dict to paste into TiktokenAgent._ESTIMATOR_CALIBRATION.
+
+Corpus files are plain text (one sample per line) or .jsonl with a "content" field.
+Without --corpus the synthetic transcript of benchmark_token_count.py is used.
+
+Usage:
+    python benchmarks/calibrate_token_estimator.py --corpus chat_logs.jsonl
+"""
+import argparse
+import json
+import math
+import statistics
+import time
+
+from agent_a2z_payment.core import TiktokenAgent
+
+from benchmark_token_count import build_messages
+
+MODEL_BY_ENCODING = {
+    "cl100k_base": "gpt-4",
+    "p50k_base": "text-davinci-003",
+}
+
+# Samples with fewer tokens than this calibrate the absolute error instead of the relative one
+SHORT_SAMPLE_TOKENS = 20
+
+
+def load_corpus(paths):
+    samples = []
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.rstrip("\n")
+                if not line:
+                    continue
+                if path.endswith(".jsonl"):
+                    content = json.loads(line).get("content", "")
+                    if isinstance(content, str) and content:
+                        samples.append(content)
+                else:
+                    samples.append(line)
+    return samples
+
+
+def fit(features, tokens, default_extra_byte_coef):
+    """
+    Least squares fit without intercept of tokens on (characters, extra bytes).
+    """
+    scc = sum(c * c for c, _ in features)
+    see = sum(e * e for _, e in features)
+    sce = sum(c * e for c, e in features)
+    sct = sum(c * t for (c, _), t in zip(features, tokens))
+    set_ = sum(e * t for (_, e), t in zip(features, tokens))
+    det = scc * see - sce * sce
+    if see == 0 or abs(det) < 1e-9:
+        ## ascii only corpus, keep the multibyte coefficient
+        extra_byte_coef = default_extra_byte_coef
+        char_coef = (sct - extra_byte_coef * sce) / scc
+    else:
+        char_coef = (sct * see - set_ * sce) / det
+        extra_byte_coef = (scc * set_ - sce * sct) / det
+    return char_coef, extra_byte_coef
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(math.ceil(q * len(values))) - 1)]
+
+
+def calibrate(encoding_name, samples):
+    agent = TiktokenAgent(MODEL_BY_ENCODING[encoding_name], cache_max_entries=0)
+
+    start = time.perf_counter()
+    tokens = [agent.count_tokens(sample) for sample in samples]
+    exact_seconds = time.perf_counter() - start
+
+    features = [(len(s), len(s.encode("utf-8", "surrogatepass")) - len(s)) for s in samples]
+    default = agent._ESTIMATOR_CALIBRATION.get(encoding_name, agent._ESTIMATOR_CALIBRATION["cl100k_base"])
+    char_coef, extra_byte_coef = fit(features, tokens, default["extra_byte_coef"])
+
+    relative_errors = []
+    absolute_errors = []
+    for (c, e), t in zip(features, tokens):
+        estimate = math.ceil(char_coef * c + extra_byte_coef * e)
+        if t >= SHORT_SAMPLE_TOKENS:
+            relative_errors.append(abs(estimate - t) / t)
+        else:
+            absolute_errors.append(abs(estimate - t))
+
+    calibration = {
+        "char_coef": round(char_coef, 4),
+        "extra_byte_coef": round(extra_byte_coef, 4),
+        "relative_error": round(percentile(relative_errors, 0.99), 4),
+        "absolute_error": int(percentile(absolute_errors, 0.99)),
+    }
+
+    agent._ESTIMATOR_CALIBRATION = dict(agent._ESTIMATOR_CALIBRATION, **{encoding_name: calibration})
+    start = time.perf_counter()
+    for sample in samples:
+        agent.estimate_tokens(sample)
+    estimate_seconds = time.perf_counter() - start
+
+    print(f"\n== {encoding_name} ({len(samples)} samples, {sum(tokens)} tokens) ==")
+    print(f"relative error  p50 {percentile(relative_errors, 0.50):.3f} | p95 {percentile(relative_errors, 0.95):.3f} "
+          f"| p99 {percentile(relative_errors, 0.99):.3f} | max {max(relative_errors, default=0.0):.3f}")
+    print(f"absolute error (< {SHORT_SAMPLE_TOKENS} tokens)  p99 {percentile(absolute_errors, 0.99)} "
+          f"| max {max(absolute_errors, default=0)}")
+    print(f"exact    {exact_seconds * 1e6 / len(samples):9.2f} us/sample")
+    print(f"estimate {estimate_seconds * 1e6 / len(samples):9.2f} us/sample "
+          f"({exact_seconds / max(estimate_seconds, 1e-9):.1f}x faster)")
+    return calibration
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--corpus", nargs="*", default=[])
+    parser.add_argument("--encodings", default="cl100k_base,p50k_base")
+    parser.add_argument("--synthetic_size", type=int, default=5000)
+    args = parser.parse_args()
+
+    samples = load_corpus(args.corpus) if args.corpus else [m["content"] for m in build_messages(args.synthetic_size)]
+    result = {}
+    for encoding_name in args.encodings.split(","):
+        result[encoding_name] = calibrate(encoding_name, samples)
+
+    print("\n_ESTIMATOR_CALIBRATION = " + json.dumps(result, indent=4))
+
+
+if __name__ == "__main__":
+    main()
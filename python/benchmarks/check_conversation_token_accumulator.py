@@ -0,0 +1,80 @@
+"""
+Checks that ConversationTokenAccumulator returns the token count of the whole conversation
+after every kind of change between two turns, compared with counting all messages again:
+
+1. Appended messages are counted incrementally.
+2. An edited message in the middle, a removed and an inserted message are detected and recounted.
+3. A truncated or replaced conversation is recounted.
+4. Concurrent turns of one conversation end with the count of the longest one.
+
+Exits with status 1 on any mismatch.
+
+Usage:
+    python benchmarks/check_conversation_token_accumulator.py --messages 25
+"""
+import argparse
+import random
+import sys
+import threading
+
+from agent_a2z_payment.core import ConversationTokenAccumulator, TiktokenAgent
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=25)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    words = ["payment", "order", "stripe", "paypal", "token", "agent", "checkout", "refund", "12.50", "USD", "\n"]
+
+    def message():
+        return " ".join(rng.choice(words) for _ in range(rng.randint(5, 80)))
+
+    tokenizer = TiktokenAgent("gpt-4", cache_max_entries=0)
+    accumulator = ConversationTokenAccumulator(tokenizer)
+    failures = []
+
+    def check(name: str, conversation_id: str, contents):
+        expected = sum(tokenizer.count_tokens_batch(contents))
+        counted = accumulator.count(conversation_id, contents)
+        print(f"{name:<18} | messages {len(contents):>4} | counted {counted:>6} | expected {expected:>6}")
+        if counted != expected:
+            failures.append(name)
+
+    contents = [message() for _ in range(args.messages)]
+    check("first turn", "c1", contents)
+    contents = contents + [message(), message()]
+    check("appended", "c1", contents)
+    middle = len(contents) // 5
+    contents = contents[:middle] + [contents[middle] + " " + message()] + contents[middle + 1:]
+    check("middle edited", "c1", contents)
+    contents = contents[:middle] + contents[middle + 1:]
+    check("middle removed", "c1", contents)
+    contents = contents[:middle] + [message()] + contents[middle:]
+    check("middle inserted", "c1", contents)
+    contents = contents[:len(contents) // 2]
+    check("truncated", "c1", contents)
+    contents = [message() for _ in range(args.messages)]
+    check("replaced", "c1", contents)
+
+    ## concurrent turns of one conversation, each adding a message
+    shared = [message() for _ in range(args.messages)]
+    turns = [shared[:args.messages // 2 + i] for i in range(args.messages // 2 + 1)]
+    threads = [threading.Thread(target=accumulator.count, args=("c2", turn)) for turn in turns]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    check("after concurrent", "c2", shared)
+
+    print(f"stats {accumulator.stats()}")
+    if failures:
+        print(f"FAILED: {', '.join(failures)}")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""
+Checks that a repeated checkout of an order reuses its provider payments.
+
+1. A second checkout of the same order calls no provider, provider_timings report "cached".
+2. Concurrent checkouts of one fresh order send one idempotency key per provider, so the
+   provider creates one object each (the mock honours Idempotency-Key and PayPal-Request-Id
+   as Stripe and PayPal do).
+3. With a SQLiteOrderStore another worker on the same database reuses the saved payments.
+
+Usage:
+    python benchmarks/check_idempotent_checkout.py --concurrent 10
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import stripe
+
+from agent_a2z_payment import paypal_auth
+from agent_a2z_payment.constants import *
+from agent_a2z_payment.core import AgentPaymentConfig, PaymentAgent
+from agent_a2z_payment.order_store import SQLiteOrderStore
+
+
+class MockProviders:
+    def __init__(self, provider_seconds: float):
+        self.provider_seconds = provider_seconds
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.objects = {}
+        self.keys = set()
+
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+            self.keys = set()
+
+
+def make_handler(mock: MockProviders):
+    class Handler(BaseHTTPRequestHandler):
+        disable_nagle_algorithm = True
+        protocol_version = "HTTP/1.1"
+
+        def _reply(self, body: dict):
+            data = json.dumps(body).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if self.path == "/v1/oauth2/token":
+                self._reply({"access_token": "mock_token", "expires_in": 32400})
+                return
+            key = self.headers.get("Idempotency-Key") or self.headers.get("PayPal-Request-Id")
+            time.sleep(mock.provider_seconds)
+            with mock.lock:
+                mock.requests += 1
+                mock.keys.add(key)
+                if key is None or key not in mock.objects:
+                    object_id = f"{time.time_ns()}"
+                    if self.path == "/v1/payment_intents":
+                        body = {"id": f"pi_{object_id}", "object": "payment_intent", "client_secret": f"pi_{object_id}_secret"}
+                    else:
+                        body = {"id": object_id, "status": "CREATED",
+                                "links": [{"rel": "approve", "href": f"https://paypal.mock/approve?token={object_id}"}]}
+                    if key is None:
+                        self._reply(body)
+                        return
+                    mock.objects[key] = body
+                body = mock.objects[key]
+            self._reply(body)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def new_agent(order_store=None) -> PaymentAgent:
+    return PaymentAgent(AgentPaymentConfig(stripe_secret_key="sk_test_mock", stripe_publishable_key="pk_test_mock",
+                                           paypal_client_id="mock_client", paypal_secret="mock_secret"),
+                        order_store=order_store)
+
+
+async def checkout(payment_agent: PaymentAgent, order_id: str):
+    return await payment_agent.acheckout(payment_method=PAYMENT_METHOD_ALL, order_id=order_id, amount=5.0, currency="USD")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrent", type=int, default=10)
+    parser.add_argument("--provider_ms", type=float, default=100.0)
+    args = parser.parse_args()
+
+    mock = MockProviders(args.provider_ms / 1000.0)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(mock))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    mock_url = f"http://127.0.0.1:{server.server_address[1]}"
+    stripe.api_base = mock_url
+    paypal_auth.PAYPAL_BASE_URL_SANDBOX = mock_url
+    failures = []
+
+    async def run():
+        ## 1. repeated checkout
+        payment_agent = new_agent()
+        order_id = payment_agent.create_order(5.0, "USD")[ORDER_ID]
+        first = await checkout(payment_agent, order_id)
+        mock.reset()
+        second = await checkout(payment_agent, order_id)
+        sync_again = payment_agent.checkout(payment_method=PAYMENT_METHOD_ALL, order_id=order_id, amount=5.0, currency="USD")
+        statuses = sorted({timing[STATUS] for result in (second, sync_again) for timing in result[KEY_PROVIDER_TIMINGS].values()})
+        same_card = first[KEY_CHECKOUT_JS] == second[KEY_CHECKOUT_JS] == sync_again[KEY_CHECKOUT_JS]
+        print(f"repeated checkout  | provider requests {mock.requests} | timings {statuses} | same card {same_card}")
+        if mock.requests != 0 or statuses != [PROVIDER_STATUS_CACHED] or not same_card:
+            failures.append("repeated checkout")
+
+        ## 2. concurrent checkouts of a fresh order
+        order_id = payment_agent.create_order(5.0, "USD")[ORDER_ID]
+        mock.reset()
+        results = await asyncio.gather(*[checkout(payment_agent, order_id) for _ in range(args.concurrent)])
+        cards = {result[KEY_CHECKOUT_JS] for result in results}
+        print(f"concurrent x{args.concurrent:<4} | provider requests {mock.requests} | idempotency keys {len(mock.keys)} | "
+              f"distinct cards {len(cards)}")
+        if len(mock.keys) != 2 or len(cards) != 1:
+            failures.append("concurrent checkout")
+        await payment_agent.async_http_client.aclose()
+
+        ## 3. another worker on the same database
+        db_path = os.path.join(tempfile.mkdtemp(), "orders.db")
+        worker_a = new_agent(SQLiteOrderStore(db_path))
+        order_id = worker_a.create_order(5.0, "USD")[ORDER_ID]
+        await checkout(worker_a, order_id)
+        worker_a.orders.flush()
+        worker_b = new_agent(SQLiteOrderStore(db_path))
+        mock.reset()
+        result = await checkout(worker_b, order_id)
+        statuses = sorted({timing[STATUS] for timing in result[KEY_PROVIDER_TIMINGS].values()})
+        print(f"second worker      | provider requests {mock.requests} | timings {statuses}")
+        if mock.requests != 0 or statuses != [PROVIDER_STATUS_CACHED]:
+            failures.append("second worker")
+        for worker in (worker_a, worker_b):
+            worker.orders.close()
+            await worker.async_http_client.aclose()
+
+    asyncio.run(run())
+    server.shutdown()
+    if failures:
+        print(f"FAILED: {', '.join(failures)}")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Multi-worker check of the shared order state: waiter processes stand in for the uvicorn
+workers holding payment_stream_generator, each creates orders and awaits their events.
+The main process stands in for the worker receiving the webhooks and marks every order
+paid through its own PaymentAgent on the same SQLite database. Every waiter must wake up
+with the order paid, the report shows the webhook to wake up latency.
+
+Exits with status 1 if any waiter timed out, or if the median webhook to wake up latency
+exceeds --max_wake_ms, e.g. a notifier falling back to polling.
+
+Usage:
+    python benchmarks/check_multi_worker_orders.py --workers 4 --orders 50 --max_wake_ms 100
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from agent_a2z_payment.constants import *
+from agent_a2z_payment.core import AgentPaymentConfig, PaymentAgent
+
+
+def waiter_worker(db_path: str, num_orders: int, timeout: float, order_queue, result_queue):
+    async def run():
+        payment_agent = PaymentAgent(AgentPaymentConfig(order_db_path=db_path))
+        orders = [await payment_agent.acreate_order(4.25, CURRENCY_USD) for _ in range(num_orders)]
+        payment_agent.orders.flush()
+        order_queue.put([order[ORDER_ID] for order in orders])
+
+        async def wait(order):
+            try:
+                await asyncio.wait_for(order[EVENT].wait(), timeout=timeout)
+                return order[ORDER_ID], time.time(), str(order[STATUS])
+            except asyncio.TimeoutError:
+                return order[ORDER_ID], None, str(order[STATUS])
+
+        results = await asyncio.gather(*[wait(order) for order in orders])
+        payment_agent.orders.close()
+        result_queue.put((os.getpid(), results))
+
+    asyncio.run(run())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--orders", type=int, default=50)
+    parser.add_argument("--timeout", type=float, default=10.0)
+    parser.add_argument("--max_wake_ms", type=float, default=100.0)
+    args = parser.parse_args()
+
+    db_path = os.path.join(tempfile.mkdtemp(), "orders.db")
+    ctx = multiprocessing.get_context("spawn")
+    order_queue, result_queue = ctx.Queue(), ctx.Queue()
+    workers = [ctx.Process(target=waiter_worker, args=(db_path, args.orders, args.timeout, order_queue, result_queue))
+               for _ in range(args.workers)]
+    for worker in workers:
+        worker.start()
+
+    order_ids = []
+    for _ in workers:
+        order_ids.extend(order_queue.get(timeout=60))
+
+    ## the webhook worker
+    payment_agent = PaymentAgent(AgentPaymentConfig(order_db_path=db_path))
+    paid_at = {}
+    for order_id in order_ids:
+        paid_at[order_id] = time.time()
+        payment_agent.orders.update(order_id, status=STATUS_PAID)
+
+    latencies = []
+    missed = []
+    for _ in workers:
+        pid, results = result_queue.get(timeout=args.timeout + 30)
+        for order_id, woke_at, status in results:
+            if woke_at is None or status != STATUS_PAID:
+                missed.append((pid, order_id, status))
+            else:
+                latencies.append((woke_at - paid_at[order_id]) * 1000)
+    for worker in workers:
+        worker.join()
+    payment_agent.orders.close()
+
+    print(f"workers {args.workers} | orders {len(order_ids)} | woken {len(latencies)} | missed {len(missed)}")
+    if latencies:
+        print(f"webhook to wake up ms  p50 {statistics.median(latencies):.2f} | max {max(latencies):.2f}")
+    for pid, order_id, status in missed[:10]:
+        print(f"MISSED worker {pid} order {order_id} status {status}")
+    slow = bool(latencies) and statistics.median(latencies) > args.max_wake_ms
+    if slow:
+        print(f"SLOW median webhook to wake up {statistics.median(latencies):.2f} ms > {args.max_wake_ms} ms")
+    sys.exit(1 if missed or slow else 0)
+
+
+if __name__ == "__main__":
+    main()
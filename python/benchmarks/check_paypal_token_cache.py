@@ -0,0 +1,125 @@
+"""
+Checks the PayPal access token cache against a local mock of the PayPal OAuth endpoint.
+
+1. N concurrent callers without a cached token share one token request (single-flight).
+2. Inside the refresh-ahead window the cached token is still served and one background
+   request fetches its successor, callers never wait for it.
+3. An API answering 401 invalidates the token and the call is retried once with a new one.
+
+Usage:
+    python benchmarks/check_paypal_token_cache.py --callers 100
+"""
+import argparse
+import json
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from agent_a2z_payment.http_client import ProviderHttpClient
+from agent_a2z_payment.paypal_auth import PayPalTokenCache, paypal_request
+
+
+class MockPayPal:
+    def __init__(self, expires_in: int, token_delay: float):
+        self.expires_in = expires_in
+        self.token_delay = token_delay
+        self.token_requests = 0
+        self.api_requests = 0
+        self.revoked = set()
+        self.lock = threading.Lock()
+
+
+def make_handler(mock: MockPayPal):
+    class Handler(BaseHTTPRequestHandler):
+        disable_nagle_algorithm = True
+        protocol_version = "HTTP/1.1"
+
+        def _reply(self, status: int, body: dict):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if self.path == "/v1/oauth2/token":
+                time.sleep(mock.token_delay)
+                with mock.lock:
+                    mock.token_requests += 1
+                    token = f"token_{mock.token_requests}"
+                self._reply(200, {"access_token": token, "expires_in": mock.expires_in})
+                return
+            with mock.lock:
+                mock.api_requests += 1
+            token = self.headers.get("Authorization", "").replace("Bearer ", "")
+            if token in mock.revoked:
+                self._reply(401, {"name": "AUTHENTICATION_FAILURE"})
+                return
+            self._reply(200, {"status": "COMPLETED", "token": token})
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--callers", type=int, default=100)
+    parser.add_argument("--token_delay", type=float, default=0.2)
+    args = parser.parse_args()
+
+    mock = MockPayPal(expires_in=3, token_delay=args.token_delay)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(mock))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    http_client = ProviderHttpClient()
+    failures = []
+
+    ## 1. single-flight
+    cache = PayPalTokenCache(refresh_ahead_seconds=1.5, expiry_margin_seconds=0.5)
+    with ThreadPoolExecutor(max_workers=args.callers) as pool:
+        tokens = list(pool.map(lambda _: cache.get_token("client", "secret", "sandbox", http_client, base_url),
+                               range(args.callers)))
+    print(f"single-flight | {args.callers} concurrent callers | token requests {mock.token_requests} | "
+          f"distinct tokens {len(set(tokens))}")
+    if mock.token_requests != 1 or set(tokens) != {"token_1"}:
+        failures.append("single-flight")
+
+    ## 2. refresh-ahead, token lives 3s, refresh starts 1.5s before expiry
+    time.sleep(1.6)
+    t0 = time.perf_counter()
+    token = cache.get_token("client", "secret", "sandbox", http_client, base_url)
+    wait_ms = (time.perf_counter() - t0) * 1000
+    time.sleep(args.token_delay + 0.2)
+    refreshed = cache.get_token("client", "secret", "sandbox", http_client, base_url)
+    print(f"refresh-ahead | served {token} in {wait_ms:.1f}ms | after refresh {refreshed} | "
+          f"token requests {mock.token_requests}")
+    if token != "token_1" or refreshed != "token_2" or wait_ms > args.token_delay * 500:
+        failures.append("refresh-ahead")
+
+    ## 3. 401 retry once
+    mock.revoked.add(refreshed)
+    api_before = mock.api_requests
+    response = paypal_request("POST", f"{base_url}/v2/checkout/orders/1/capture", "client", "secret", "sandbox",
+                              http_client=http_client, base_url=base_url, token_cache=cache, json={})
+    print(f"401 retry     | status {response.status_code} | api calls {mock.api_requests - api_before} | "
+          f"retried with {response.json().get('token')}")
+    if response.status_code != 200 or mock.api_requests - api_before != 2:
+        failures.append("401 retry")
+
+    print(f"cache stats   | {cache.stats()}")
+    server.shutdown()
+    http_client.close()
+    if failures:
+        print(f"FAILED: {', '.join(failures)}")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+"""
+Offline load test of checkout and the payment webhooks against the local mock provider server
+(agent_a2z_payment.mock_providers), no sandbox API is called.
+
+The SDK points at the mock with AgentPaymentConfig(stripe_api_base, paypal_base_url). Each
+simulated buyer gets an "all" checkout, then pays by credit card or PayPal through the mock,
+which sends the signed webhooks. A local receiver handles them the way the app's stripe_webhook
+and paypal_webhook endpoints do: stripe.Webhook.construct_event, PayPal verify-webhook-signature,
+capture of an approved PayPal order, order transition to paid. A tampered webhook of each
+provider checks that bad signatures are rejected.
+
+Usage:
+    python benchmarks/load_test_mock_providers.py --buyers 200 --concurrency 20 --stripe_latency lognormal:150:0.4
+"""
+import argparse
+import asyncio
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+import stripe
+
+from agent_a2z_payment.constants import *
+from agent_a2z_payment.core import AgentPaymentConfig, PaymentAgent
+from agent_a2z_payment.mock_providers import MockProviderServer, sign_stripe_payload
+from agent_a2z_payment.order import OrderStatus
+from agent_a2z_payment.paypal_auth import paypal_base_url, paypal_request
+
+
+class WebhookReceiver(ThreadingHTTPServer):
+    ## the mock delivers the webhooks of many buyers at once
+    request_queue_size = 128
+    daemon_threads = True
+
+
+def make_webhook_handler(payment_agent: PaymentAgent, counters: dict, lock: threading.Lock):
+    config = payment_agent.config
+
+    def count(key):
+        with lock:
+            counters[key] = counters.get(key, 0) + 1
+
+    def paypal(method, path, **kwargs):
+        return paypal_request(method, f"{paypal_base_url(config.environment.value, config.paypal_base_url)}{path}",
+                              config.paypal_client_id, config.paypal_secret, config.environment.value,
+                              http_client=payment_agent.http_client, base_url=config.paypal_base_url, **kwargs)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _reply(self, status: int):
+            self.send_response(status)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def do_POST(self):
+            payload = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if self.path == "/stripe/webhook":
+                try:
+                    event = stripe.Webhook.construct_event(payload, self.headers.get("Stripe-Signature"),
+                                                           config.stripe_webhook_secret)
+                except Exception:
+                    count("stripe_rejected")
+                    self._reply(400)
+                    return
+                count("stripe_verified")
+                if event["type"] == "payment_intent.succeeded":
+                    order_id = json.loads(payload)["data"]["object"]["metadata"].get(ORDER_ID)
+                    payment_agent.orders.transition(order_id, OrderStatus.PAID)
+                self._reply(200)
+            elif self.path == "/paypal/webhook":
+                event = json.loads(payload)
+                verification = {
+                    "auth_algo": self.headers.get("PAYPAL-AUTH-ALGO"),
+                    "cert_url": self.headers.get("PAYPAL-CERT-URL"),
+                    "transmission_id": self.headers.get("PAYPAL-TRANSMISSION-ID"),
+                    "transmission_sig": self.headers.get("PAYPAL-TRANSMISSION-SIG"),
+                    "transmission_time": self.headers.get("PAYPAL-TRANSMISSION-TIME"),
+                    "webhook_id": config.paypal_webhook_id,
+                    "webhook_event": event
+                }
+                response = paypal("POST", "/v1/notifications/verify-webhook-signature", json=verification)
+                if response.json().get("verification_status") != "SUCCESS":
+                    count("paypal_rejected")
+                    self._reply(403)
+                    return
+                count("paypal_verified")
+                resource = event["resource"]
+                if event["event_type"] == "CHECKOUT.ORDER.APPROVED":
+                    order_id = resource["purchase_units"][0]["reference_id"]
+                    if payment_agent.orders.transition(order_id, OrderStatus.APPROVED):
+                        capture = paypal("POST", f"/v2/checkout/orders/{resource['id']}/capture", json={})
+                        if capture.json().get("status") == "COMPLETED":
+                            payment_agent.orders.transition(order_id, OrderStatus.PAID)
+                elif event["event_type"] == "PAYMENT.CAPTURE.COMPLETED":
+                    order_id = payment_agent.orders.find_order_id(resource["supplementary_data"]["related_ids"]["order_id"])
+                    ## the capture already marked it paid, a duplicate transition is a no-op
+                    payment_agent.orders.transition(order_id, OrderStatus.PAID)
+                self._reply(200)
+            else:
+                self._reply(404)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+async def buyer(payment_agent: PaymentAgent, mock: MockProviderServer, semaphore: asyncio.Semaphore,
+                paid_at: dict, rng: random.Random, results: list):
+    async with semaphore:
+        order_id = payment_agent.create_order(5.0 + rng.randint(0, 100), "USD")[ORDER_ID]
+        start = time.perf_counter()
+        checkout = await payment_agent.acheckout(payment_method=PAYMENT_METHOD_ALL, order_id=order_id, amount=5.0, currency="USD")
+        checkout_seconds = time.perf_counter() - start
+    method = rng.choice(CHECKOUT_SELECT_METHODS)
+    payment = payment_agent.orders.get_payment(order_id, method)
+    if payment is None:
+        results.append((checkout_seconds, None, method))
+        return
+    object_id = payment[KEY_STRIPE_CLIENT_SECRET].split("_secret")[0] if method == PAYMENT_METHOD_CREDIT_CARD \
+        else payment[KEY_PAYPAL_ORDER_ID]
+    ## the buyer takes a moment, then pays at the provider
+    await asyncio.sleep(rng.uniform(0.0, 0.2))
+    paid_start = time.perf_counter()
+    await asyncio.get_running_loop().run_in_executor(None, requests.post, f"{mock.url}/mock/pay/{object_id}")
+    for _ in range(1000):
+        if order_id in paid_at:
+            break
+        await asyncio.sleep(0.01)
+    results.append((checkout_seconds, paid_at[order_id] - paid_start if order_id in paid_at else None, method))
+
+
+def percentile(values, quantile):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * quantile))] if values else float("nan")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--buyers", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--stripe_latency", default="lognormal:150:0.4")
+    parser.add_argument("--paypal_latency", default="lognormal:250:0.4")
+    parser.add_argument("--error_rate", type=float, default=0.01)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    counters = {}
+    lock = threading.Lock()
+    receiver = WebhookReceiver(("127.0.0.1", 0), None)
+    receiver_url = f"http://127.0.0.1:{receiver.server_address[1]}"
+    mock = MockProviderServer(stripe_latency=args.stripe_latency, paypal_latency=args.paypal_latency,
+                              error_rate=args.error_rate, seed=args.seed,
+                              stripe_webhook_url=f"{receiver_url}/stripe/webhook",
+                              paypal_webhook_url=f"{receiver_url}/paypal/webhook")
+    mock_url = mock.start()
+    payment_agent = PaymentAgent(AgentPaymentConfig(
+        stripe_secret_key="sk_test_mock", stripe_publishable_key="pk_test_mock",
+        paypal_client_id="mock_client", paypal_secret="mock_secret",
+        stripe_webhook_secret=mock.stripe_webhook_secret, paypal_webhook_id=mock.paypal_webhook_id,
+        stripe_api_base=mock_url, paypal_base_url=mock_url))
+    receiver.RequestHandlerClass = make_webhook_handler(payment_agent, counters, lock)
+    threading.Thread(target=receiver.serve_forever, daemon=True).start()
+
+    paid_at = {}
+    payment_agent.orders.add_listener(
+        lambda order: order.status == OrderStatus.PAID and paid_at.setdefault(order.get(ORDER_ID), time.perf_counter()))
+
+    async def run():
+        semaphore = asyncio.Semaphore(args.concurrency)
+        rng = random.Random(args.seed)
+        results = []
+        start = time.perf_counter()
+        await asyncio.gather(*[buyer(payment_agent, mock, semaphore, paid_at, rng, results) for _ in range(args.buyers)])
+        elapsed = time.perf_counter() - start
+        await payment_agent.async_http_client.aclose()
+        return results, elapsed
+
+    results, elapsed = asyncio.run(run())
+    ## a webhook of each provider with a bad signature
+    bad_stripe = json.dumps({"id": "evt_tampered", "object": "event", "type": "payment_intent.succeeded",
+                             "data": {"object": {"metadata": {}}}})
+    requests.post(f"{receiver_url}/stripe/webhook", data=bad_stripe,
+                  headers={"Stripe-Signature": sign_stripe_payload(bad_stripe, "whsec_wrong")})
+    requests.post(f"{receiver_url}/paypal/webhook", json={"event_type": "CHECKOUT.ORDER.APPROVED", "resource": {}},
+                  headers={"PAYPAL-TRANSMISSION-ID": "1", "PAYPAL-TRANSMISSION-TIME": "t", "PAYPAL-TRANSMISSION-SIG": "forged"})
+    time.sleep(0.5)
+
+    checkout_ms = [seconds * 1000 for seconds, _, _ in results]
+    print(f"mock {mock_url} | stripe {args.stripe_latency} | paypal {args.paypal_latency} | error rate {args.error_rate}")
+    print(f"buyers {args.buyers} | concurrency {args.concurrency} | {args.buyers / elapsed:.1f} buyers/s | "
+          f"checkout p50 {percentile(checkout_ms, 0.5):.1f}ms p95 {percentile(checkout_ms, 0.95):.1f}ms")
+    for method in CHECKOUT_SELECT_METHODS:
+        paid_ms = [seconds * 1000 for _, seconds, paid_method in results if paid_method == method and seconds is not None]
+        chosen = sum(1 for _, _, paid_method in results if paid_method == method)
+        print(f"{method:>11} | chosen {chosen:>4} | paid {len(paid_ms):>4} | pay to paid p50 {percentile(paid_ms, 0.5):.1f}ms "
+              f"p95 {percentile(paid_ms, 0.95):.1f}ms")
+    print(f"webhooks | receiver {dict(sorted(counters.items()))}")
+    print(f"mock     | {dict(sorted(mock.stats().items()))}")
+    print(f"circuits | { {method: stats['state'] for method, stats in payment_agent.provider_metrics().items()} }")
+    mock.stop()
+    receiver.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -21,10 +21,50 @@ STATUS_PENDING = "pending"
 CREATED = "created"
 EVENT = "event"
 STATUS_PAID = "paid"
+STATUS_EXPIRED = "expired"
+STATUS_APPROVED = "approved"
+STATUS_CAPTURED = "captured"
+STATUS_REFUNDED = "refunded"
+## notify_payment callback statuses onto the order state machine, a failed payment ends the wait as expired
+NOTIFY_STATUS_SUCCESS = "success"
+NOTIFY_STATUS_DICT = {NOTIFY_STATUS_SUCCESS: STATUS_PAID, "failed": STATUS_EXPIRED, "failure": STATUS_EXPIRED,
+                      "cancelled": STATUS_EXPIRED, "canceled": STATUS_EXPIRED}
+## per order counter of status transitions, the expected value of compare-and-swap transitions
+VERSION = "version"
+EXPIRES = "expires"
+## Order Expiry, seconds after created, in line with the awaiting payment timeout of each method
+ORDER_EXPIRE_SECONDS_DICT = {PAYMENT_METHOD_PAYPAL: 120, PAYMENT_METHOD_CREDIT_CARD: 60, PAYMENT_METHOD_STRIPE: 60}
+ORDER_EXPIRE_SECONDS_DEFAULT = 120
+## a lazy checkout card stays open this long for the user to select a method
+ORDER_EXPIRE_SECONDS_LAZY = 1800
+## Expired orders are kept this long before the sweeper drops them, so late webhooks still find them
+ORDER_EXPIRE_GRACE_SECONDS = 300
+ORDER_SWEEP_INTERVAL_SECONDS = 30
 ESTIMATED_TOKENS = "estimated_tokens"
+ESTIMATED_TOKENS_ERROR_BOUND = "estimated_tokens_error_bound"
+TOKEN_COUNT_MODE = "token_count_mode"
+## index of the price tier of a quote, see AgentPaymentConfig price_tiers
+PRICE_TIER = "price_tier"
+TOKEN_COUNT_MODE_EXACT = "exact"
+TOKEN_COUNT_MODE_ESTIMATE = "estimate"
+
+## Pricing, per thousand tokens rate table keys
+KEY_PRICE_INPUT = "input"
+KEY_PRICE_OUTPUT = "output"
+## input and output price of the default model when no rate table names it
+PRICE_PER_THOUSAND_TOKEN_DEFAULT = 0.10
+
+## Stream Meter Event
+KEY_EVENT_TYPE = "type"
+KEY_THRESHOLD = "threshold"
+KEY_TOKENS = "tokens"
+EVENT_THRESHOLD_CROSSED = "threshold_crossed"
 CURRENCY_USD = "USD"
 CURRENCY_CNY = "CNY"
 CURRENCY_EUR = "EUR"
+## Digits of the minor unit of a currency (cents), Order keeps amounts as integer minor units
+CURRENCY_MINOR_UNIT_DIGITS_DICT = {"JPY": 0, "KRW": 0}
+CURRENCY_MINOR_UNIT_DIGITS_DEFAULT = 2
 
 ## LOG
 LOG_ENABLE = False
@@ -42,6 +82,13 @@ KEY_PAYPAL_SECRET_TEST = "PAYPAL_SECRET_TEST"
 KEY_PAYPAL_SECRET_LIVE = "PAYPAL_SECRET_LIVE"
 KEY_AGENT_A2Z_API_KEY_TEST = "AGENT_A2Z_API_KEY_TEST"
 KEY_AGENT_A2Z_API_KEY_LIVE = "AGENT_A2Z_API_KEY_LIVE"
+KEY_TIKTOKEN_CACHE_DIR = "TIKTOKEN_CACHE_DIR"
+KEY_ORDER_DB_PATH = "A2Z_PAYMENT_ORDER_DB_PATH"
+KEY_ORDER_NOTIFY_DIR = "A2Z_PAYMENT_ORDER_NOTIFY_DIR"
+KEY_CHECKOUT_SELECT_URL = "A2Z_PAYMENT_CHECKOUT_SELECT_URL"
+## provider API base URL overrides, e.g. the local mock provider server (agent_a2z_payment.mock_providers)
+KEY_STRIPE_API_BASE = "A2Z_PAYMENT_STRIPE_API_BASE"
+KEY_PAYPAL_BASE_URL = "A2Z_PAYMENT_PAYPAL_BASE_URL"
 ## Paypal
 KEY_PAYPAL_WEBHOOK_ID = "PAYPAL_WEBHOOK_ID"
 KEY_PAYPAL_CLIENT_ID = "PAYPAL_CLIENT_ID"
@@ -88,6 +135,75 @@ CHECKOUT_CARD_DESCRIPTION = "Checkout Card for Purchase Payment Using Paypal"
 
 KEY_CHECKOUT_HTML = "checkout_html"
 KEY_CHECKOUT_JS = "checkout_js"
+## css display of the payment method options, a provider late or failed at checkout is hidden
+KEY_STRIPE_DISPLAY = "stripe_display"
+KEY_PAYPAL_DISPLAY = "paypal_display"
+
+## Checkout mode, eager: the provider payments are created with the card, lazy: the card renders at once
+## and the payment of a method is created when the user selects it (PaymentAgent.aselect_payment_method)
+CHECKOUT_MODE_EAGER = "eager"
+CHECKOUT_MODE_LAZY = "lazy"
+KEY_CHECKOUT_MODE = "checkout_mode"
+KEY_CHECKOUT_SELECT_URL_JS = "select_url"
+## the payment methods a lazy card may create on select
+CHECKOUT_SELECT_METHODS = [PAYMENT_METHOD_CREDIT_CARD, PAYMENT_METHOD_PAYPAL]
+
+## Checkout provider fan-out, seconds a provider setup may take before the card renders without it
+CHECKOUT_PROVIDER_DEADLINE_SECONDS_DEFAULT = 5.0
+## per provider timing of a checkout result, {"credit_card": {"status": "ok", "ms": 412.3}, ...}
+KEY_PROVIDER_TIMINGS = "provider_timings"
+KEY_ELAPSED_MS = "ms"
+KEY_ERROR = "error"
+PROVIDER_STATUS_OK = "ok"
+PROVIDER_STATUS_TIMEOUT = "timeout"
+PROVIDER_STATUS_FAILED = "failed"
+## the payment saved by an earlier checkout of the order was reused, no provider call
+PROVIDER_STATUS_CACHED = "cached"
+## the circuit of the provider is open, the checkout did not call it
+PROVIDER_STATUS_CIRCUIT_OPEN = "circuit_open"
+
+## Provider circuit breakers, a provider failing half of its latest calls fails fast for a while
+CIRCUIT_CLOSED = "closed"
+CIRCUIT_HALF_OPEN = "half_open"
+CIRCUIT_OPEN = "open"
+## healthiest first
+CIRCUIT_STATES = [CIRCUIT_CLOSED, CIRCUIT_HALF_OPEN, CIRCUIT_OPEN]
+CIRCUIT_WINDOW_SIZE_DEFAULT = 20
+CIRCUIT_MIN_CALLS_DEFAULT = 5
+CIRCUIT_FAILURE_RATE_DEFAULT = 0.5
+CIRCUIT_RESET_SECONDS_DEFAULT = 30.0
+## checkout card option of a payment method, the default selected one is the healthiest offered
+KEY_DEFAULT_METHOD = "default_method"
+CHECKOUT_CARD_OPTIONS = {PAYMENT_METHOD_CREDIT_CARD: "stripe", PAYMENT_METHOD_PAYPAL: "paypal"}
+CHECKOUT_CARD_OPTION_DEFAULT = "agenta2z"
+
+## Provider retries of the idempotent payment creations, jittered exponential backoff and hedged requests
+PROVIDER_RETRY_MAX_ATTEMPTS_DEFAULT = 3
+PROVIDER_RETRY_BASE_DELAY_DEFAULT = 0.1
+PROVIDER_RETRY_MAX_DELAY_DEFAULT = 1.0
+PROVIDER_RETRY_HTTP_STATUSES = {409, 425, 429, 500, 502, 503, 504}
+## a call is hedged after the latency quantile of its provider's successful calls, once there are enough of them
+PROVIDER_HEDGE_QUANTILE_DEFAULT = 0.95
+PROVIDER_HEDGE_MIN_SAMPLES = 20
+PROVIDER_LATENCY_WINDOW_SIZE = 500
+PROVIDER_HEDGE_MIN_DELAY_SECONDS = 0.05
+PROVIDER_COUNTER_RETRIES = "retries"
+PROVIDER_COUNTER_HEDGES = "hedges"
+PROVIDER_COUNTER_HEDGE_WINS = "hedge_wins"
+
+## Reconciliation of the orders a lost webhook left pending, checked with bulk provider list calls
+RECONCILE_MIN_AGE_SECONDS_DEFAULT = 30
+RECONCILE_INTERVAL_SECONDS = 15
+RECONCILE_STRIPE_PAGE_SIZE = 100
+RECONCILE_STRIPE_MAX_PAGES = 50
+## Stripe objects are listed from the oldest order's created time minus this margin, for clock skew
+RECONCILE_STRIPE_CREATED_MARGIN_SECONDS = 60
+RECONCILE_PAYPAL_CONCURRENCY = 8
+STRIPE_PAYMENT_INTENT_SUCCEEDED = "succeeded"
+STRIPE_CHECKOUT_SESSION_COMPLETE = "complete"
+STRIPE_CHECKOUT_SESSION_PAID = "paid"
+PAYPAL_ORDER_APPROVED = "APPROVED"
+PAYPAL_ORDER_COMPLETED = "COMPLETED"
 
 PAYPAL_CHECKOUT_ERROR_HTML = """<h1>Payment Error</h1><p>Could not generate PayPal payment link.</p>"""
 
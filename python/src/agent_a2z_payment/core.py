@@ -1,15 +1,25 @@
 import logging
+import asyncio
+import functools
 from enum import Enum
 import tiktoken
+import regex
 import time
 import math
+import bisect
+import hashlib
+import threading
+import numpy as np
 import stripe
 import requests
 
 import sqlite3
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import List, Dict, Tuple, Optional, Any
+from typing import List, Dict, Tuple, Optional, Any, AsyncIterator
 from calendar import monthrange
+from collections import OrderedDict
 import uuid
 
 import sys, os
@@ -20,6 +30,19 @@ else:
     from importlib.resources import files
 
 from .constants import *
+from .http_client import AsyncProviderHttpClient, ProviderHttpClient
+from .ids import new_ulid
+from .paypal_auth import PAYPAL_TOKEN_CACHE, paypal_request
+from .order import Order, OrderStatus, ORDER_RELEASE_STATUSES, to_minor_units
+from .order_notify import OrderNotifier, UnixSocketOrderNotifier
+from .order_store import OrderStore, InMemoryOrderStore, SQLiteOrderStore
+from .provider_registry import CircuitOpenError, ProviderRegistry
+from .providers import (AsyncPayPalAdapter, AsyncStripeAdapter, paypal_order_error, paypal_order_request,
+                        paypal_order_result, stripe_amount_cents, stripe_amount_too_small_result,
+                        stripe_checkout_session_params, stripe_checkout_session_result,
+                        stripe_payment_intent_params, stripe_payment_intent_result)
+from .reconciler import OrderReconciler
+from .retry_policy import ProviderError, RetryPolicy
 
 template_filepath_obj = files('agent_a2z_payment') / "web/checkout/checkout_template.html"
 script_filepath_obj = files('agent_a2z_payment') / "web/checkout/checkout_scripts.js"
@@ -77,8 +100,48 @@ class AgentPaymentConfig:
                  paypal_webhook_id: Optional[str] = None,
                  alipay_app_id: Optional[str] = None,
                  wechat_mch_id: Optional[str] = None,
-                 price_per_thousand_token=0.10,
-                 model_name="gpt-4"):
+                 # ---- Provider API Base URLs ----
+                 stripe_api_base: Optional[str] = None,
+                 paypal_base_url: Optional[str] = None,
+                 price_per_thousand_token=PRICE_PER_THOUSAND_TOKEN_DEFAULT,
+                 model_name="gpt-4",
+                 # ---- Tokenizer ----
+                 tokenizer_num_threads: int = 8,
+                 token_cache_max_entries: int = 4096,
+                 token_cache_max_bytes: Optional[int] = None,
+                 conversation_token_ttl_seconds: int = 3600,
+                 conversation_token_max_conversations: int = 10000,
+                 token_count_mode: str = TOKEN_COUNT_MODE_EXACT,
+                 tokenizer_bpe_dir: Optional[str] = None,
+                 price_tables: Optional[Dict[str, Dict[str, float]]] = None,
+                 price_tiers: Optional[List[float]] = None,
+                 # ---- Async Executors ----
+                 quote_max_workers: int = 4,
+                 provider_max_workers: int = 16,
+                 # ---- Order Store ----
+                 order_db_path: Optional[str] = None,
+                 order_notify_dir: Optional[str] = None,
+                 # ---- Provider HTTP Client ----
+                 http_pool_connections: int = 10,
+                 http_pool_maxsize: int = 32,
+                 http_connect_timeout: float = 3.05,
+                 http_read_timeout: float = 20.0,
+                 # ---- Checkout ----
+                 checkout_provider_deadlines: Optional[Dict[str, float]] = None,
+                 checkout_mode: str = CHECKOUT_MODE_EAGER,
+                 checkout_select_url: Optional[str] = None,
+                 checkout_deadline_seconds: Optional[float] = None,
+                 # ---- Provider Circuit Breakers ----
+                 circuit_window_size: int = CIRCUIT_WINDOW_SIZE_DEFAULT,
+                 circuit_min_calls: int = CIRCUIT_MIN_CALLS_DEFAULT,
+                 circuit_failure_rate: float = CIRCUIT_FAILURE_RATE_DEFAULT,
+                 circuit_reset_seconds: float = CIRCUIT_RESET_SECONDS_DEFAULT,
+                 # ---- Provider Retries ----
+                 provider_max_attempts: int = PROVIDER_RETRY_MAX_ATTEMPTS_DEFAULT,
+                 provider_retry_base_delay: float = PROVIDER_RETRY_BASE_DELAY_DEFAULT,
+                 provider_retry_max_delay: float = PROVIDER_RETRY_MAX_DELAY_DEFAULT,
+                 provider_hedge: bool = True,
+                 provider_hedge_quantile: float = PROVIDER_HEDGE_QUANTILE_DEFAULT):
         self.environment = Environment(environment.lower())
         # load dotenv
         from dotenv import load_dotenv
@@ -111,8 +174,179 @@ class AgentPaymentConfig:
         else:
             raise ValueError("Environment must be either SANDBOX or PRODUCTION")
 
+        ## point the SDK at another Stripe / PayPal API, e.g. the local mock provider server of load tests,
+        ## the environment keys and webhook settings stay as configured
+        self.stripe_api_base = stripe_api_base or os.getenv(KEY_STRIPE_API_BASE)
+        self.paypal_base_url = paypal_base_url or os.getenv(KEY_PAYPAL_BASE_URL)
         self.model_name = model_name
         self.price_per_thousand_token = price_per_thousand_token
+        self.tokenizer_num_threads = tokenizer_num_threads
+        self.token_cache_max_entries = token_cache_max_entries
+        self.token_cache_max_bytes = token_cache_max_bytes
+        self.conversation_token_ttl_seconds = conversation_token_ttl_seconds
+        self.conversation_token_max_conversations = conversation_token_max_conversations
+        ## exact: tiktoken encoding, estimate: character/byte heuristic with exact fallback near a price tier
+        ## boundary or the Stripe minimum
+        self.token_count_mode = token_count_mode
+        ## local directory of BPE files in tiktoken cache format, for hosts without network access
+        self.tokenizer_bpe_dir = tokenizer_bpe_dir or os.getenv(KEY_TIKTOKEN_CACHE_DIR)
+        ## per model rate tables, e.g. {"gpt-4": {"input": 0.03, "output": 0.06}}, price per thousand tokens
+        ## model_name defaults to price_per_thousand_token for both input and output
+        self.price_tables = price_tables or {}
+        ## amounts where the next price tier starts, e.g. [1.0, 10.0], a quote reports its tier index;
+        ## an estimate whose error bound straddles a tier boundary is counted exactly
+        self.price_tiers = sorted(price_tiers or [])
+        ## bounded pools of the async API: tokenization (CPU) and blocking provider calls (I/O)
+        self.quote_max_workers = quote_max_workers
+        self.provider_max_workers = provider_max_workers
+        ## SQLite order store path, orders are kept in memory only if not set
+        self.order_db_path = order_db_path or os.getenv(KEY_ORDER_DB_PATH)
+        ## socket directory of the workers sharing order_db_path, defaults to "<order_db_path>.notify"
+        self.order_notify_dir = order_notify_dir or os.getenv(KEY_ORDER_NOTIFY_DIR)
+        ## keep-alive connection pool of the provider API calls, pool_maxsize ~ concurrent calls per host
+        self.http_pool_connections = http_pool_connections
+        self.http_pool_maxsize = http_pool_maxsize
+        self.http_connect_timeout = http_connect_timeout
+        self.http_read_timeout = http_read_timeout
+        ## seconds per payment method, e.g. {"paypal": 3.0}, a checkout renders without the providers
+        ## not done by then, CHECKOUT_PROVIDER_DEADLINE_SECONDS_DEFAULT for the methods not set
+        self.checkout_provider_deadlines = checkout_provider_deadlines or {}
+        ## "eager" or "lazy", lazy cards post the selected method to checkout_select_url,
+        ## an endpoint calling PaymentAgent.aselect_payment_method
+        self.checkout_mode = checkout_mode
+        self.checkout_select_url = checkout_select_url or os.getenv(KEY_CHECKOUT_SELECT_URL, "")
+        ## seconds a whole checkout may take, caps every provider deadline, retries included
+        self.checkout_deadline_seconds = checkout_deadline_seconds
+        ## a provider failing circuit_failure_rate of its last circuit_window_size calls (at least
+        ## circuit_min_calls) is not called for circuit_reset_seconds, checkouts leave it out
+        self.circuit_window_size = circuit_window_size
+        self.circuit_min_calls = circuit_min_calls
+        self.circuit_failure_rate = circuit_failure_rate
+        self.circuit_reset_seconds = circuit_reset_seconds
+        ## transient failures of the Stripe and PayPal creations are retried up to provider_max_attempts
+        ## with a jittered backoff, async calls slower than the provider_hedge_quantile latency are hedged,
+        ## all attempts share the idempotency key of the order so only one provider object is created
+        self.provider_max_attempts = provider_max_attempts
+        self.provider_retry_base_delay = provider_retry_base_delay
+        self.provider_retry_max_delay = provider_retry_max_delay
+        self.provider_hedge = provider_hedge
+        self.provider_hedge_quantile = provider_hedge_quantile
+
+class TokenizerRegistry:
+    """
+    Process wide registry of tiktoken encodings, shared by every TiktokenAgent.
+    Encodings are loaded lazily on first use, so creating agents does not load BPE tables,
+    and each table exists once per process. Calling prewarm() before the server forks its
+    workers (or in the FastAPI lifespan) moves the load off the first request.
+    """
+    _encodings = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def configure(cls, bpe_dir: Optional[str] = None):
+        """
+        :param bpe_dir: Directory of BPE files in tiktoken cache format (files named by the sha1 of their
+            download url, as written by tiktoken when TIKTOKEN_CACHE_DIR is set). Encodings are then
+            loaded from this directory without network access.
+        """
+        if bpe_dir:
+            if not os.path.isdir(bpe_dir):
+                raise ValueError(f"TokenizerRegistry bpe_dir {bpe_dir} is not a directory")
+            os.environ[KEY_TIKTOKEN_CACHE_DIR] = bpe_dir
+
+    @classmethod
+    def get_encoding(cls, encoding_name: str):
+        encoding = cls._encodings.get(encoding_name)
+        if encoding is None:
+            with cls._lock:
+                encoding = cls._encodings.get(encoding_name)
+                if encoding is None:
+                    start = time.time()
+                    encoding = tiktoken.get_encoding(encoding_name)
+                    cls._encodings[encoding_name] = encoding
+                    logging.info(f"TokenizerRegistry loaded encoding {encoding_name} in {time.time() - start:.3f}s")
+        return encoding
+
+    @classmethod
+    def prewarm(cls, encoding_names: Optional[List[str]] = None):
+        """
+        Loads the encodings ahead of first use, all encodings known to TiktokenAgent by default.
+        """
+        if encoding_names is None:
+            encoding_names = sorted(set(TiktokenAgent._ENCODING_MAP.values()))
+        for encoding_name in encoding_names:
+            cls.get_encoding(encoding_name)
+
+    @classmethod
+    def loaded_encodings(cls) -> List[str]:
+        return list(cls._encodings.keys())
+
+class TokenCountCache:
+    """
+    Bounded LRU cache of token counts keyed by (encoding name, content hash).
+    Only a 16 byte digest of the text is kept, so every entry costs the same amount of memory
+    and the cache can be bounded by number of entries, by bytes, or both.
+    """
+
+    # Approximate memory of one entry: key tuple, 16 byte digest, int count and OrderedDict node
+    ENTRY_SIZE_BYTES = 200
+
+    def __init__(self, max_entries: Optional[int] = 4096, max_bytes: Optional[int] = None):
+        """
+        :param max_entries: Maximum number of cached counts, None for no entry limit.
+        :param max_bytes: Maximum approximate memory of the cache in bytes, None for no byte limit.
+        """
+        limits = [max_entries] if max_entries is not None else []
+        if max_bytes is not None:
+            limits.append(max_bytes // self.ENTRY_SIZE_BYTES)
+        if not limits:
+            raise ValueError("TokenCountCache requires max_entries or max_bytes")
+        self.capacity = max(0, min(limits))
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(encoding_name: str, text: str) -> Tuple[str, bytes]:
+        digest = hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+        return encoding_name, digest
+
+    def get(self, key: Tuple[str, bytes]) -> Optional[int]:
+        with self._lock:
+            count = self._entries.get(key)
+            if count is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return count
+
+    def put(self, key: Tuple[str, bytes], count: int):
+        if self.capacity == 0:
+            return
+        with self._lock:
+            self._entries[key] = count
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": len(self._entries) * self.ENTRY_SIZE_BYTES,
+                "capacity": self.capacity,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
 
 class TiktokenAgent:
     """
@@ -129,30 +363,469 @@ class TiktokenAgent:
         "default": "cl100k_base",
     }
 
-    def __init__(self, model_name: str = "default"):
+    # Below this many texts the plain loop is cheaper than dispatching to the worker pool
+    _BATCH_MIN_PARALLEL_SIZE = 16
+
+    # Character and byte heuristic of estimate_tokens, per encoding:
+    #   tokens ~= char_coef * characters + extra_byte_coef * (utf-8 bytes - characters)
+    # The second term charges multibyte (e.g. CJK) characters, which split into more tokens than ASCII text.
+    # Error bound of an estimate is relative_error * estimate + absolute_error.
+    # Refit with benchmarks/calibrate_token_estimator.py on your own traffic.
+    _ESTIMATOR_CALIBRATION = {
+        "cl100k_base": {"char_coef": 0.25, "extra_byte_coef": 0.375, "relative_error": 0.25, "absolute_error": 4},
+        "p50k_base": {"char_coef": 0.26, "extra_byte_coef": 0.77, "relative_error": 0.30, "absolute_error": 4},
+    }
+
+    def __init__(self, model_name: str = "default", num_threads: int = 8,
+                 cache_max_entries: Optional[int] = 4096, cache_max_bytes: Optional[int] = None):
         """
         Initializes the agent with a specific model encoding.
 
         :param model_name: The name of the model (e.g., 'gpt-4', 'gpt-3.5-turbo').
+        :param num_threads: Worker threads used by count_tokens_batch, capped at the number of CPUs, 1 disables the pool.
+        :param cache_max_entries: Size of the token count cache in entries, 0 disables the cache.
+        :param cache_max_bytes: Optional size of the token count cache in bytes.
         """
         self.model_name = model_name
         self.encoding_name = self._ENCODING_MAP.get(model_name, self._ENCODING_MAP["default"])
-        self.encoding = tiktoken.get_encoding(self.encoding_name)
+        self.num_threads = max(1, min(int(num_threads), os.cpu_count() or 1))
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        self.cache = None
+        if cache_max_entries != 0 and cache_max_bytes != 0:
+            self.cache = TokenCountCache(max_entries=cache_max_entries, max_bytes=cache_max_bytes)
         print(f"Initialized TiktokenAgent for model '{self.model_name}' using encoding '{self.encoding_name}'.")
 
+    @property
+    def encoding(self):
+        """
+        The shared encoding of the TokenizerRegistry, loaded on first use.
+        """
+        return TokenizerRegistry.get_encoding(self.encoding_name)
+
     def count_tokens(self, text: str) -> int:
         """
         Uses the actual tiktoken encoding to get the precise count.
+        Counts of previously seen texts are served from the token count cache.
+        """
+        if self.cache is None:
+            return len(self.encoding.encode(text))
+        key = TokenCountCache.make_key(self.encoding_name, text)
+        count = self.cache.get(key)
+        if count is None:
+            count = len(self.encoding.encode(text))
+            self.cache.put(key, count)
+        return count
+
+    def count_tokens_batch(self, texts: List[str]) -> List[int]:
+        """
+        Counts the tokens of a list of texts in one call. Texts found in the token count cache
+        are not encoded again, the remaining ones are split into one slice per worker and
+        encoded on a shared thread pool (tiktoken releases the GIL while encoding), so long
+        transcripts do not pay one round of Python overhead per message.
+
+        :param texts: List of texts, e.g. the contents of a conversation.
+        :return: List of token counts, aligned with texts.
+        """
+        if self.cache is None:
+            return self._encode_count_batch(texts)
+
+        counts = [0] * len(texts)
+        miss_keys = []
+        miss_indexes = []
+        for i, text in enumerate(texts):
+            key = TokenCountCache.make_key(self.encoding_name, text)
+            count = self.cache.get(key)
+            if count is None:
+                miss_keys.append(key)
+                miss_indexes.append(i)
+            else:
+                counts[i] = count
+
+        miss_counts = self._encode_count_batch([texts[i] for i in miss_indexes])
+        for i, key, count in zip(miss_indexes, miss_keys, miss_counts):
+            counts[i] = count
+            self.cache.put(key, count)
+        return counts
+
+    def estimate_tokens(self, text: str) -> Tuple[int, int]:
+        """
+        Approximates the token count from the character and UTF-8 byte length of the text,
+        without running the BPE encoder.
+
+        :return: Tuple of (estimated tokens, error bound in tokens).
+        """
+        calibration = self._ESTIMATOR_CALIBRATION.get(self.encoding_name, self._ESTIMATOR_CALIBRATION["cl100k_base"])
+        num_chars = len(text)
+        num_extra_bytes = 0 if text.isascii() else len(text.encode("utf-8", "surrogatepass")) - num_chars
+        estimate = math.ceil(calibration["char_coef"] * num_chars + calibration["extra_byte_coef"] * num_extra_bytes)
+        error_bound = math.ceil(calibration["relative_error"] * estimate + calibration["absolute_error"])
+        return estimate, error_bound
+
+    def estimate_tokens_batch(self, texts: List[str]) -> Tuple[int, int]:
+        """
+        Estimated token total of a list of texts and the summed error bound.
+
+        :return: Tuple of (estimated tokens, error bound in tokens).
+        """
+        estimate_total = 0
+        error_bound_total = 0
+        for text in texts:
+            estimate, error_bound = self.estimate_tokens(text)
+            estimate_total += estimate
+            error_bound_total += error_bound
+        return estimate_total, error_bound_total
+
+    def cache_stats(self) -> Dict[str, int]:
+        """
+        Hit, miss and eviction counters of the token count cache, empty if the cache is disabled.
+        """
+        return self.cache.stats() if self.cache is not None else {}
+
+    def _encode_count_batch(self, texts: List[str]) -> List[int]:
+        if len(texts) < self._BATCH_MIN_PARALLEL_SIZE or self.num_threads <= 1:
+            return self._count_tokens_slice(texts)
+
+        slice_size = math.ceil(len(texts) / self.num_threads)
+        slices = [texts[i:i + slice_size] for i in range(0, len(texts), slice_size)]
+        counts = []
+        for slice_counts in self._get_executor().map(self._count_tokens_slice, slices):
+            counts.extend(slice_counts)
+        return counts
+
+    def _count_tokens_slice(self, texts: List[str]) -> List[int]:
+        return [len(self.encoding.encode(text)) for text in texts]
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        """
+        The pool is created on first batched call and reused, tiktoken's own encode_batch
+        starts and joins a new pool on every call.
+        """
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.num_threads, thread_name_prefix="tiktoken_agent")
+            return self._executor
+
+    def close(self):
+        """
+        Shuts down the worker pool of count_tokens_batch.
         """
-        token_ids = self.encoding.encode(text)
-        return len(token_ids)
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
 
     @classmethod
-    def from_model_name(cls, model_name: str):
+    def from_model_name(cls, model_name: str, **kwargs):
         """
         Class method to create an instance based on a model name.
         """
-        return cls(model_name)
+        return cls(model_name, **kwargs)
+
+class ConversationTokenAccumulator:
+    """
+    Conversation scoped token accounting for growing message lists. For every conversation it
+    remembers a digest and the token count of each counted message. A turn hashes the messages
+    (much cheaper than encoding them) and only counts the messages from the first one whose
+    digest changed: the appended suffix of a grown list, or the rest of the list after an edited,
+    removed or inserted message. Concurrent turns of one conversation are serialized on its own
+    lock. Conversations idle for more than ttl_seconds expire.
+    """
+
+    def __init__(self, tokenizer: TiktokenAgent, ttl_seconds: int = 3600, max_conversations: int = 10000):
+        """
+        :param tokenizer: TiktokenAgent used to count the new messages.
+        :param ttl_seconds: Idle time after which a conversation is forgotten.
+        :param max_conversations: Maximum number of conversations kept, least recently used ones are dropped first.
+        """
+        self.tokenizer = tokenizer
+        self.ttl_seconds = ttl_seconds
+        self.max_conversations = max_conversations
+        # conversation_id -> [message_digests, message_tokens, last_access, lock]
+        self._conversations = OrderedDict()
+        self._lock = threading.Lock()
+        self.incremental_counts = 0
+        self.edit_recounts = 0
+        self.expired = 0
+
+    @staticmethod
+    def _digest(content: str) -> bytes:
+        return hashlib.blake2b(content.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+
+    def count(self, conversation_id: str, contents: List[str]) -> int:
+        """
+        Returns the token total of contents, counting only the messages appended or changed since
+        the previous call for the same conversation.
+
+        :param conversation_id: Id of the conversation, e.g. the chat session_id.
+        :param contents: Contents of all messages of the conversation, in order.
+        :return: Total number of tokens.
+        """
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            state = self._conversations.get(conversation_id)
+            if state is None:
+                state = [[], [], now, threading.Lock()]
+                self._conversations[conversation_id] = state
+            state[2] = now
+            self._conversations.move_to_end(conversation_id)
+            while len(self._conversations) > self.max_conversations:
+                self._conversations.popitem(last=False)
+                self.expired += 1
+
+        digests = [self._digest(content) for content in contents]
+        with state[3]:
+            counted_digests, counted_tokens = state[0], state[1]
+            ## messages up to the first changed one keep their counts
+            unchanged = 0
+            for digest, counted_digest in zip(digests, counted_digests):
+                if digest != counted_digest:
+                    break
+                unchanged += 1
+            tokens = counted_tokens[:unchanged] + self.tokenizer.count_tokens_batch(contents[unchanged:])
+            state[0], state[1] = digests, tokens
+        token_total = sum(tokens)
+
+        with self._lock:
+            if unchanged < len(counted_digests):
+                self.edit_recounts += 1
+            elif counted_digests:
+                self.incremental_counts += 1
+        return token_total
+
+    def forget(self, conversation_id: str):
+        with self._lock:
+            self._conversations.pop(conversation_id, None)
+
+    def _expire(self, now: float):
+        """
+        Conversations are kept in last access order, so expired ones are all at the front.
+        """
+        while self._conversations:
+            conversation_id, state = next(iter(self._conversations.items()))
+            if now - state[2] < self.ttl_seconds:
+                break
+            self._conversations.popitem(last=False)
+            self.expired += 1
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "conversations": len(self._conversations),
+                "incremental_counts": self.incremental_counts,
+                "edit_recounts": self.edit_recounts,
+                "expired": self.expired,
+            }
+
+class StreamingTokenMeter:
+    """
+    Running token count of LLM output while it streams. Chunks are appended to a small pending
+    buffer, and only text up to a stable pre-tokenization boundary is encoded, so the accumulated
+    text is never encoded again and the final count equals encoding the whole output at once.
+    An encoding without a readable pattern falls back to counting the whole output at each flush.
+    Each time the running cost crosses one of the thresholds a threshold_crossed event is emitted,
+    which a workflow can use to insert a payment gate in the middle of the stream.
+    """
+
+    # The last pieces of the pending text can still grow or split differently when the next chunk arrives
+    _HOLD_BACK_PIECES = 2
+
+    def __init__(self, tokenizer: TiktokenAgent, price_per_thousand_token: float,
+                 thresholds: Optional[List[float]] = None, flush_chars: int = 64):
+        """
+        :param tokenizer: TiktokenAgent whose encoding is used.
+        :param price_per_thousand_token: Price used to turn tokens into an amount.
+        :param thresholds: Amounts, e.g. [1.0, 4.0], that emit a threshold_crossed event once reached.
+        :param flush_chars: Pending text is encoded once it reaches this many characters, smaller
+            values keep the running count closer to the stream at the cost of more encode calls.
+        """
+        self.tokenizer = tokenizer
+        self.price_per_thousand_token = price_per_thousand_token
+        self.thresholds = sorted(thresholds or [])
+        self.flush_chars = flush_chars
+        self._pattern = self._compile_pattern(tokenizer.encoding)
+        self._pending = ""
+        ## output so far, kept only without a pattern
+        self._text = ""
+        self._next_threshold = 0
+        self.token_count = 0
+
+    @property
+    def amount(self) -> float:
+        return self.token_count / 1000.0 * self.price_per_thousand_token
+
+    def feed(self, chunk: str) -> List[Dict]:
+        """
+        Adds one chunk of streamed text.
+
+        :return: List of threshold_crossed events, usually empty.
+        """
+        self._pending += chunk
+        if len(self._pending) < self.flush_chars:
+            return []
+        if self._pattern is None:
+            return self._count_whole()
+        cut = self._stable_cut(self._pending)
+        if cut > 0:
+            self.token_count += len(self.tokenizer.encoding.encode_ordinary(self._pending[:cut]))
+            self._pending = self._pending[cut:]
+        return self._check_thresholds()
+
+    def finish(self) -> List[Dict]:
+        """
+        Counts the remaining pending text at the end of the stream.
+
+        :return: List of threshold_crossed events, usually empty.
+        """
+        if self._pattern is None:
+            return self._count_whole()
+        if self._pending:
+            self.token_count += len(self.tokenizer.encoding.encode_ordinary(self._pending))
+            self._pending = ""
+        return self._check_thresholds()
+
+    async def meter(self, chunks: AsyncIterator[str]):
+        """
+        Wraps an async generator of text chunks and yields (chunk, events) tuples, counting each
+        chunk as it passes through.
+        """
+        async for chunk in chunks:
+            yield chunk, self.feed(chunk)
+        events = self.finish()
+        if events:
+            yield "", events
+
+    @staticmethod
+    def _compile_pattern(encoding):
+        ## the pre-tokenization regex is the private _pat_str of tiktoken, None if it is missing or does not compile
+        pat_str = getattr(encoding, "_pat_str", None)
+        if not pat_str:
+            logging.warning(f"StreamingTokenMeter encoding {getattr(encoding, 'name', encoding)} has no _pat_str, counting the whole output")
+            return None
+        try:
+            return regex.compile(pat_str)
+        except Exception as e:
+            logging.warning(f"StreamingTokenMeter compiling _pat_str failed with error {e}, counting the whole output")
+            return None
+
+    def _count_whole(self) -> List[Dict]:
+        self._text += self._pending
+        self._pending = ""
+        self.token_count = len(self.tokenizer.encoding.encode_ordinary(self._text))
+        return self._check_thresholds()
+
+    def _stable_cut(self, text: str) -> int:
+        """
+        Start of the oldest held back piece, moved back so the stable text does not end in whitespace,
+        whose split depends on the text that follows it.
+        """
+        starts = [m.start() for m in self._pattern.finditer(text)]
+        if len(starts) <= self._HOLD_BACK_PIECES:
+            return 0
+        for cut in reversed(starts[1:len(starts) - self._HOLD_BACK_PIECES + 1]):
+            if not text[cut - 1].isspace():
+                return cut
+        return 0
+
+    def _check_thresholds(self) -> List[Dict]:
+        events = []
+        amount = self.amount
+        while self._next_threshold < len(self.thresholds) and amount >= self.thresholds[self._next_threshold]:
+            events.append({
+                KEY_EVENT_TYPE: EVENT_THRESHOLD_CROSSED,
+                KEY_THRESHOLD: self.thresholds[self._next_threshold],
+                AMOUNT: round(amount, 4),
+                KEY_TOKENS: self.token_count,
+            })
+            self._next_threshold += 1
+        return events
+
+class PricingEngine:
+    """
+    Holds per model rate tables (price per thousand input and output tokens) and computes
+    quotes for arrays of token counts in vectorized NumPy form, e.g. to re-price historical
+    conversations under different rate tables. Every quote is raised to min_amount, the same
+    minimum rule as MIN_PAYMENT_AMOUNT_STRIPE_CENTS.
+    """
+
+    def __init__(self, price_tables: Optional[Dict[str, Dict[str, float]]] = None,
+                 default_model_name: str = "default",
+                 min_amount: float = MIN_PAYMENT_AMOUNT_STRIPE_CENTS/100.0,
+                 decimals: int = 4, tiers: Optional[List[float]] = None):
+        """
+        :param price_tables: Dict of model name to {"input": price, "output": price}, prices per thousand tokens.
+        :param default_model_name: Model used when a quote does not name one, priced at
+            PRICE_PER_THOUSAND_TOKEN_DEFAULT if price_tables has no table for it.
+        :param min_amount: Minimum amount of a quote.
+        :param decimals: Decimals quotes are rounded to.
+        :param tiers: Ascending amounts where the next price tier starts, see tier().
+        """
+        self.price_tables = {}
+        for model_name, rates in (price_tables or {}).items():
+            self.set_rate_table(model_name, rates[KEY_PRICE_INPUT], rates.get(KEY_PRICE_OUTPUT, rates[KEY_PRICE_INPUT]))
+        if default_model_name not in self.price_tables:
+            self.set_rate_table(default_model_name, PRICE_PER_THOUSAND_TOKEN_DEFAULT, PRICE_PER_THOUSAND_TOKEN_DEFAULT)
+        self.default_model_name = default_model_name
+        self.min_amount = min_amount
+        self.decimals = decimals
+        self.tiers = sorted(tiers or [])
+
+    @classmethod
+    def from_config(cls, config: AgentPaymentConfig):
+        price_tables = {config.model_name: {KEY_PRICE_INPUT: config.price_per_thousand_token,
+                                            KEY_PRICE_OUTPUT: config.price_per_thousand_token}}
+        price_tables.update(config.price_tables)
+        return cls(price_tables, default_model_name=config.model_name, tiers=config.price_tiers)
+
+    def tier(self, amount: float) -> int:
+        """
+        Index of the price tier of amount, 0 below the first boundary of tiers.
+        """
+        return bisect.bisect_right(self.tiers, amount)
+
+    def set_rate_table(self, model_name: str, input_price: float, output_price: float):
+        self.price_tables[model_name] = {KEY_PRICE_INPUT: float(input_price), KEY_PRICE_OUTPUT: float(output_price)}
+
+    def _rates(self, model_name: Optional[str]) -> Tuple[float, float]:
+        model_name = model_name or self.default_model_name
+        rates = self.price_tables.get(model_name)
+        if rates is None:
+            raise ValueError(f"PricingEngine has no rate table for model {model_name}")
+        return rates[KEY_PRICE_INPUT], rates[KEY_PRICE_OUTPUT]
+
+    def quote_batch(self, input_tokens, output_tokens=None, model_name=None, apply_minimum: bool = True) -> np.ndarray:
+        """
+        Vectorized quotes.
+
+        :param input_tokens: Array like of input token counts.
+        :param output_tokens: Optional array like of output token counts, same shape as input_tokens.
+        :param model_name: One model name for all quotes, or an array like of model names, one per quote.
+        :param apply_minimum: Raise every quote to min_amount.
+        :return: Array of amounts.
+        """
+        input_tokens = np.asarray(input_tokens, dtype=np.float64)
+        output_tokens = np.zeros_like(input_tokens) if output_tokens is None else np.asarray(output_tokens, dtype=np.float64)
+
+        if model_name is None or isinstance(model_name, str):
+            input_price, output_price = self._rates(model_name)
+        else:
+            unique_names, inverse = np.unique(np.asarray(model_name), return_inverse=True)
+            rates = np.array([self._rates(name) for name in unique_names], dtype=np.float64).reshape(-1, 2)
+            inverse = inverse.reshape(input_tokens.shape)
+            input_price, output_price = rates[inverse, 0], rates[inverse, 1]
+
+        amounts = (input_tokens * input_price + output_tokens * output_price) / 1000.0
+        if apply_minimum:
+            amounts = np.maximum(amounts, self.min_amount)
+        return np.round(amounts, self.decimals)
+
+    def quote(self, input_tokens: int, output_tokens: int = 0, model_name: Optional[str] = None,
+              apply_minimum: bool = True) -> float:
+        """
+        Scalar quote, a one element quote_batch.
+        """
+        return float(self.quote_batch([input_tokens], [output_tokens], model_name=model_name,
+                                      apply_minimum=apply_minimum)[0])
 
 def render_template(filepath, **kwargs):
     """
@@ -173,88 +846,340 @@ def render_template(filepath, **kwargs):
 
 class PaymentAgent:
 
-    def __init__(self, config: AgentPaymentConfig):
+    def __init__(self, config: AgentPaymentConfig, order_store: Optional[OrderStore] = None):
+        """
+        :param config: AgentPaymentConfig
+        :param order_store: Optional OrderStore behind self.orders, defaults to a SQLiteOrderStore
+            if config.order_db_path is set and to an InMemoryOrderStore otherwise. The SQLiteOrderStore
+            notifies the other workers sharing the database of status changes over unix sockets.
+        """
         self.config = config
-        self.orders = {}
-        self.tokenizer = TiktokenAgent.from_model_name(config.model_name)
+        if order_store is None:
+            if config.order_db_path:
+                order_store = SQLiteOrderStore(config.order_db_path, notifier=self._create_order_notifier(config))
+            else:
+                order_store = InMemoryOrderStore()
+        self.orders = order_store
+        ## a paid or expired status set by a webhook of any worker releases the waiting stream
+        self.orders.add_listener(self._on_order_status)
+        TokenizerRegistry.configure(bpe_dir=config.tokenizer_bpe_dir)
+        self.pricing_engine = PricingEngine.from_config(config)
+        ## the async API runs tokenization and blocking provider calls here, off the event loop
+        self._quote_executor = ThreadPoolExecutor(max_workers=config.quote_max_workers, thread_name_prefix="payment_quote")
+        self._provider_executor = ThreadPoolExecutor(max_workers=config.provider_max_workers, thread_name_prefix="payment_provider")
+        ## pooled keep-alive session of every PayPal API call
+        self.http_client = ProviderHttpClient(pool_connections=config.http_pool_connections,
+                                              pool_maxsize=config.http_pool_maxsize,
+                                              connect_timeout=config.http_connect_timeout,
+                                              read_timeout=config.http_read_timeout)
+        ## async provider calls of acheckout, Stripe create_async and PayPal on an httpx pool
+        self.async_http_client = AsyncProviderHttpClient(pool_maxsize=config.http_pool_maxsize,
+                                                         connect_timeout=config.http_connect_timeout,
+                                                         read_timeout=config.http_read_timeout)
+        self.stripe_adapter = AsyncStripeAdapter(config, self.orders, executor=self._provider_executor)
+        self.paypal_adapter = AsyncPayPalAdapter(config, self.orders, self.async_http_client)
+        ## every provider payment goes through its circuit breaker, sync and async calls alike
+        retry_policy = RetryPolicy(max_attempts=config.provider_max_attempts, base_delay=config.provider_retry_base_delay,
+                                   max_delay=config.provider_retry_max_delay, hedge=config.provider_hedge)
+        self.providers = ProviderRegistry(window_size=config.circuit_window_size, min_calls=config.circuit_min_calls,
+                                          failure_rate=config.circuit_failure_rate,
+                                          reset_seconds=config.circuit_reset_seconds,
+                                          retry_policy=retry_policy, hedge_quantile=config.provider_hedge_quantile)
+        ## Stripe Checkout returns an empty link instead of raising
+        self.providers.register(PAYMENT_METHOD_STRIPE, self._stripe_create_payment, self.stripe_adapter.create_checkout_session,
+                                succeeded=lambda payment: bool(payment.get(KEY_PAYMENT_URL)), idempotent=True)
+        self.providers.register(PAYMENT_METHOD_CREDIT_CARD, self._stripe_credit_card_create_payment,
+                                self.stripe_adapter.create_payment_intent, idempotent=True)
+        self.providers.register(PAYMENT_METHOD_PAYPAL, self._paypal_create_payment, self.paypal_adapter.create_payment,
+                                idempotent=True)
+        ## links only, no provider call
+        self.providers.register(PAYMENT_METHOD_ALIPAY, self._alipay_create_payment)
+        self.providers.register(PAYMENT_METHOD_WECHAT, self._wechat_create_payment)
+        self.providers.register(PAYMENT_METHOD_AGENTA2Z, self._agenta2z_create_payment)
+        ## pending orders of lost webhooks are settled from the providers' side in bulk
+        self.reconciler = OrderReconciler(config, self.orders, self.async_http_client,
+                                          executor=self._provider_executor, retry_policy=retry_policy)
+        self.tokenizer = TiktokenAgent.from_model_name(config.model_name,
+                                                       num_threads=config.tokenizer_num_threads,
+                                                       cache_max_entries=config.token_cache_max_entries,
+                                                       cache_max_bytes=config.token_cache_max_bytes)
+        self.token_accumulator = ConversationTokenAccumulator(self.tokenizer,
+                                                              ttl_seconds=config.conversation_token_ttl_seconds,
+                                                              max_conversations=config.conversation_token_max_conversations)
         stripe.api_key = config.stripe_secret_key
+        if config.stripe_api_base:
+            stripe.api_base = config.stripe_api_base
+        ## retries go through self.providers, bounded by the checkout deadline
+        stripe.max_network_retries = 0
         if stripe.api_key is None or stripe.api_key == "":
             print(f"PaymentAgent stripe_api_key is missing and not set...")
         else:
             print(f"PaymentAgent stripe_api_key is set successfully...")
 
+    @staticmethod
+    def _create_order_notifier(config: AgentPaymentConfig) -> Optional[OrderNotifier]:
+        try:
+            return UnixSocketOrderNotifier(config.order_notify_dir or f"{config.order_db_path}.notify")
+        except Exception as e:
+            logging.error(f"PaymentAgent order notifier is disabled, only this worker sees its status changes, error {e}")
+            return None
+
     def calculate_payment(self, messages, **kwargs) -> dict:
         """
         Calculate the payment amount needed from the messages.
 
         :param messages: A list of message dictionaries (e.g., [{"role": "user", "content": "..."}]).
+        :param conversation_id: Optional kwarg. If set, messages already counted for this conversation
+            are not counted again, only the new messages appended since the previous call.
+        :param token_count_mode: Optional kwarg overriding config.token_count_mode, "exact" or "estimate".
+            In "estimate" mode the heuristic count is used only while its error bound stays within
+            one price tier of pricing_engine.tiers and its upper bound below the Stripe minimum
+            amount, otherwise the messages are counted exactly.
+        :param model_name: Optional kwarg, model whose rate table in pricing_engine prices the tokens.
         :return: A dictionary containing the calculated amount, currency, and token count.
         """
         output = {}
+        conversation_id = kwargs.get("conversation_id")
+        token_count_mode = kwargs.get("token_count_mode", self.config.token_count_mode)
+        model_name = kwargs.get("model_name")
 
         # 1. Estimate Total Tokens
-        estimated_tokens = 0
-        # Iterate through all messages (assuming message is a dict with a 'content' key)
-        for message in messages:
-            content = message.get("content", "")
-            if content:
-                estimated_tokens += self.tokenizer.count_tokens(content)
-        price_per_thousand_token = self.config.price_per_thousand_token
-        thousands_of_tokens = estimated_tokens / 1000.0
-        amount = thousands_of_tokens * price_per_thousand_token
-
-        amount = amount if amount >= MIN_PAYMENT_AMOUNT_STRIPE_CENTS/100.0 else MIN_PAYMENT_AMOUNT_STRIPE_CENTS/100.0
+        # Collect the contents of all messages (assuming message is a dict with a 'content' key)
+        # and count them in one batched call
+        contents = [message.get("content", "") for message in messages]
+        contents = [content for content in contents if content]
+        error_bound = 0
+        if token_count_mode == TOKEN_COUNT_MODE_ESTIMATE:
+            estimated_tokens, error_bound = self.tokenizer.estimate_tokens_batch(contents)
+            lower_amount = self.pricing_engine.quote(max(0, estimated_tokens - error_bound), model_name=model_name, apply_minimum=False)
+            upper_amount = self.pricing_engine.quote(estimated_tokens + error_bound, model_name=model_name, apply_minimum=False)
+            if upper_amount >= self.pricing_engine.min_amount or \
+                    self.pricing_engine.tier(lower_amount) != self.pricing_engine.tier(upper_amount):
+                ## the estimate could change the amount or the tier, fall back to the exact count
+                token_count_mode = TOKEN_COUNT_MODE_EXACT
+        if token_count_mode != TOKEN_COUNT_MODE_ESTIMATE:
+            token_count_mode = TOKEN_COUNT_MODE_EXACT
+            error_bound = 0
+            if conversation_id:
+                estimated_tokens = self.token_accumulator.count(conversation_id, contents)
+            else:
+                estimated_tokens = sum(self.tokenizer.count_tokens_batch(contents))
+        amount = self.pricing_engine.quote(estimated_tokens, model_name=model_name)
 
         # Final Output Structure
-        output[AMOUNT] = round(amount, 4)
+        output[AMOUNT] = amount
         output[CURRENCY] = CURRENCY_USD
         output[ESTIMATED_TOKENS] = estimated_tokens
+        output[ESTIMATED_TOKENS_ERROR_BOUND] = error_bound
+        output[TOKEN_COUNT_MODE] = token_count_mode
+        output[PRICE_TIER] = self.pricing_engine.tier(amount)
         return output
 
-    def create_order(self, amount: int, currency: str = CURRENCY_USD, description: str = "") -> Dict:
+    async def acalculate_payment(self, messages, **kwargs) -> dict:
+        """
+        Async calculate_payment. Tokenization is CPU bound, so it runs in the bounded quote executor
+        and a large quote does not stall the other streams served by the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._quote_executor, functools.partial(self.calculate_payment, messages, **kwargs))
+
+    def create_stream_meter(self, thresholds: Optional[List[float]] = None, **kwargs) -> StreamingTokenMeter:
+        """
+        Creates a StreamingTokenMeter priced with config.price_per_thousand_token, to meter LLM output while it streams.
+
+        :param thresholds: Amounts that emit a threshold_crossed event, e.g. [MIN_PAYMENT_AMOUNT_STRIPE_CENTS/100.0]
+        """
+        return StreamingTokenMeter(self.tokenizer, self.config.price_per_thousand_token, thresholds=thresholds, **kwargs)
+
+    def create_order(self, amount: float, currency: str = CURRENCY_USD, description: str = "") -> Order:
         """
             Creates a generic internal order record.
-            amount: in smallest unit (e.g., cents)
+            amount: in major units (e.g., 4.25 USD), the Order keeps it as integer minor units (425 cents)
         """
-        order_id = f"order_{uuid.uuid4().hex[:16]}"
+        ## k-sortable id, consecutive orders land next to each other in the order_id index
+        order_id = f"order_{new_ulid()}"
         cur_timestamp = int(time.time())
-        self.orders[order_id] = {
-            ORDER_ID: order_id,
-            AMOUNT: amount,
-            CURRENCY: currency,
-            DESCRIPTION: description,
-            STATUS: STATUS_PENDING,
-            CREATED: cur_timestamp,
-            EVENT: None
-        }
-        return self.orders[order_id]
+        return self.orders.add(Order(
+            order_id,
+            amount_minor=to_minor_units(amount, currency),
+            currency=currency,
+            description=description,
+            status=OrderStatus.PENDING,
+            created=cur_timestamp,
+            expires=cur_timestamp + ORDER_EXPIRE_SECONDS_DEFAULT,
+            event=None
+        ))
+
+    async def acreate_order(self, amount: float, currency: str = CURRENCY_USD, description: str = "") -> Order:
+        """
+        Async create_order. The order gets an asyncio.Event of the running loop, which is set once the
+        order is paid, so workflows can await the payment in payment_stream_generator.
+        """
+        order = self.create_order(amount, currency, description)
+        order.event = asyncio.Event()
+        return order
+
+    def sweep_orders(self) -> List[Dict]:
+        """
+        Expires the pending orders past their EXPIRES and drops stale orders from memory. The
+        expiries are transitions, the order listener sets their events, so the waiting streams stop waiting.
+
+        :return: The orders expired by this sweep.
+        """
+        return self.orders.sweep()
+
+    async def run_order_sweeper(self, interval_seconds: int = ORDER_SWEEP_INTERVAL_SECONDS):
+        """
+        Background task sweeping expired orders every interval_seconds, e.g.
+        asyncio.create_task(payment_agent.run_order_sweeper()) at server startup.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(interval_seconds)
+            try:
+                expired = await loop.run_in_executor(self._quote_executor, self.orders.sweep)
+                logging.debug(f"run_order_sweeper expired {len(expired)} orders, metrics {self.order_metrics()}")
+            except Exception as e:
+                logging.error(f"run_order_sweeper failed with error {e}")
+
+    async def areconcile_orders(self, min_age_seconds: int = RECONCILE_MIN_AGE_SECONDS_DEFAULT,
+                                limit: Optional[int] = None) -> Dict:
+        """
+        Checks the pending and approved orders older than min_age_seconds against Stripe and PayPal
+        and marks the paid ones paid, which releases their waiting streams, see OrderReconciler.
+
+        :param limit: Most orders checked per status, the oldest first.
+        :return: Report of the run: orders, checked, paid, errors, api_calls, api_calls_per_order,
+            seconds, orders_per_second.
+        """
+        return await self.reconciler.reconcile(min_age_seconds=min_age_seconds, limit=limit)
+
+    async def run_order_reconciler(self, interval_seconds: int = RECONCILE_INTERVAL_SECONDS,
+                                   min_age_seconds: int = RECONCILE_MIN_AGE_SECONDS_DEFAULT):
+        """
+        Background task reconciling the pending orders every interval_seconds, e.g.
+        asyncio.create_task(payment_agent.run_order_reconciler()) at server startup. Keep
+        interval_seconds plus min_age_seconds below the order expiry, so a paid order is settled
+        before its stream gives up.
+        """
+        while True:
+            await asyncio.sleep(interval_seconds)
+            try:
+                report = await self.reconciler.reconcile(min_age_seconds=min_age_seconds)
+                logging.log(logging.INFO if report["paid"] > 0 else logging.DEBUG,
+                            f"run_order_reconciler settled {report['paid']} of {report['checked']} orders, "
+                            f"api calls {report['api_calls']} in {report['seconds']:.2f}s")
+            except Exception as e:
+                logging.error(f"run_order_reconciler failed with error {e}")
+
+    def reconcile_metrics(self) -> Dict:
+        """
+        Totals of the reconciliation runs: orders checked and paid, Stripe and PayPal calls, seconds.
+        """
+        return self.reconciler.stats()
+
+    def http_metrics(self) -> Dict:
+        """
+        Connection pool metrics of the provider HTTP client: in use, new connections and an estimate of the reused ones,
+        the async client under "async".
+        """
+        return {**self.http_client.stats(), "async": self.async_http_client.stats()}
+
+    def provider_metrics(self) -> Dict:
+        """
+        Circuit breaker of each payment method: state (closed, half_open, open), error rate and
+        p50/p95 latency of its latest calls, calls, failures, calls rejected while open.
+        """
+        return self.providers.stats()
+
+    def order_metrics(self) -> Dict:
+        """
+        Gauges of the order store: live orders in memory, orders expired and swept so far.
+        """
+        return self.orders.stats()
+
+    @classmethod
+    def _on_order_status(cls, order: Order):
+        ## approved or captured orders keep the stream waiting for the payment
+        if order.status in ORDER_RELEASE_STATUSES:
+            cls._set_order_event(order)
+
+    @staticmethod
+    def _set_order_event(order: Dict):
+        event = order.get(EVENT)
+        if event is None:
+            return
+        try:
+            ## asyncio.Event is not thread safe, set it on the loop it was created on
+            loop = getattr(event, "_loop", None)
+            if loop is not None and loop.is_running():
+                loop.call_soon_threadsafe(event.set)
+            else:
+                event.set()
+        except Exception as e:
+            logging.error(f"_set_order_event order {order.get(ORDER_ID)} failed with error {e}")
+
+    def find_order_by_reference(self, provider_ref: str):
+        """
+        Order of a provider object id indexed when the payment was created: PayPal order id,
+        Stripe PaymentIntent id or Checkout Session id. None if the id is unknown.
+        """
+        order_id = self.orders.find_order_id(provider_ref)
+        return self.orders.get(order_id) if order_id else None
 
     def create_payment(self, order_id: str, method: str):
         """
+            The provider payment of an order and method is created once, a repeated call (reload,
+            retried checkout) returns the saved one without calling the provider.
+
             Return:
                 Payment Related URLs, such as return_url, web_hook
         """
-        order = self.orders.get(order_id, {})
-        if len(order) == 0:
+        payment = self.orders.get_payment(order_id, method)
+        if payment is not None:
+            return payment
+        return self._save_payment(order_id, method, self._create_payment(order_id, method))
+
+    def _create_payment(self, order_id: str, method: str, deadline: Optional[float] = None):
+        """
+        :param deadline: Seconds the checkout waits for the payment, a slower call counts against the circuit.
+        :raise CircuitOpenError: If the circuit of the provider is open.
+        """
+        order = self.orders.get(order_id)
+        if not order:
             print (f"ERROR：create_payment order_id {order_id} status is not found...")
             return {}
         amount = order.get(AMOUNT, 0)
         currency = order.get(CURRENCY, CURRENCY_USD)
+        return self.providers.create(method, order_id, amount, currency, deadline=deadline)
 
-        if method == PAYMENT_METHOD_STRIPE:
-            return self._stripe_create_payment(order_id, amount, currency)
-        elif method == PAYMENT_METHOD_CREDIT_CARD:
-            return self._stripe_credit_card_create_payment(order_id, amount, currency)
-        elif method == PAYMENT_METHOD_PAYPAL:
-            return self._paypal_create_payment(order_id, amount, currency)
-        elif method == PAYMENT_METHOD_ALIPAY:
-            return self._alipay_create_payment(order_id, amount, currency)
-        elif method == PAYMENT_METHOD_WECHAT:
-            return self._wechat_create_payment(order_id, amount, currency)
-        elif method == PAYMENT_METHOD_AGENTA2Z:
-            return self._agenta2z_create_payment(order_id, amount, currency)
-        else:
-            raise ValueError(f"Unknown payment method {method}")
+    async def acreate_payment(self, order_id: str, method: str):
+        """
+        Async create_payment, same results. Stripe and PayPal go through the async adapters.
+        """
+        payment = await self.orders.aget_payment(order_id, method, executor=self._provider_executor)
+        if payment is not None:
+            return payment
+        return self._save_payment(order_id, method, await self._acreate_payment(order_id, method))
+
+    async def _acreate_payment(self, order_id: str, method: str, deadline: Optional[float] = None):
+        order = await self.orders.aget(order_id, executor=self._provider_executor)
+        if not order:
+            print (f"ERROR：acreate_payment order_id {order_id} status is not found...")
+            return {}
+        amount = order.get(AMOUNT, 0)
+        currency = order.get(CURRENCY, CURRENCY_USD)
+        return await self.providers.acreate(method, order_id, amount, currency, deadline=deadline)
+
+    def _save_payment(self, order_id: str, method: str, payment: Dict) -> Dict:
+        ## only a payment created at the provider is reused, failures and static links are not saved
+        if method in (PAYMENT_METHOD_CREDIT_CARD, PAYMENT_METHOD_STRIPE, PAYMENT_METHOD_PAYPAL):
+            created = payment.get(KEY_STRIPE_CLIENT_SECRET) if method == PAYMENT_METHOD_CREDIT_CARD \
+                else payment.get(KEY_PAYPAL_ORDER_ID) if method == PAYMENT_METHOD_PAYPAL \
+                else payment.get(KEY_PAYMENT_URL)
+            if created:
+                self.orders.save_payment(order_id, method, payment)
+        return payment
 
     # -----------------------------
     # Stripe Checkout (Stripe)
@@ -264,23 +1189,10 @@ class PaymentAgent:
             stripe amount should be integer value of unit cents
         """
         try:
-            amount_cents = math.ceil(amount * 100.0)
+            amount_cents = stripe_amount_cents(amount)
             logging.info(f"_stripe_create_payment input amount {amount} {currency} converting to cents {amount_cents} cents {currency} for {order_id}")
-            session = stripe.checkout.Session.create(
-                payment_method_types=["card"],
-                mode="payment",
-                line_items=[{
-                    "price_data": {
-                        "currency": currency.lower(),
-                        "unit_amount": amount_cents,
-                        "product_data": {"name": f"Order {order_id}"}
-                    },
-                    "quantity": 1
-                }],
-                success_url=f"{SUCCESS_URL}{order_id}",
-                cancel_url=f"{CANCEL_URL}{order_id}",
-            )
-            return {KEY_PAYMENT_URL: session.url}
+            session = stripe.checkout.Session.create(**stripe_checkout_session_params(order_id, amount_cents, currency))
+            return stripe_checkout_session_result(self.orders, order_id, session)
 
         except Exception as e:
             logging.error(f"_stripe_create_payment failed with error {e}")
@@ -298,92 +1210,43 @@ class PaymentAgent:
             Stripe Publishable Key (pk_live_xxx / pk_test_xxx)
             PaymentIntent Client Secret (pi_xxx_secret_xxx)
         """
-        amount_cents = math.ceil(amount * 100.0)
-        if amount_cents < MIN_PAYMENT_AMOUNT_STRIPE_CENTS:
-            return {
-                KEY_SUCCESS: False,
-                KEY_STRIPE_PUBLISHABLE_KEY: "",
-                KEY_STRIPE_CLIENT_SECRET: "",
-                KEY_PAYMENT_METHOD: PAYMENT_METHOD_CREDIT_CARD,
-                KEY_MESSAGE: f"Checkout Stripe Input Amount {amount_cents} cents is too small for Stripe, Minimum should be more than 400 cents"
-            }
+        amount_cents = stripe_amount_cents(amount)
+        too_small = stripe_amount_too_small_result(amount_cents)
+        if too_small is not None:
+            return too_small
 
         logging.info(
             f"_stripe_credit_card_create_payment input amount {amount} {currency} converting to cents {amount_cents} cents {currency} for {order_id}")
-        intent = stripe.PaymentIntent.create(
-            amount=amount_cents,
-            currency=currency.lower(),
-            metadata={ORDER_ID: order_id},
-        )
-
-        return {
-            KEY_SUCCESS: True,
-            KEY_STRIPE_PUBLISHABLE_KEY: self.config.stripe_publishable_key,
-            KEY_STRIPE_CLIENT_SECRET: intent.client_secret,
-            KEY_PAYMENT_METHOD: PAYMENT_METHOD_CREDIT_CARD,
-            KEY_MESSAGE: "Checkout Stripe Successfully!"
-        }
+        intent = stripe.PaymentIntent.create(**stripe_payment_intent_params(order_id, amount_cents, currency))
+        return stripe_payment_intent_result(self.config, self.orders, order_id, intent)
 
     # -----------------------------
     # PayPal Integration
     # -----------------------------
     def _paypal_create_payment(self, order_id, amount, currency):
         """
-
+            :raise ProviderError: If the PayPal order was not created, retryable if the failure is transient.
         """
         token = _get_paypal_access_token(
             self.config.paypal_client_id,
             self.config.paypal_secret,
-            self.config.environment.value
+            self.config.environment.value,
+            http_client=self.http_client,
+            base_url=self.config.paypal_base_url
         )
         if not token:
-            raise Exception("_paypal_create_payment Could not retrieve PayPal access token.")
+            raise ProviderError("_paypal_create_payment Could not retrieve PayPal access token.", retryable=True)
         try:
-            ## Token Registered
-            base_url = "https://api-m.sandbox.paypal.com" if self.config.environment == Environment.SANDBOX else "https://api-m.paypal.com"
-            order_url = f"{base_url}/v2/checkout/orders"
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {token}",
-                "PayPal-Request-Id": order_id  # Ensure idempotency
-            }
-            order_payload = {
-                "intent": "CAPTURE",
-                "purchase_units": [{
-                    "reference_id": order_id,
-                    "amount": {
-                        "currency_code": currency,
-                        "value": f"{amount:.2f}"
-                    },
-                    "description": f"Payment for Order {order_id}"
-                }],
-                "application_context": {
-                    "return_url": f"{RETURN_URL}{order_id}",
-                    "cancel_url": f"{CANCEL_URL}{order_id}",
-                    "brand_name": PAYPAL_BRAND_NAME,
-                    "shipping_preference": "NO_SHIPPING"
-                }
-            }
-
-            response = requests.post(order_url, headers=headers, json=order_payload)
+            ## Token Registered, cached, paypal_request refreshes it once on a 401
+            order_url, headers, order_payload = paypal_order_request(self.config, order_id, amount, currency)
+            response = paypal_request("POST", order_url, self.config.paypal_client_id, self.config.paypal_secret,
+                                      self.config.environment.value, http_client=self.http_client,
+                                      base_url=self.config.paypal_base_url, headers=headers, json=order_payload)
             response.raise_for_status()
-            order_data = response.json()
-
-            # 5. Extract Approval Link
-            approval_link = next(
-                (link['href'] for link in order_data.get('links', []) if link['rel'] == 'approve'),
-                None
-            )
-
-            if approval_link:
-                return {KEY_PAYMENT_URL: approval_link, KEY_PAYPAL_ORDER_ID: order_data["id"]}
-            else:
-                raise Exception("PayPal order created but no approval link found.")
+            return paypal_order_result(self.orders, order_id, response.json())
 
         except Exception as e:
-
-            print(f"DEBUG: Paypal Checkout Failed with error {e}")
-            return {KEY_PAYMENT_URL: f"https://paypal.com/checkout?token={order_id}"}
+            raise paypal_order_error(order_id, e) from e
 
     # -----------------------------
     # Alipay Integration
@@ -404,9 +1267,21 @@ class PaymentAgent:
     # 3. Notify callback
     # -----------------------------
     def notify_payment(self, order_id: str, status: str):
-        self.orders[order_id]["status"] = status
-
-        if status == "success":
+        """
+        Payment callback, applied as a transition of the order state machine: "success" marks the
+        order paid, "failed"/"cancelled" expire it (see NOTIFY_STATUS_DICT), an order status
+        (e.g. "refunded") is taken as is. Returns None if the order does not take the status,
+        e.g. a duplicate callback or an unknown order, an unknown status is logged and ignored.
+        """
+        to_status = OrderStatus.parse(NOTIFY_STATUS_DICT.get(status, status))
+        if not isinstance(to_status, OrderStatus):
+            logging.error(f"notify_payment unknown status {status} of order {order_id}, expected one of {list(NOTIFY_STATUS_DICT)} or an order status")
+            return None
+        if not self.orders.transition(order_id, to_status):
+            logging.info(f"notify_payment order {order_id} does not take status {status}, duplicate or out of order callback")
+            return None
+
+        if to_status == OrderStatus.PAID:
             return self.post_process_payment(order_id)
 
     def post_process_payment(self, order_id: str):
@@ -424,141 +1299,355 @@ class PaymentAgent:
         final_message = f"Order {order_id} is paid. The Agent Loop continue and results will be rendered"
         return final_message
 
-    def checkout(self, payment_method: str = PAYMENT_METHOD_ALL, order_id: str = "", amount: float = 0.0, currency: str = CURRENCY_USD):
+    def checkout(self, payment_method: str = PAYMENT_METHOD_ALL, order_id: str = "", amount: float = 0.0, currency: str = CURRENCY_USD,
+                 checkout_mode: Optional[str] = None):
         """
             The checkout is the main function to create payment by the method user chose, and return valid html, js snippet
             to render on chat/ai output, Create Order should be called before checkout
 
+            With payment_method "all" the provider setups run concurrently, a provider not done by
+            its deadline (config.checkout_provider_deadlines) or failed is left out of the card.
+
+            checkout_mode "lazy" (default config.checkout_mode) renders the card without provider calls,
+            the card creates the payment of the method the user selects, see select_payment_method.
+
             Return:
-                Dict, key: checkout_html, checkout_js
+                Dict, key: checkout_html, checkout_js, provider_timings (status and ms per method)
         """
         ## load .env variables inspection
         from dotenv import load_dotenv
         load_dotenv()
 
+        if (checkout_mode or self.config.checkout_mode) == CHECKOUT_MODE_LAZY:
+            return self._lazy_checkout(payment_method, order_id, amount, currency)
+        self._set_checkout_expiry(order_id, payment_method)
+        ## the provider setups run concurrently, each one until its deadline
+        start = time.perf_counter()
+        futures = {method: self._provider_executor.submit(self._timed_create_payment, order_id, method)
+                   for method in self._checkout_methods(payment_method)}
+        outcomes = {}
+        for method, future in futures.items():
+            remaining = start + self._provider_deadline(method) - time.perf_counter()
+            try:
+                outcomes[method] = future.result(timeout=max(0.0, remaining))
+            except concurrent.futures.TimeoutError:
+                ## the call finishes in the background, its result is not waited for
+                logging.warning(f"Payment Method {payment_method}|{method} missed the checkout deadline {self._provider_deadline(method)}s")
+                outcomes[method] = (None, self._provider_timing(PROVIDER_STATUS_TIMEOUT, start))
+        return self._finish_checkout(payment_method, order_id, amount, currency, outcomes)
+
+    async def acheckout(self, payment_method: str = PAYMENT_METHOD_ALL, order_id: str = "", amount: float = 0.0, currency: str = CURRENCY_USD,
+                        checkout_mode: Optional[str] = None):
+        """
+        Async checkout. The provider calls go through the async adapters (Stripe create_async,
+        PayPal on the async HTTP client), the event loop is never blocked. A provider not done
+        by its deadline is cancelled. checkout_mode "lazy" renders the card without provider calls.
+
+        Return:
+            Dict, key: checkout_html, checkout_js, provider_timings (status and ms per method)
+        """
+        if (checkout_mode or self.config.checkout_mode) == CHECKOUT_MODE_LAZY:
+            return self._lazy_checkout(payment_method, order_id, amount, currency)
+        self._set_checkout_expiry(order_id, payment_method)
+        ## the provider setups run concurrently, each one until its deadline
+        methods = self._checkout_methods(payment_method)
+        results = await asyncio.gather(*[self._atimed_create_payment(order_id, method) for method in methods])
+        return self._finish_checkout(payment_method, order_id, amount, currency, dict(zip(methods, results)))
+
+    def select_payment_method(self, order_id: str, method: str) -> Dict:
+        """
+        Creates the provider payment of the method the user selected on a lazy checkout card.
+
+        :param method: "credit_card" or "paypal".
+        :return: create_payment result, e.g. client_secret of the credit card or payment_url of PayPal,
+            plus provider_timings. {"success": False, "message": ...} if the order cannot be paid by it.
+        """
+        message = self._prepare_select(order_id, method)
+        if message:
+            return {KEY_SUCCESS: False, KEY_MESSAGE: message}
+        return self._finish_select(method, *self._timed_create_payment(order_id, method))
+
+    async def aselect_payment_method(self, order_id: str, method: str) -> Dict:
+        """
+        Async select_payment_method, the backend of the lazy card endpoint. The provider call
+        is bounded by the checkout deadline of the method.
+        """
+        message = self._prepare_select(order_id, method)
+        if message:
+            return {KEY_SUCCESS: False, KEY_MESSAGE: message}
+        return self._finish_select(method, *(await self._atimed_create_payment(order_id, method)))
+
+    def _lazy_checkout(self, payment_method: str, order_id: str, amount: float, currency: str) -> Dict:
+        ## no provider payment yet, the card stays open until the user selects a method
+        self._set_checkout_expiry(order_id, payment_method, expire_seconds=ORDER_EXPIRE_SECONDS_LAZY)
+        payments = {}
+        for method in self._checkout_methods(payment_method):
+            if not self.providers.available(method):
+                ## an open circuit is not offered, its select would fail fast
+                continue
+            if method == PAYMENT_METHOD_CREDIT_CARD:
+                payments[method] = {KEY_SUCCESS: True, KEY_STRIPE_PUBLISHABLE_KEY: self.config.stripe_publishable_key,
+                                    KEY_STRIPE_CLIENT_SECRET: ""}
+            else:
+                payments[method] = {KEY_PAYMENT_URL: "#"}
+        try:
+            result = self._render_checkout(payment_method, amount, currency, payments, order_id=order_id,
+                                           checkout_mode=CHECKOUT_MODE_LAZY)
+        except Exception as e:
+            logging.error(f"Checkout Failed with error {e}")
+            result = {KEY_CHECKOUT_HTML: "", KEY_CHECKOUT_JS: ""}
+        result[KEY_PROVIDER_TIMINGS] = {}
+        return result
+
+    def _prepare_select(self, order_id: str, method: str) -> str:
+        """
+        Checks the order can be paid by method and restarts its expiry for the method.
+
+        :return: Why the order cannot be paid by method, "" if it can.
+        """
+        if method not in CHECKOUT_SELECT_METHODS:
+            return f"Payment method {method} is not supported, expected one of {CHECKOUT_SELECT_METHODS}"
+        order = self.orders.get(order_id)
+        if not order:
+            return f"Order {order_id} is not found"
+        if order.get(STATUS) not in (STATUS_PENDING, STATUS_APPROVED):
+            return f"Order {order_id} is {order.get(STATUS)}"
+        ## the awaiting payment timeout of the method starts at the selection
+        expires = int(time.time()) + ORDER_EXPIRE_SECONDS_DICT.get(method, ORDER_EXPIRE_SECONDS_DEFAULT)
+        if expires > order.get(EXPIRES, 0):
+            self.orders.update(order_id, expires=expires)
+        return ""
+
+    @staticmethod
+    def _finish_select(method: str, payment: Optional[Dict], timing: Dict) -> Dict:
+        if payment is None:
+            return {KEY_SUCCESS: False, KEY_MESSAGE: f"Payment method {method} {timing[STATUS]}",
+                    KEY_PROVIDER_TIMINGS: {method: timing}}
+        result = {KEY_SUCCESS: True, **payment}
+        result[KEY_PROVIDER_TIMINGS] = {method: timing}
+        return result
+
+    @staticmethod
+    def _checkout_methods(payment_method: str) -> List[str]:
+        """
+        Provider payments a checkout creates, "all" offers the credit card form and PayPal.
+        """
+        if payment_method == PAYMENT_METHOD_ALL:
+            return [PAYMENT_METHOD_CREDIT_CARD, PAYMENT_METHOD_PAYPAL]
+        if payment_method in (PAYMENT_METHOD_PAYPAL, PAYMENT_METHOD_CREDIT_CARD):
+            return [payment_method]
+        return []
+
+    def _provider_deadline(self, method: str) -> float:
+        deadline = self.config.checkout_provider_deadlines.get(method, CHECKOUT_PROVIDER_DEADLINE_SECONDS_DEFAULT)
+        if self.config.checkout_deadline_seconds is not None:
+            ## the provider setups run concurrently, none outlives the checkout
+            deadline = min(deadline, self.config.checkout_deadline_seconds)
+        return deadline
+
+    @staticmethod
+    def _provider_timing(status: str, start: float, error: Optional[Exception] = None) -> Dict:
+        timing = {STATUS: status, KEY_ELAPSED_MS: round((time.perf_counter() - start) * 1000, 1)}
+        if error is not None:
+            timing[KEY_ERROR] = str(error)
+        return timing
+
+    def _timed_create_payment(self, order_id: str, method: str) -> Tuple[Optional[Dict], Dict]:
+        """
+        create_payment of the checkout fan-out, a failure is returned as its timing instead of raised.
+
+        :return: (payment, timing), payment is None if the provider failed.
+        """
+        start = time.perf_counter()
+        payment = self.orders.get_payment(order_id, method)
+        if payment is not None:
+            return payment, self._provider_timing(PROVIDER_STATUS_CACHED, start)
+        try:
+            payment = self._create_payment(order_id, method, deadline=self._provider_deadline(method))
+            return self._save_payment(order_id, method, payment), self._provider_timing(PROVIDER_STATUS_OK, start)
+        except CircuitOpenError as e:
+            return None, self._provider_timing(PROVIDER_STATUS_CIRCUIT_OPEN, start, e)
+        except Exception as e:
+            logging.error(f"Payment Method {method} failed with error {e}")
+            return None, self._provider_timing(PROVIDER_STATUS_FAILED, start, e)
+
+    async def _atimed_create_payment(self, order_id: str, method: str) -> Tuple[Optional[Dict], Dict]:
+        start = time.perf_counter()
+        payment = await self.orders.aget_payment(order_id, method, executor=self._provider_executor)
+        if payment is not None:
+            return payment, self._provider_timing(PROVIDER_STATUS_CACHED, start)
+        try:
+            deadline = self._provider_deadline(method)
+            payment = await asyncio.wait_for(self._acreate_payment(order_id, method, deadline=deadline), timeout=deadline)
+            return self._save_payment(order_id, method, payment), self._provider_timing(PROVIDER_STATUS_OK, start)
+        except CircuitOpenError as e:
+            return None, self._provider_timing(PROVIDER_STATUS_CIRCUIT_OPEN, start, e)
+        except asyncio.TimeoutError:
+            logging.warning(f"Payment Method {method} missed the checkout deadline {self._provider_deadline(method)}s")
+            return None, self._provider_timing(PROVIDER_STATUS_TIMEOUT, start)
+        except Exception as e:
+            logging.error(f"Payment Method {method} failed with error {e}")
+            return None, self._provider_timing(PROVIDER_STATUS_FAILED, start, e)
+
+    def _finish_checkout(self, payment_method: str, order_id: str, amount: float, currency: str,
+                         outcomes: Dict[str, Tuple[Optional[Dict], Dict]]) -> Dict:
+        """
+        Renders the checkout of the fan-out outcomes and adds the per provider timings.
+
+        :param outcomes: (payment, timing) per payment method.
+        """
+        timings = {method: timing for method, (payment, timing) in outcomes.items()}
+        payments = {method: payment for method, (payment, timing) in outcomes.items() if payment is not None}
+        failed = [timing for timing in timings.values() if timing[STATUS] in (PROVIDER_STATUS_FAILED, PROVIDER_STATUS_CIRCUIT_OPEN)]
+        result = {KEY_CHECKOUT_HTML: "", KEY_CHECKOUT_JS: ""}
+        if failed and payment_method != PAYMENT_METHOD_ALL:
+            logging.error(f"Checkout Failed with error {failed[0].get(KEY_ERROR)}")
+        try:
+            ## a failed provider is missing from payments and renders the error card of its method, as a timeout does
+            result = self._render_checkout(payment_method, amount, currency, payments, order_id=order_id)
+        except Exception as e:
+            logging.error(f"Checkout Failed with error {e}")
+        result[KEY_PROVIDER_TIMINGS] = timings
+        return result
+
+    def _default_card_option(self, payments: Dict[str, Dict]) -> str:
+        """
+        Card option selected when the "all" card opens, the offered provider with the healthiest circuit.
+        """
+        offered = [method for method in CHECKOUT_CARD_OPTIONS
+                   if payments.get(method, {}).get(KEY_STRIPE_PUBLISHABLE_KEY) or payments.get(method, {}).get(KEY_PAYMENT_URL)]
+        healthiest = self.providers.ordered(offered)
+        return CHECKOUT_CARD_OPTIONS[healthiest[0]] if healthiest else CHECKOUT_CARD_OPTION_DEFAULT
+
+    def _set_checkout_expiry(self, order_id: str, payment_method: str, expire_seconds: Optional[int] = None):
+        ## the order expires after the awaiting payment timeout of the chosen method
+        order = self.orders.get(order_id) if order_id else None
+        if order and order.get(STATUS) == STATUS_PENDING:
+            if expire_seconds is None:
+                expire_seconds = ORDER_EXPIRE_SECONDS_DICT.get(payment_method, ORDER_EXPIRE_SECONDS_DEFAULT)
+            self.orders.update(order_id, expires=order.get(CREATED, int(time.time())) + expire_seconds)
+
+    def _render_checkout(self, payment_method: str, amount: float, currency: str, payments: Dict[str, Dict],
+                         order_id: str = "", checkout_mode: str = CHECKOUT_MODE_EAGER) -> Dict:
+        """
+        Renders the checkout html and js of the provider payments created by checkout or acheckout.
+
+        :param payments: create_payment result per payment method, a failed method of "all" is missing.
+        :param checkout_mode: "lazy" cards post the selected method to config.checkout_select_url.
+        """
         checkout_html = ""
         checkout_js = ""
-        try:
-            if payment_method == PAYMENT_METHOD_PAYPAL:
-                ## 1. Paypal Payment
-                payment = self.create_payment(order_id, method = payment_method)
-                success = payment.get(KEY_SUCCESS, False)
-                payment_url = payment.get(KEY_PAYMENT_URL, "")
-                print(f"INFO: Paypal Checkout URL Successfully: {payment_url}")
-
-                ## credit card on stripe
-                if payment_url:
-                    html_data_pass = {
-                        KEY_TITLE: CHECKOUT_CARD_TITLE,
-                        KEY_DESCRIPTION: CHECKOUT_CARD_DESCRIPTION,
-                        KEY_AMOUNT: amount,
-                        KEY_CURRENCY: currency,
-                        KEY_PAYPAL_URL: payment_url,
-                        KEY_A2Z_URL: AGENT_A2Z_PAY_URL
-                    }
-                    # Render a custom HTML template for PayPal (using the same render_checkout_html for simplicity)
-                    checkout_html = self.render_checkout_html(**html_data_pass)  # Use a new render function
-                    script_data_pass = {
-                        KEY_STRIPE_PUBLISHABLE_KEY: "",
-                        KEY_STRIPE_CLIENT_SECRET: ""
-                    }
-                    checkout_js = self.render_checkout_script(**script_data_pass)
-                else:
-                    checkout_html = PAYPAL_CHECKOUT_ERROR_HTML
-                    checkout_js = ""
-
-            elif payment_method == PAYMENT_METHOD_CREDIT_CARD:
-
-                ## 1. Credit Card
-                payment = self.create_payment(order_id, method = payment_method)
-                success = payment.get(KEY_SUCCESS, False)
-                payment_url = payment.get(KEY_PAYMENT_URL, "")
-                publishable_key = payment.get(KEY_STRIPE_PUBLISHABLE_KEY, "")
-                client_secret = payment.get(KEY_STRIPE_CLIENT_SECRET, "")
-                if success:
-                    print(f"INFO: Credit Card Stripe Checkout Successfully URL: {payment_url}")
-                else:
-                    print(f"ERROR: Credit Card Stripe Checkout Failed with empty result return: {payment}")
+        lazy_script_data = {
+            KEY_CHECKOUT_MODE: checkout_mode,
+            ORDER_ID: order_id,
+            KEY_CHECKOUT_SELECT_URL_JS: self.config.checkout_select_url
+        }
+        if payment_method == PAYMENT_METHOD_PAYPAL:
+            ## 1. Paypal Payment
+            payment = payments.get(PAYMENT_METHOD_PAYPAL, {})
+            payment_url = payment.get(KEY_PAYMENT_URL, "")
+            print(f"INFO: Paypal Checkout URL Successfully: {payment_url}")
+
+            ## credit card on stripe
+            if payment_url:
                 html_data_pass = {
                     KEY_TITLE: CHECKOUT_CARD_TITLE,
                     KEY_DESCRIPTION: CHECKOUT_CARD_DESCRIPTION,
                     KEY_AMOUNT: amount,
                     KEY_CURRENCY: currency,
+                    KEY_PAYPAL_URL: payment_url,
                     KEY_A2Z_URL: AGENT_A2Z_PAY_URL
                 }
-                # Render the template
-                checkout_html = self.render_checkout_html(**html_data_pass)
-                if LOG_ENABLE:
-                    print(f"Payment Method {payment_method} checkout_html {checkout_html}")
-
+                # Render a custom HTML template for PayPal (using the same render_checkout_html for simplicity)
+                checkout_html = self.render_checkout_html(**html_data_pass)  # Use a new render function
                 script_data_pass = {
-                    KEY_STRIPE_PUBLISHABLE_KEY: publishable_key,
-                    KEY_STRIPE_CLIENT_SECRET: client_secret
+                    KEY_STRIPE_PUBLISHABLE_KEY: "",
+                    KEY_STRIPE_CLIENT_SECRET: ""
                 }
-                checkout_js = self.render_checkout_script(**script_data_pass)
-                if LOG_ENABLE:
-                    print(f"Payment Method {payment_method} checkout_js {checkout_js}")
-
-            elif payment_method == PAYMENT_METHOD_ALL:
-                ## 1. add payment Paypal
-                stripe_publishable_key = ""
-                stripe_client_secret = ""
-                try:
-                    payment_card = self.create_payment(order_id, method=PAYMENT_METHOD_CREDIT_CARD)
-                    print(f"Payment By Stripe Checkout Credit Card payment_card Result: {payment_card}")
-                    payment_url_card = payment_card.get(KEY_PAYMENT_URL, "")
-                    if payment_url_card is not None or payment_url_card != "":
-                        print(f"INFO: Payment By Credit Card Checkout URL Successfully: {payment_url_card}")
-                    else:
-                        print(f"INFO: Payment By Credit Card Checkout Failed with empty URL")
-                    stripe_publishable_key = payment_card.get(KEY_STRIPE_PUBLISHABLE_KEY, "")
-                    stripe_client_secret = payment_card.get(KEY_STRIPE_CLIENT_SECRET, "")
-                except Exception as e1:
-                    logging.error(f"Payment Method {payment_method}|CREDIT_CARD failed with error {e1}")
+                checkout_js = self.render_checkout_script(**script_data_pass, **lazy_script_data)
+            else:
+                checkout_html = PAYPAL_CHECKOUT_ERROR_HTML
+                checkout_js = ""
+
+        elif payment_method == PAYMENT_METHOD_CREDIT_CARD:
+
+            ## 1. Credit Card
+            payment = payments.get(PAYMENT_METHOD_CREDIT_CARD, {})
+            success = payment.get(KEY_SUCCESS, False)
+            payment_url = payment.get(KEY_PAYMENT_URL, "")
+            publishable_key = payment.get(KEY_STRIPE_PUBLISHABLE_KEY, "")
+            client_secret = payment.get(KEY_STRIPE_CLIENT_SECRET, "")
+            if success:
+                print(f"INFO: Credit Card Stripe Checkout Successfully URL: {payment_url}")
+            else:
+                print(f"ERROR: Credit Card Stripe Checkout Failed with empty result return: {payment}")
+            html_data_pass = {
+                KEY_TITLE: CHECKOUT_CARD_TITLE,
+                KEY_DESCRIPTION: CHECKOUT_CARD_DESCRIPTION,
+                KEY_AMOUNT: amount,
+                KEY_CURRENCY: currency,
+                KEY_A2Z_URL: AGENT_A2Z_PAY_URL
+            }
+            # Render the template
+            checkout_html = self.render_checkout_html(**html_data_pass)
+            if LOG_ENABLE:
+                print(f"Payment Method {payment_method} checkout_html {checkout_html}")
 
-                ## 2. PayPal Payment
-                payment_url_paypal = ""
-                try:
-                    payment_paypal = self.create_payment(order_id, method=PAYMENT_METHOD_PAYPAL)
-                    payment_url_paypal = payment_paypal.get(KEY_PAYMENT_URL, "")
-                    logging.info(f"Payment By Paypal Checkout URL Successfully: {payment_url_paypal}")
-                except Exception as e2:
-                    logging.error (f"Payment Method {payment_method} failed with error {e2}")
+            script_data_pass = {
+                KEY_STRIPE_PUBLISHABLE_KEY: publishable_key,
+                KEY_STRIPE_CLIENT_SECRET: client_secret
+            }
+            checkout_js = self.render_checkout_script(**script_data_pass, **lazy_script_data)
+            if LOG_ENABLE:
+                print(f"Payment Method {payment_method} checkout_js {checkout_js}")
 
-                ## 3. Add Alipay
+        elif payment_method == PAYMENT_METHOD_ALL:
+            ## 1. add payment Credit Card
+            payment_card = payments.get(PAYMENT_METHOD_CREDIT_CARD, {})
+            print(f"Payment By Stripe Checkout Credit Card payment_card Result: {payment_card}")
+            stripe_publishable_key = payment_card.get(KEY_STRIPE_PUBLISHABLE_KEY, "")
+            stripe_client_secret = payment_card.get(KEY_STRIPE_CLIENT_SECRET, "")
 
+            ## 2. PayPal Payment
+            payment_url_paypal = payments.get(PAYMENT_METHOD_PAYPAL, {}).get(KEY_PAYMENT_URL, "")
+            logging.info(f"Payment By Paypal Checkout URL Successfully: {payment_url_paypal}")
 
-                ## 4. Add WeChat
+            ## 3. Add Alipay
 
 
-                ## Merge Results
-                ## Merge Data in Html
-                html_data_pass = {
-                    KEY_TITLE: CHECKOUT_CARD_TITLE,
-                    KEY_DESCRIPTION: CHECKOUT_CARD_DESCRIPTION,
-                    KEY_AMOUNT: amount,
-                    KEY_CURRENCY: currency,
-                    KEY_PAYPAL_URL: payment_url_paypal,
-                    KEY_A2Z_URL: AGENT_A2Z_PAY_URL
-                }
+            ## 4. Add WeChat
 
-                # Render the template
-                checkout_html = self.render_checkout_html(**html_data_pass)
-                if LOG_ENABLE:
-                    print(f"Payment Method {payment_method} checkout_html {checkout_html}")
-                script_data_pass = {
-                    KEY_STRIPE_PUBLISHABLE_KEY: stripe_publishable_key,
-                    KEY_STRIPE_CLIENT_SECRET: stripe_client_secret
-                }
-                checkout_js = self.render_checkout_script(**script_data_pass)
-                if LOG_ENABLE:
-                    print(f"Payment Method {payment_method} checkout_js {checkout_js}")
 
-            else:
-                if LOG_ENABLE:
-                    print(f"DEBUG: PAYMENT_METHOD {payment_method} not supported.")
-        except Exception as e:
-            logging.error(f"Checkout Failed with error {e}")
+            ## Merge Results
+            ## Merge Data in Html
+            html_data_pass = {
+                KEY_TITLE: CHECKOUT_CARD_TITLE,
+                KEY_DESCRIPTION: CHECKOUT_CARD_DESCRIPTION,
+                KEY_AMOUNT: amount,
+                KEY_CURRENCY: currency,
+                KEY_PAYPAL_URL: payment_url_paypal,
+                KEY_A2Z_URL: AGENT_A2Z_PAY_URL,
+                ## the providers late or failed at checkout are not offered
+                KEY_STRIPE_DISPLAY: "block" if stripe_publishable_key else "none",
+                KEY_PAYPAL_DISPLAY: "block" if payment_url_paypal else "none"
+            }
+
+            # Render the template
+            checkout_html = self.render_checkout_html(**html_data_pass)
+            if LOG_ENABLE:
+                print(f"Payment Method {payment_method} checkout_html {checkout_html}")
+            script_data_pass = {
+                KEY_STRIPE_PUBLISHABLE_KEY: stripe_publishable_key,
+                KEY_STRIPE_CLIENT_SECRET: stripe_client_secret,
+                KEY_DEFAULT_METHOD: self._default_card_option(payments)
+            }
+            checkout_js = self.render_checkout_script(**script_data_pass, **lazy_script_data)
+            if LOG_ENABLE:
+                print(f"Payment Method {payment_method} checkout_js {checkout_js}")
+
+        else:
+            if LOG_ENABLE:
+                print(f"DEBUG: PAYMENT_METHOD {payment_method} not supported.")
 
         result = {
             KEY_CHECKOUT_HTML: checkout_html,
@@ -578,6 +1667,8 @@ class PaymentAgent:
                 "a2z_url": "test_pay.aiagenta2z.com"
             }
         """
+        html_data.setdefault(KEY_STRIPE_DISPLAY, "block")
+        html_data.setdefault(KEY_PAYPAL_DISPLAY, "block")
         return render_template(template_filepath, **html_data)
 
     def render_checkout_script(self, **script_data):
@@ -588,6 +1679,10 @@ class PaymentAgent:
                     "client_secret": client_secret
                 }
         """
+        script_data.setdefault(KEY_CHECKOUT_MODE, CHECKOUT_MODE_EAGER)
+        script_data.setdefault(ORDER_ID, "")
+        script_data.setdefault(KEY_CHECKOUT_SELECT_URL_JS, "")
+        script_data.setdefault(KEY_DEFAULT_METHOD, CHECKOUT_CARD_OPTIONS[PAYMENT_METHOD_CREDIT_CARD])
         return render_template(script_filepath, **script_data)
 
     def render_checkout_success(self, **order_status):
@@ -611,29 +1706,20 @@ class PaymentAgent:
 # --------------------------------
 # --- PayPal Helper Functions ---
 # --------------------------------
-def _get_paypal_access_token(client_id: str, client_secret: str, environment: str) -> Optional[str]:
-    """Retrieves an access token from PayPal."""
-    base_url = "https://api-m.sandbox.paypal.com" if environment == Environment.SANDBOX.value else "https://api-m.paypal.com"
-    token_url = f"{base_url}/v1/oauth2/token"
-
-    # PayPal uses Basic Auth for token request
-    try:
-        response = requests.post(
-            token_url,
-            headers={"Content-Type": "application/x-www-form-urlencoded"},
-            data="grant_type=client_credentials",
-            auth=(client_id, client_secret)
-        )
-        response.raise_for_status()
-        token_data = response.json()
-        return token_data.get(KEY_PAYPAL_ACCESS_TOKEN)
-    except requests.exceptions.RequestException as e:
-        logging.error(f"_get_paypal_access_token PayPal Token Request Failed: {e}")
-        return None
+def _get_paypal_access_token(client_id: str, client_secret: str, environment: str,
+                             http_client: Optional[ProviderHttpClient] = None, base_url: Optional[str] = None) -> Optional[str]:
+    """
+    Retrieves an access token from PayPal. Tokens are cached per (client_id, environment, base_url) until
+    expires_in and refreshed in the background shortly before, see PayPalTokenCache.
+    """
+    return PAYPAL_TOKEN_CACHE.get_token(client_id, client_secret, environment, http_client=http_client, base_url=base_url)
 
 # --- Usage Helper ---
-def get_payment_sdk(env="sandbox"):
-    cfg = AgentPaymentConfig(environment=env)
+def get_payment_sdk(env="sandbox", **config_kwargs):
+    """
+    :param config_kwargs: Further AgentPaymentConfig arguments, e.g. checkout_select_url.
+    """
+    cfg = AgentPaymentConfig(environment=env, **config_kwargs)
     return PaymentAgent(cfg)
 
 # --- Bill Agent (Records) ----
@@ -0,0 +1,197 @@
+import threading
+from typing import Dict, Optional, Tuple
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+class _CountingHTTPAdapter(HTTPAdapter):
+    """
+    HTTPAdapter keeping the urllib3 pools it hands out, so their public num_connections and
+    num_requests counters can be read. A pool evicted from the pool manager keeps counting in retired.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._pools_lock = threading.Lock()
+        self._pools = {}
+        self.retired = {"num_connections": 0, "num_requests": 0}
+        super().__init__(*args, **kwargs)
+
+    def get_connection_with_tls_context(self, *args, **kwargs):
+        return self._track(super().get_connection_with_tls_context(*args, **kwargs))
+
+    def get_connection(self, *args, **kwargs):
+        return self._track(super().get_connection(*args, **kwargs))
+
+    def counters(self) -> Dict:
+        """
+        num_connections and num_requests summed over the pools, and the number of hosts.
+        """
+        with self._pools_lock:
+            pools = list(self._pools.values())
+            counters = dict(self.retired)
+        for pool in pools:
+            counters["num_connections"] += pool.num_connections
+            counters["num_requests"] += pool.num_requests
+        counters["hosts"] = len(pools)
+        return counters
+
+    def _track(self, pool):
+        key = (pool.scheme, pool.host, pool.port)
+        with self._pools_lock:
+            known = self._pools.get(key)
+            if known is not pool:
+                if known is not None:
+                    self.retired["num_connections"] += known.num_connections
+                    self.retired["num_requests"] += known.num_requests
+                self._pools[key] = pool
+        return pool
+
+class ProviderHttpClient:
+    """
+    Shared HTTP client of the payment provider APIs (PayPal, ...).
+
+    One requests.Session with a pooled HTTPAdapter: connections are kept alive and reused
+    across calls, so a payment no longer pays a TCP and TLS handshake per API call.
+    Every request gets the default (connect, read) timeout unless it passes its own.
+    Thread safe, shared by the provider executor threads.
+    """
+
+    def __init__(self, pool_connections: int = 10, pool_maxsize: int = 32,
+                 connect_timeout: float = 3.05, read_timeout: float = 20.0):
+        """
+        :param pool_connections: Number of hosts whose connection pools are kept.
+        :param pool_maxsize: Maximum connections kept alive per host, about the number of concurrent calls.
+        :param connect_timeout: Seconds to establish a connection.
+        :param read_timeout: Seconds to wait for the response between bytes.
+        """
+        self.timeout: Tuple[float, float] = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        ## no urllib3 retries, a retried POST could create a second PayPal order
+        self._adapter = _CountingHTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=0)
+        self.session.mount("https://", self._adapter)
+        self.session.mount("http://", self._adapter)
+        self._lock = threading.Lock()
+        self._in_use = 0
+        self._requests = 0
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        with self._lock:
+            self._in_use += 1
+            self._requests += 1
+        try:
+            return self.session.request(method, url, **kwargs)
+        finally:
+            with self._lock:
+                self._in_use -= 1
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+    def stats(self) -> Dict:
+        """
+        Pool metrics: requests in flight, connections opened (urllib3 num_connections) and
+        reused_estimate, the requests that did not open a connection. urllib3 does not count
+        requests per connection, a connection opened for a failed request makes it an estimate.
+        """
+        counters = self._adapter.counters()
+        with self._lock:
+            return {
+                "in_use": self._in_use,
+                "requests": self._requests,
+                "new_connections": counters["num_connections"],
+                "reused_estimate": max(0, counters["num_requests"] - counters["num_connections"]),
+                "hosts": counters["hosts"],
+            }
+
+    def close(self):
+        self.session.close()
+
+class AsyncProviderHttpClient:
+    """
+    Async counterpart of ProviderHttpClient on an httpx.AsyncClient, for the provider calls made
+    from async handlers, so they never block the event loop.
+
+    Same pooling and default timeouts. The connection pool belongs to the event loop that first
+    uses the client, share one instance per loop (e.g. the app loop).
+
+    New and reused connections are counted per request through the httpx "trace" request
+    extension: a request that opened a TCP connection is new, any other answered request reused one.
+    """
+
+    def __init__(self, pool_maxsize: int = 32, connect_timeout: float = 3.05, read_timeout: float = 20.0):
+        """
+        :param pool_maxsize: Maximum connections kept alive, about the number of concurrent calls.
+        :param connect_timeout: Seconds to establish a connection.
+        :param read_timeout: Seconds to wait for the response between bytes.
+        """
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        ## no transport retries, a retried POST could create a second PayPal order
+        self.client = httpx.AsyncClient(
+            timeout=self.timeout,
+            limits=httpx.Limits(max_connections=pool_maxsize, max_keepalive_connections=pool_maxsize),
+        )
+        self._in_use = 0
+        self._requests = 0
+        self._new_connections = 0
+        self._reused = 0
+
+    async def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        ## requests style keywords of the sync call sites
+        if "data" in kwargs and isinstance(kwargs["data"], (str, bytes)):
+            kwargs["content"] = kwargs.pop("data")
+        connected = []
+        caller_trace = kwargs.get("extensions", {}).get("trace")
+
+        async def trace(event_name: str, info: Dict):
+            if event_name == "connection.connect_tcp.complete":
+                connected.append(True)
+            if caller_trace is not None:
+                await caller_trace(event_name, info)
+
+        kwargs["extensions"] = {**kwargs.get("extensions", {}), "trace": trace}
+        self._in_use += 1
+        self._requests += 1
+        response = None
+        try:
+            response = await self.client.request(method, url, **kwargs)
+            return response
+        finally:
+            self._in_use -= 1
+            if connected:
+                self._new_connections += 1
+            elif response is not None:
+                self._reused += 1
+
+    async def get(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("POST", url, **kwargs)
+
+    def stats(self) -> Dict:
+        """
+        Pool metrics: requests in flight, connections opened and requests served on a reused connection.
+        """
+        return {"in_use": self._in_use, "requests": self._requests,
+                "new_connections": self._new_connections, "reused": self._reused}
+
+    async def aclose(self):
+        await self.client.aclose()
+
+_default_client: Optional[ProviderHttpClient] = None
+_default_client_lock = threading.Lock()
+
+def get_default_http_client() -> ProviderHttpClient:
+    """
+    Process wide client of the module level helpers, e.g. _get_paypal_access_token, when no client is passed.
+    """
+    global _default_client
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = ProviderHttpClient()
+        return _default_client
@@ -0,0 +1,77 @@
+import os
+import threading
+import time
+import uuid
+
+# Crockford base32, the ULID alphabet, sorts in the same order as the encoded values
+CROCKFORD_BASE32 = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+
+class MonotonicIdGenerator:
+    """
+    K-sortable id source: a 48 bit unix millisecond timestamp followed by random_bits random bits.
+
+    Within one millisecond the random part of the previous id is incremented instead of drawn
+    again, so ids of one process sort strictly in creation order (ULID monotonic mode).
+    A clock going backwards keeps the last timestamp, the ids still increase.
+    """
+
+    def __init__(self, random_bits: int):
+        self.random_bits = random_bits
+        self._max_random = (1 << random_bits) - 1
+        self._last_ms = -1
+        self._last_random = 0
+        self._lock = threading.Lock()
+
+    def next(self):
+        """
+        :return: (timestamp_ms, random) of the next id.
+        """
+        now_ms = time.time_ns() // 1_000_000
+        with self._lock:
+            if now_ms <= self._last_ms:
+                now_ms = self._last_ms
+                random = self._last_random + 1
+                if random > self._max_random:
+                    ## random part exhausted in this millisecond, borrow the next one
+                    now_ms += 1
+                    random = int.from_bytes(os.urandom(16), "big") >> (128 - self.random_bits + 1)
+            else:
+                ## the top bit stays clear, leaves room for increments within the millisecond
+                random = int.from_bytes(os.urandom(16), "big") >> (128 - self.random_bits + 1)
+            self._last_ms = now_ms
+            self._last_random = random
+        return now_ms, random
+
+_ulid_generator = MonotonicIdGenerator(80)
+_uuid7_generator = MonotonicIdGenerator(74)
+
+def new_ulid() -> str:
+    """
+    26 character ULID, e.g. 01JA2Z8Q5C7M3V0T6R1N9XK4BD, lexicographically sorted by creation time.
+    """
+    timestamp_ms, random = _ulid_generator.next()
+    return _encode_ulid((timestamp_ms << 80) | random)
+
+def new_uuid7() -> str:
+    """
+    RFC 9562 UUIDv7 string, same shape as str(uuid.uuid4()) and sorted by creation time.
+    """
+    timestamp_ms, random = _uuid7_generator.next()
+    rand_a = random >> 62
+    rand_b = random & ((1 << 62) - 1)
+    value = (timestamp_ms & ((1 << 48) - 1)) << 80 | 0x7 << 76 | rand_a << 64 | 0b10 << 62 | rand_b
+    return str(uuid.UUID(int=value))
+
+def ulid_floor(timestamp: float) -> str:
+    """
+    Smallest ULID of a unix timestamp in seconds, the bound of a range scan on ULID keys,
+    e.g. order_id < "order_" + ulid_floor(cutoff) selects the orders created before cutoff.
+    """
+    return _encode_ulid(int(timestamp * 1000) << 80)
+
+def _encode_ulid(value: int) -> str:
+    chars = []
+    for _ in range(26):
+        chars.append(CROCKFORD_BASE32[value & 0x1F])
+        value >>= 5
+    return "".join(reversed(chars))
@@ -0,0 +1,628 @@
+"""
+Local stand-in of the Stripe and PayPal APIs the SDK calls, for offline load tests of checkout
+and the stripe_webhook / paypal_webhook endpoints without the sandbox APIs and their rate limits.
+
+Point the SDK at it with AgentPaymentConfig(stripe_api_base=..., paypal_base_url=...) or the
+A2Z_PAYMENT_STRIPE_API_BASE / A2Z_PAYMENT_PAYPAL_BASE_URL environment variables.
+
+Usage:
+    python -m agent_a2z_payment.mock_providers --port 12111 --stripe_latency lognormal:150:0.4 \\
+        --error_rate 0.01 --stripe_webhook_url http://127.0.0.1:7000/a2z_payment_agent_sandbox/stripe/webhook \\
+        --paypal_webhook_url http://127.0.0.1:7000/a2z_payment_agent_sandbox/paypal/webhook --pay_after fixed:2000
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import math
+import random
+import threading
+import time
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+from urllib.parse import parse_qs, urlsplit
+
+import requests
+
+from .constants import *
+
+class LatencyDistribution:
+    """
+    Response latency of a mock endpoint, parsed from a spec string in milliseconds:
+
+        fixed:MS                  always MS
+        uniform:MIN_MS:MAX_MS     uniform in [MIN_MS, MAX_MS]
+        lognormal:MEDIAN_MS:SIGMA lognormal around MEDIAN_MS, SIGMA 0.5 gives a p99 of ~3.2x the median
+    """
+
+    KINDS = ("fixed", "uniform", "lognormal")
+
+    def __init__(self, kind: str = "fixed", *params: float):
+        if kind not in self.KINDS:
+            raise ValueError(f"Unknown latency distribution {kind}, expected one of {self.KINDS}")
+        self.kind = kind
+        self.params = params
+
+    @classmethod
+    def parse(cls, spec: str) -> "LatencyDistribution":
+        kind, *params = spec.split(":")
+        return cls(kind, *[float(param) for param in params])
+
+    def sample(self, rng: random.Random) -> float:
+        """
+        :return: Seconds.
+        """
+        if self.kind == "fixed":
+            millis = self.params[0]
+        elif self.kind == "uniform":
+            millis = rng.uniform(self.params[0], self.params[1])
+        else:
+            millis = rng.lognormvariate(math.log(self.params[0]), self.params[1])
+        return max(0.0, millis) / 1000.0
+
+    def __repr__(self):
+        return ":".join([self.kind] + [f"{param:g}" for param in self.params])
+
+def sign_stripe_payload(payload: str, secret: str, timestamp: Optional[int] = None) -> str:
+    """
+    Stripe-Signature header of a webhook payload, the scheme stripe.Webhook.construct_event verifies.
+    """
+    timestamp = int(time.time()) if timestamp is None else timestamp
+    signature = hmac.new(secret.encode(), f"{timestamp}.{payload}".encode(), hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={signature}"
+
+def _paypal_signature(key: bytes, transmission_id: str, transmission_time: str, webhook_id: str, event: Dict) -> str:
+    ## PayPal signs "<id>|<time>|<webhook_id>|<crc32 of the body>", the mock with an HMAC instead of its RSA key,
+    ## the body is canonical JSON, the receiver posts the parsed event back to verify it
+    body = json.dumps(event, sort_keys=True, separators=(",", ":"))
+    message = f"{transmission_id}|{transmission_time}|{webhook_id}|{zlib.crc32(body.encode())}"
+    return base64.b64encode(hmac.new(key, message.encode(), hashlib.sha256).digest()).decode()
+
+class MockProviderServer:
+    """
+    Mock Stripe and PayPal API on a local ThreadingHTTPServer.
+
+    Stripe: POST /v1/payment_intents, POST /v1/checkout/sessions, GET of both lists (created[gte|gt|lte|lt],
+        limit, starting_after, status) and objects.
+    PayPal: POST /v1/oauth2/token, POST /v2/checkout/orders, GET /v2/checkout/orders/{id},
+        POST /v2/checkout/orders/{id}/capture, POST /v1/notifications/verify-webhook-signature.
+
+    Create calls honour Idempotency-Key and PayPal-Request-Id as the providers do. A buyer paying
+    is simulated by pay(object_id), POST /mock/pay/{object_id}, opening the Checkout Session url or
+    PayPal approve link, or after pay_after of every created payment. Paying sends the signed
+    webhooks of the provider: payment_intent.succeeded (and checkout.session.completed) to
+    stripe_webhook_url, CHECKOUT.ORDER.APPROVED to paypal_webhook_url and PAYMENT.CAPTURE.COMPLETED
+    once the order is captured, each dropped with probability webhook_loss_rate to test reconciliation.
+    GET /mock/stats returns the request, error and webhook counters.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0,
+                 stripe_latency: str = "fixed:50", paypal_latency: str = "fixed:80", token_latency: str = "fixed:20",
+                 error_rate: float = 0.0, seed: Optional[int] = None,
+                 stripe_webhook_url: Optional[str] = None, stripe_webhook_secret: str = "whsec_mock",
+                 paypal_webhook_url: Optional[str] = None, paypal_webhook_id: str = "WH-MOCK",
+                 pay_after: Optional[str] = None, webhook_workers: int = 16, webhook_retries: int = 3,
+                 webhook_loss_rate: float = 0.0):
+        """
+        :param stripe_latency: LatencyDistribution spec of the Stripe endpoints.
+        :param paypal_latency: LatencyDistribution spec of the PayPal order, capture and verify endpoints.
+        :param token_latency: LatencyDistribution spec of the PayPal OAuth endpoint.
+        :param error_rate: Share of the API calls answered 503.
+        :param seed: Seed of the latency and error draws, for repeatable runs.
+        :param stripe_webhook_secret: Signing secret of the Stripe webhooks, the SDK's stripe_webhook_secret.
+        :param paypal_webhook_id: Webhook id the PayPal signatures verify against, the SDK's paypal_webhook_id.
+        :param pay_after: LatencyDistribution spec of the buyer paying each created payment, never if not set.
+        :param webhook_workers: Threads delivering the webhooks.
+        :param webhook_retries: Redeliveries of a webhook not answered 2xx, as Stripe and PayPal retry them.
+        :param webhook_loss_rate: Share of the webhooks never sent, e.g. an endpoint down past the provider's retries.
+        """
+        self.host = host
+        self.port = port
+        self.latencies = {"stripe": LatencyDistribution.parse(stripe_latency),
+                          "paypal": LatencyDistribution.parse(paypal_latency),
+                          "token": LatencyDistribution.parse(token_latency)}
+        self.error_rate = error_rate
+        self.stripe_webhook_url = stripe_webhook_url
+        self.stripe_webhook_secret = stripe_webhook_secret
+        self.paypal_webhook_url = paypal_webhook_url
+        self.paypal_webhook_id = paypal_webhook_id
+        self.pay_after = LatencyDistribution.parse(pay_after) if pay_after else None
+        self.webhook_retries = webhook_retries
+        self.webhook_loss_rate = webhook_loss_rate
+        self._random = random.Random(seed)
+        self._signing_key = uuid.uuid4().bytes
+        self._lock = threading.Lock()
+        self._objects: Dict[str, Dict] = {}
+        self._idempotent: Dict[str, Dict] = {}
+        self._inflight = set()
+        self._tokens = set()
+        self._counters: Dict[str, int] = {}
+        self._webhook_executor = ThreadPoolExecutor(max_workers=webhook_workers, thread_name_prefix="mock_webhook")
+        self._server: Optional[ThreadingHTTPServer] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self._server.server_address[1]}" if self._server else ""
+
+    def start(self) -> str:
+        """
+        Starts serving in a background thread.
+
+        :return: Base URL of both APIs, e.g. "http://127.0.0.1:12111".
+        """
+        self._server = _MockHTTPServer((self.host, self.port), _make_handler(self))
+        self._thread = threading.Thread(target=self._server.serve_forever, name="mock_providers", daemon=True)
+        self._thread.start()
+        logging.info(f"MockProviderServer listening on {self.url}")
+        return self.url
+
+    def stop(self):
+        ## the queued webhooks are delivered first, their receiver may still call the API
+        self._webhook_executor.shutdown(wait=True)
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._counters)
+
+    def pay(self, object_id: str) -> bool:
+        """
+        The buyer pays a PaymentIntent, Checkout Session or approves a PayPal order, its webhooks are sent.
+
+        :return: False if the object is unknown or already paid.
+        """
+        with self._lock:
+            obj = self._objects.get(object_id)
+            if obj is None or obj.get("_paid"):
+                return False
+            obj["_paid"] = True
+            if obj["object"] == "payment_intent":
+                obj["status"] = "succeeded"
+            elif obj["object"] == "checkout.session":
+                obj.update(status="complete", payment_status="paid")
+                intent = self._objects.get(obj["payment_intent"])
+                if intent is not None:
+                    intent.update(status="succeeded", _paid=True)
+            else:
+                obj["status"] = "APPROVED"
+            snapshot = _public(obj)
+            intent_snapshot = _public(self._objects[obj["payment_intent"]]) \
+                if obj["object"] == "checkout.session" and obj["payment_intent"] in self._objects else None
+        self._count("payments_paid")
+        if snapshot["object"] == "payment_intent":
+            self._send_stripe_event("payment_intent.succeeded", snapshot)
+        elif snapshot["object"] == "checkout.session":
+            self._send_stripe_event("checkout.session.completed", snapshot)
+            if intent_snapshot is not None:
+                self._send_stripe_event("payment_intent.succeeded", intent_snapshot)
+        else:
+            self._send_paypal_event("CHECKOUT.ORDER.APPROVED", snapshot)
+        return True
+
+    def verify_paypal_signature(self, verification: Dict) -> bool:
+        """
+        The verify-webhook-signature check of a webhook this server sent.
+        """
+        if verification.get("webhook_id") != self.paypal_webhook_id:
+            return False
+        expected = _paypal_signature(self._signing_key, str(verification.get("transmission_id")),
+                                     str(verification.get("transmission_time")), self.paypal_webhook_id,
+                                     verification.get("webhook_event") or {})
+        return hmac.compare_digest(expected, str(verification.get("transmission_sig")))
+
+    # -----------------------------
+    # Stripe
+    # -----------------------------
+    def create_payment_intent(self, form: Dict[str, str], auto_pay: bool = True) -> Dict:
+        object_id = f"pi_mock_{uuid.uuid4().hex[:24]}"
+        return self._add({
+            "id": object_id,
+            "object": "payment_intent",
+            "amount": int(form.get("amount", 0)),
+            "currency": form.get("currency", "usd"),
+            "client_secret": f"{object_id}_secret_{uuid.uuid4().hex[:16]}",
+            "status": "requires_payment_method",
+            "metadata": _form_metadata(form),
+            "created": int(time.time()),
+            "livemode": False
+        }, auto_pay=auto_pay)
+
+    def create_checkout_session(self, form: Dict[str, str]) -> Dict:
+        intent = self.create_payment_intent({
+            "amount": str(int(form.get("line_items[0][price_data][unit_amount]", 0)) * int(form.get("line_items[0][quantity]", 1))),
+            "currency": form.get("line_items[0][price_data][currency]", "usd"),
+            **{key: value for key, value in form.items() if key.startswith("metadata[")}
+        }, auto_pay=False)
+        object_id = f"cs_mock_{uuid.uuid4().hex[:24]}"
+        return self._add({
+            "id": object_id,
+            "object": "checkout.session",
+            "amount_total": intent["amount"],
+            "currency": intent["currency"],
+            "payment_intent": intent["id"],
+            "payment_status": "unpaid",
+            "status": "open",
+            "mode": form.get("mode", "payment"),
+            "url": f"{self.url}/mock/checkout/{object_id}",
+            "success_url": form.get("success_url", ""),
+            "cancel_url": form.get("cancel_url", ""),
+            "metadata": _form_metadata(form),
+            "created": int(time.time()),
+            "livemode": False
+        })
+
+    # -----------------------------
+    # PayPal
+    # -----------------------------
+    def issue_token(self) -> Dict:
+        token = f"A21_mock_{uuid.uuid4().hex}"
+        with self._lock:
+            self._tokens.add(token)
+        return {"scope": "https://uri.paypal.com/services/payments/payment", "access_token": token,
+                "token_type": "Bearer", "app_id": "APP-MOCK", "expires_in": 32400, "nonce": uuid.uuid4().hex}
+
+    def authorized(self, authorization: Optional[str]) -> bool:
+        with self._lock:
+            return bool(authorization) and authorization.replace("Bearer ", "") in self._tokens
+
+    def create_paypal_order(self, body: Dict) -> Dict:
+        object_id = uuid.uuid4().hex[:17].upper()
+        return self._add({
+            "id": object_id,
+            "object": "paypal_order",
+            "intent": body.get("intent", "CAPTURE"),
+            "status": "CREATED",
+            "purchase_units": body.get("purchase_units", []),
+            "create_time": _iso_now(),
+            "links": [
+                {"href": f"{self.url}/v2/checkout/orders/{object_id}", "rel": "self", "method": "GET"},
+                {"href": f"{self.url}/mock/paypal/approve?token={object_id}", "rel": "approve", "method": "GET"},
+                {"href": f"{self.url}/v2/checkout/orders/{object_id}/capture", "rel": "capture", "method": "POST"}
+            ]
+        })
+
+    def capture_paypal_order(self, object_id: str):
+        """
+        :return: (status code, body), 422 as PayPal if the order is not approved or already captured.
+        """
+        with self._lock:
+            order = self._objects.get(object_id)
+            if order is None or order["object"] != "paypal_order":
+                return 404, {"name": "RESOURCE_NOT_FOUND", "message": f"Order {object_id} not found"}
+            if order["status"] == "COMPLETED":
+                return 422, {"name": "UNPROCESSABLE_ENTITY", "details": [{"issue": "ORDER_ALREADY_CAPTURED"}]}
+            if order["status"] != "APPROVED":
+                return 422, {"name": "UNPROCESSABLE_ENTITY", "details": [{"issue": "ORDER_NOT_APPROVED"}]}
+            capture_id = uuid.uuid4().hex[:17].upper()
+            order["status"] = "COMPLETED"
+            for unit in order["purchase_units"]:
+                unit["payments"] = {"captures": [{"id": capture_id, "status": "COMPLETED", "amount": unit.get("amount")}]}
+            snapshot = _public(order)
+        capture = {"id": capture_id, "status": "COMPLETED",
+                   "amount": (snapshot["purchase_units"] or [{}])[0].get("amount"),
+                   "supplementary_data": {"related_ids": {"order_id": object_id}}}
+        self._send_paypal_event("PAYMENT.CAPTURE.COMPLETED", capture)
+        return 201, snapshot
+
+    def list_objects(self, object_type: str, query: Dict[str, str], url: str) -> Dict:
+        """
+        A Stripe list of object_type, newest first as Stripe pages them.
+
+        :param query: The list parameters, created[gte], created[gt], created[lte], created[lt], limit (1 to 100),
+            starting_after and status.
+        """
+        bounds = {"gte": lambda created, value: created >= value, "gt": lambda created, value: created > value,
+                  "lte": lambda created, value: created <= value, "lt": lambda created, value: created < value}
+        limit = max(1, min(100, int(query.get("limit", 10))))
+        with self._lock:
+            objects = [obj for obj in reversed(list(self._objects.values())) if obj["object"] == object_type]
+        if query.get("starting_after"):
+            ids = [obj["id"] for obj in objects]
+            objects = objects[ids.index(query["starting_after"]) + 1:] if query["starting_after"] in ids else []
+        for bound, check in bounds.items():
+            if f"created[{bound}]" in query:
+                objects = [obj for obj in objects if check(obj["created"], int(query[f"created[{bound}]"]))]
+        if query.get("status"):
+            objects = [obj for obj in objects if obj.get("status") == query["status"]]
+        return {"object": "list", "url": url, "has_more": len(objects) > limit,
+                "data": [_public(obj) for obj in objects[:limit]]}
+
+    def get_object(self, object_id: str) -> Optional[Dict]:
+        with self._lock:
+            obj = self._objects.get(object_id)
+            return _public(obj) if obj is not None else None
+
+    def create(self, key: Optional[str], group: str, create):
+        """
+        A create call of the API: its latency, an injected 503, then create() once per idempotency key.
+        The result of a key is replayed, a concurrent call of a key in flight is answered 409 as Stripe does.
+
+        :return: (status code, body).
+        """
+        with self._lock:
+            if key and key in self._idempotent:
+                self._counters["idempotent_replays"] = self._counters.get("idempotent_replays", 0) + 1
+                return 200, self._idempotent[key]
+            if key and key in self._inflight:
+                self._counters["idempotent_conflicts"] = self._counters.get("idempotent_conflicts", 0) + 1
+                return 409, {"error": {"type": "invalid_request_error", "code": "idempotency_key_in_use",
+                                       "message": "There is currently another in-progress request using this Idempotent Key"}}
+            if key:
+                self._inflight.add(key)
+        try:
+            if self.delay(group):
+                return 503, {"error": {"type": "api_error", "message": "Mock provider injected 503"}}
+            created = create()
+            if key:
+                with self._lock:
+                    self._idempotent[key] = created
+            return 200, created
+        finally:
+            if key:
+                with self._lock:
+                    self._inflight.discard(key)
+
+    def delay(self, group: str) -> bool:
+        """
+        Sleeps the latency of the endpoint group.
+
+        :return: True if the call is answered with an injected 503.
+        """
+        with self._lock:
+            seconds = self.latencies[group].sample(self._random)
+            failed = self._random.random() < self.error_rate
+            self._counters["requests"] = self._counters.get("requests", 0) + 1
+            if failed:
+                self._counters["errors_injected"] = self._counters.get("errors_injected", 0) + 1
+        time.sleep(seconds)
+        return failed
+
+    def _add(self, obj: Dict, auto_pay: bool = True) -> Dict:
+        ## auto_pay: the buyer pays it after pay_after, not the PaymentIntent of a Checkout Session
+        with self._lock:
+            self._objects[obj["id"]] = obj
+            self._counters[f"{obj['object']}_created"] = self._counters.get(f"{obj['object']}_created", 0) + 1
+            snapshot = _public(obj)
+        if self.pay_after is not None and auto_pay:
+            with self._lock:
+                seconds = self.pay_after.sample(self._random)
+            timer = threading.Timer(seconds, self.pay, args=(obj["id"],))
+            timer.daemon = True
+            timer.start()
+        return snapshot
+
+    def _count(self, key: str):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+
+    def _send_stripe_event(self, event_type: str, obj: Dict):
+        if not self.stripe_webhook_url:
+            return
+        payload = json.dumps({
+            "id": f"evt_mock_{uuid.uuid4().hex[:24]}",
+            "object": "event",
+            "type": event_type,
+            "created": int(time.time()),
+            "livemode": False,
+            "data": {"object": obj}
+        })
+        headers = {"Content-Type": "application/json",
+                   "Stripe-Signature": sign_stripe_payload(payload, self.stripe_webhook_secret)}
+        self._submit(self.stripe_webhook_url, payload, headers)
+
+    def _send_paypal_event(self, event_type: str, resource: Dict):
+        if not self.paypal_webhook_url:
+            return
+        event = {
+            "id": f"WH-MOCK-{uuid.uuid4().hex[:17].upper()}",
+            "event_version": "1.0",
+            "create_time": _iso_now(),
+            "resource_type": "capture" if event_type.startswith("PAYMENT.CAPTURE") else "checkout-order",
+            "event_type": event_type,
+            "resource": resource
+        }
+        transmission_id = str(uuid.uuid4())
+        transmission_time = _iso_now()
+        headers = {
+            "Content-Type": "application/json",
+            "PAYPAL-TRANSMISSION-ID": transmission_id,
+            "PAYPAL-TRANSMISSION-TIME": transmission_time,
+            "PAYPAL-TRANSMISSION-SIG": _paypal_signature(self._signing_key, transmission_id, transmission_time,
+                                                         self.paypal_webhook_id, event),
+            "PAYPAL-AUTH-ALGO": "HMACSHA256",
+            "PAYPAL-CERT-URL": f"{self.url}/mock/certs/webhook"
+        }
+        self._submit(self.paypal_webhook_url, json.dumps(event), headers)
+
+    def _submit(self, url: str, payload: str, headers: Dict[str, str]):
+        with self._lock:
+            lost = self._random.random() < self.webhook_loss_rate
+        if lost:
+            self._count("webhooks_lost")
+            return
+        try:
+            self._webhook_executor.submit(self._deliver, url, payload, headers)
+        except RuntimeError:
+            ## stopping, e.g. the capture webhook of an order approved while the queue drains
+            self._count("webhooks_failed")
+            logging.warning(f"MockProviderServer stopped, webhook {url} not sent")
+
+    def _deliver(self, url: str, payload: str, headers: Dict[str, str]):
+        for attempt in range(self.webhook_retries + 1):
+            if attempt > 0:
+                self._count("webhooks_retried")
+                time.sleep(0.2 * (2 ** (attempt - 1)))
+            try:
+                response = requests.post(url, data=payload.encode(), headers=headers, timeout=10)
+            except requests.exceptions.RequestException as e:
+                logging.warning(f"MockProviderServer webhook {url} failed with error {e}")
+                continue
+            if response.status_code < 300:
+                self._count("webhooks_sent")
+                return
+            logging.warning(f"MockProviderServer webhook {url} answered {response.status_code} {response.text[:200]}")
+        self._count("webhooks_failed")
+
+class _MockHTTPServer(ThreadingHTTPServer):
+    ## the default listen backlog of 5 resets connections under load
+    request_queue_size = 128
+    daemon_threads = True
+
+def _make_handler(mock: MockProviderServer):
+    class Handler(BaseHTTPRequestHandler):
+        disable_nagle_algorithm = True
+        protocol_version = "HTTP/1.1"
+
+        def _reply(self, status: int, body, content_type: str = "application/json"):
+            data = body.encode() if isinstance(body, str) else json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _body(self) -> bytes:
+            return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        def _api_error(self, group: str) -> bool:
+            if mock.delay(group):
+                self._reply(503, {"error": {"type": "api_error", "message": "Mock provider injected 503"}})
+                return True
+            return False
+
+        def do_POST(self):
+            path = urlsplit(self.path).path
+            body = self._body()
+            if path.startswith("/mock/pay/"):
+                self._reply(200, {"paid": mock.pay(path[len("/mock/pay/"):])})
+                return
+            if path == "/v1/oauth2/token":
+                if not self._api_error("token"):
+                    self._reply(200, mock.issue_token())
+                return
+            if path in ("/v1/payment_intents", "/v1/checkout/sessions"):
+                form = {key: values[-1] for key, values in parse_qs(body.decode()).items()}
+                create = mock.create_payment_intent if path == "/v1/payment_intents" else mock.create_checkout_session
+                self._reply(*mock.create(self.headers.get("Idempotency-Key"), "stripe", lambda: create(form)))
+                return
+            if path.startswith("/v2/") or path == "/v1/notifications/verify-webhook-signature":
+                if not mock.authorized(self.headers.get("Authorization")):
+                    self._reply(401, {"error": "invalid_token", "error_description": "Token signature verification failed"})
+                    return
+                payload = json.loads(body or b"{}")
+                if path == "/v2/checkout/orders":
+                    status, order = mock.create(self.headers.get("PayPal-Request-Id"), "paypal",
+                                                lambda: mock.create_paypal_order(payload))
+                    self._reply(201 if status == 200 else status, order)
+                    return
+                if self._api_error("paypal"):
+                    return
+                if path.startswith("/v2/checkout/orders/") and path.endswith("/capture"):
+                    self._reply(*mock.capture_paypal_order(path.split("/")[4]))
+                elif path == "/v1/notifications/verify-webhook-signature":
+                    verified = mock.verify_paypal_signature(payload)
+                    self._reply(200, {"verification_status": "SUCCESS" if verified else "FAILURE"})
+                else:
+                    self._reply(404, {"name": "RESOURCE_NOT_FOUND"})
+                return
+            self._reply(404, {"error": {"message": f"Unrecognized request URL (POST: {path})"}})
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            if url.path == "/mock/stats":
+                self._reply(200, mock.stats())
+            elif url.path.startswith("/mock/checkout/") or url.path == "/mock/paypal/approve":
+                ## the buyer opened the hosted checkout page or the PayPal approve link
+                object_id = url.path[len("/mock/checkout/"):] if url.path.startswith("/mock/checkout/") \
+                    else parse_qs(url.query).get("token", [""])[0]
+                paid = mock.pay(object_id)
+                self._reply(200, f"<html><body><h1>Mock payment {object_id} {'paid' if paid else 'not found or already paid'}</h1></body></html>",
+                            content_type="text/html")
+            elif url.path in ("/v1/payment_intents", "/v1/checkout/sessions"):
+                if not self._api_error("stripe"):
+                    object_type = "payment_intent" if url.path == "/v1/payment_intents" else "checkout.session"
+                    query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+                    self._reply(200, mock.list_objects(object_type, query, url.path))
+            elif url.path.startswith("/v1/payment_intents/") or url.path.startswith("/v1/checkout/sessions/"):
+                if not self._api_error("stripe"):
+                    obj = mock.get_object(url.path.rsplit("/", 1)[1])
+                    self._reply(200 if obj else 404, obj or {"error": {"type": "invalid_request_error",
+                                                                        "code": "resource_missing"}})
+            elif url.path.startswith("/v2/checkout/orders/"):
+                if not mock.authorized(self.headers.get("Authorization")):
+                    self._reply(401, {"error": "invalid_token", "error_description": "Token signature verification failed"})
+                elif not self._api_error("paypal"):
+                    order = mock.get_object(url.path.split("/")[4])
+                    self._reply(200 if order else 404, order or {"name": "RESOURCE_NOT_FOUND"})
+            else:
+                self._reply(404, {"error": {"message": f"Unrecognized request URL (GET: {url.path})"}})
+
+        def handle_one_request(self):
+            try:
+                super().handle_one_request()
+            except (BrokenPipeError, ConnectionResetError):
+                ## the SDK gave up on the call, e.g. a cancelled hedge or a missed deadline
+                self.close_connection = True
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+def _public(obj: Dict) -> Dict:
+    ## a copy without the mock's own fields
+    return json.loads(json.dumps({key: value for key, value in obj.items() if not key.startswith("_")}))
+
+def _form_metadata(form: Dict[str, str]) -> Dict[str, str]:
+    return {key[len("metadata["):-1]: value for key, value in form.items() if key.startswith("metadata[")}
+
+def _iso_now() -> str:
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+def main():
+    parser = argparse.ArgumentParser(description="Local mock Stripe and PayPal API of the agent_a2z_payment SDK")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=12111)
+    parser.add_argument("--stripe_latency", default="fixed:50", help="fixed:MS | uniform:MIN_MS:MAX_MS | lognormal:MEDIAN_MS:SIGMA")
+    parser.add_argument("--paypal_latency", default="fixed:80")
+    parser.add_argument("--token_latency", default="fixed:20")
+    parser.add_argument("--error_rate", type=float, default=0.0, help="share of the API calls answered 503")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--stripe_webhook_url", default=None)
+    parser.add_argument("--stripe_webhook_secret", default="whsec_mock")
+    parser.add_argument("--paypal_webhook_url", default=None)
+    parser.add_argument("--paypal_webhook_id", default="WH-MOCK")
+    parser.add_argument("--pay_after", default=None, help="latency spec of the buyer paying every created payment")
+    parser.add_argument("--webhook_retries", type=int, default=3)
+    parser.add_argument("--webhook_loss_rate", type=float, default=0.0, help="share of the webhooks never sent")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    server = MockProviderServer(host=args.host, port=args.port, stripe_latency=args.stripe_latency,
+                                paypal_latency=args.paypal_latency, token_latency=args.token_latency,
+                                error_rate=args.error_rate, seed=args.seed,
+                                stripe_webhook_url=args.stripe_webhook_url, stripe_webhook_secret=args.stripe_webhook_secret,
+                                paypal_webhook_url=args.paypal_webhook_url, paypal_webhook_id=args.paypal_webhook_id,
+                                pay_after=args.pay_after, webhook_retries=args.webhook_retries,
+                                webhook_loss_rate=args.webhook_loss_rate)
+    url = server.start()
+    print(f"Mock Stripe and PayPal API on {url}, point the SDK at it with\n"
+          f"    export {KEY_STRIPE_API_BASE}={url} {KEY_PAYPAL_BASE_URL}={url} "
+          f"{KEY_STRIPE_WEBHOOK_SECRET}={args.stripe_webhook_secret} {KEY_PAYPAL_WEBHOOK_ID}={args.paypal_webhook_id}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
+
+if __name__ == "__main__":
+    main()
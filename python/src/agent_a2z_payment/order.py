@@ -0,0 +1,193 @@
+import math
+from collections.abc import MutableMapping
+from enum import Enum
+from typing import Dict, Optional, Any
+
+from .constants import *
+
+class OrderStatus(str, Enum):
+    """
+    Order status. A str enum, so order[STATUS] == "paid" and json.dumps keep working.
+    """
+    PENDING = STATUS_PENDING
+    APPROVED = STATUS_APPROVED
+    CAPTURED = STATUS_CAPTURED
+    PAID = STATUS_PAID
+    REFUNDED = STATUS_REFUNDED
+    EXPIRED = STATUS_EXPIRED
+
+    def __str__(self):
+        return self.value
+
+    @classmethod
+    def parse(cls, status: Any):
+        """
+        OrderStatus of a known status string, other values are kept as is.
+        """
+        try:
+            return cls(status)
+        except ValueError:
+            return status
+
+# Order state machine: pending -> approved -> captured/paid -> refunded, unpaid orders expire.
+# An expired order can still be paid, a late webhook means the money did move.
+ORDER_TRANSITIONS = {
+    OrderStatus.PENDING: {OrderStatus.APPROVED, OrderStatus.CAPTURED, OrderStatus.PAID, OrderStatus.EXPIRED},
+    OrderStatus.APPROVED: {OrderStatus.CAPTURED, OrderStatus.PAID, OrderStatus.EXPIRED},
+    OrderStatus.CAPTURED: {OrderStatus.PAID, OrderStatus.REFUNDED},
+    OrderStatus.PAID: {OrderStatus.REFUNDED},
+    OrderStatus.REFUNDED: set(),
+    OrderStatus.EXPIRED: {OrderStatus.CAPTURED, OrderStatus.PAID},
+}
+
+# Statuses that end the wait of a payment stream on the order EVENT
+ORDER_RELEASE_STATUSES = {OrderStatus.PAID, OrderStatus.REFUNDED, OrderStatus.EXPIRED}
+
+def can_transition(from_status: Any, to_status: Any) -> bool:
+    return OrderStatus.parse(to_status) in ORDER_TRANSITIONS.get(OrderStatus.parse(from_status), ())
+
+def minor_unit_digits(currency: str) -> int:
+    return CURRENCY_MINOR_UNIT_DIGITS_DICT.get((currency or "").upper(), CURRENCY_MINOR_UNIT_DIGITS_DEFAULT)
+
+def to_minor_units(amount: float, currency: str = CURRENCY_USD) -> int:
+    """
+    Amount in major units (e.g. 4.25 USD) to integer minor units (425 cents), rounded up as Stripe charges it.
+    """
+    ## round first, 0.07 * 100 is 7.000000000000001 in floats
+    return int(math.ceil(round(float(amount or 0) * 10 ** minor_unit_digits(currency), 6)))
+
+def to_major_units(amount_minor: int, currency: str = CURRENCY_USD) -> float:
+    digits = minor_unit_digits(currency)
+    return round(amount_minor / 10 ** digits, digits)
+
+class Order(MutableMapping):
+    """
+    Compact order record of PaymentAgent.orders.
+
+    The fields live in __slots__, the amount is kept as integer minor units and the status
+    as OrderStatus, which saves about 160 bytes per open order against the former dict
+    (see benchmarks/benchmark_order_memory.py).
+    Order is also a dict-compatible view keyed by the order constants, order[AMOUNT] is the
+    amount in major units as before, so workflows and webhook handlers written against the
+    dict layout (order.get(STATUS), order[EVENT] = ..., order.update(...)) keep working.
+    Keys outside the fixed fields are kept in a lazily created extra dict.
+    """
+    __slots__ = ("order_id", "amount_minor", "currency", "description", "status", "created", "expires",
+                 "version", "event", "extra")
+
+    _FIELDS = (ORDER_ID, AMOUNT, CURRENCY, DESCRIPTION, STATUS, CREATED, EXPIRES, VERSION, EVENT)
+
+    def __init__(self, order_id: str, amount_minor: int = 0, currency: str = CURRENCY_USD, description: str = "",
+                 status: Any = OrderStatus.PENDING, created: int = 0, expires: Optional[int] = None,
+                 event: Any = None, version: int = 0):
+        """
+        :param amount_minor: Amount in minor units of the currency, e.g. cents.
+        :param event: Optional asyncio.Event set once the order is paid or expired.
+        :param version: Number of status transitions so far, see OrderStore.transition().
+        """
+        self.order_id = order_id
+        self.amount_minor = int(amount_minor)
+        self.currency = currency
+        self.description = description
+        self.status = OrderStatus.parse(status)
+        self.created = created
+        self.expires = expires
+        self.version = version
+        self.event = event
+        self.extra = None
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "Order":
+        """
+        Order of a dict in the former layout, AMOUNT in major units.
+        """
+        currency = data.get(CURRENCY, CURRENCY_USD)
+        order = cls(data[ORDER_ID], to_minor_units(data.get(AMOUNT, 0), currency), currency,
+                    data.get(DESCRIPTION, ""), data.get(STATUS, STATUS_PENDING), data.get(CREATED, 0),
+                    data.get(EXPIRES), data.get(EVENT), data.get(VERSION) or 0)
+        for key, value in data.items():
+            if key not in cls._FIELDS:
+                order[key] = value
+        return order
+
+    def to_dict(self) -> Dict:
+        return dict(self.items())
+
+    @property
+    def amount(self) -> float:
+        return to_major_units(self.amount_minor, self.currency)
+
+    def __getitem__(self, key: str) -> Any:
+        if key == ORDER_ID:
+            return self.order_id
+        if key == AMOUNT:
+            return self.amount
+        if key == CURRENCY:
+            return self.currency
+        if key == DESCRIPTION:
+            return self.description
+        if key == STATUS:
+            return self.status
+        if key == CREATED:
+            return self.created
+        if key == EXPIRES:
+            return self.expires
+        if key == VERSION:
+            return self.version
+        if key == EVENT:
+            return self.event
+        if self.extra is not None and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key: str, value: Any):
+        if key == ORDER_ID:
+            self.order_id = value
+        elif key == AMOUNT:
+            self.amount_minor = to_minor_units(value, self.currency)
+        elif key == CURRENCY:
+            self.currency = value
+        elif key == DESCRIPTION:
+            self.description = value
+        elif key == STATUS:
+            self.status = OrderStatus.parse(value)
+        elif key == CREATED:
+            self.created = value
+        elif key == EXPIRES:
+            self.expires = value
+        elif key == VERSION:
+            self.version = value
+        elif key == EVENT:
+            self.event = value
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __delitem__(self, key: str):
+        if key in self._FIELDS:
+            raise KeyError(f"Order field {key} can not be deleted")
+        if self.extra is None or key not in self.extra:
+            raise KeyError(key)
+        del self.extra[key]
+
+    def __iter__(self):
+        yield from self._FIELDS
+        if self.extra:
+            yield from self.extra
+
+    def __len__(self) -> int:
+        return len(self._FIELDS) + (len(self.extra) if self.extra else 0)
+
+    def __contains__(self, key: Any) -> bool:
+        return key in self._FIELDS or (self.extra is not None and key in self.extra)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __repr__(self):
+        return (f"Order(order_id={self.order_id!r}, amount_minor={self.amount_minor}, currency={self.currency!r}, "
+                f"status={str(self.status)!r}, created={self.created}, expires={self.expires}, version={self.version})")
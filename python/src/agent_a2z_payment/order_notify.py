@@ -0,0 +1,114 @@
+import json
+import logging
+import os
+import socket
+import threading
+import uuid
+from typing import Callable, List
+
+class OrderNotifier:
+    """
+    Interface of the order status notifications between workers.
+    A worker publishes the new status and version of an order, every other worker sharing the
+    notifier receives it in its subscribed callbacks, callback(order_id, status, version).
+    """
+
+    def publish(self, order_id: str, status: str, version: int = 0):
+        raise NotImplementedError
+
+    def subscribe(self, callback: Callable[[str, str, int], None]):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class UnixSocketOrderNotifier(OrderNotifier):
+    """
+    Broker free notifier of the workers on one host.
+
+    Every worker binds a Unix datagram socket in socket_dir, publish() sends one datagram
+    to each other socket of the directory. Sockets of workers that are gone refuse the
+    datagram and are removed. Callbacks run on the listener thread of the notifier.
+    """
+
+    def __init__(self, socket_dir: str, recv_timeout: float = 0.5, send_timeout: float = 1.0):
+        """
+        :param socket_dir: Directory shared by the workers, e.g. next to the SQLite order database.
+        :param recv_timeout: Seconds the listener thread blocks before it checks for close().
+        :param send_timeout: Seconds publish() waits for room in the queue of a busy peer socket.
+        """
+        if not hasattr(socket, "AF_UNIX"):
+            raise RuntimeError("UnixSocketOrderNotifier needs Unix domain sockets")
+        os.makedirs(socket_dir, exist_ok=True)
+        self.socket_dir = socket_dir
+        ## short file name, the path of a unix socket is limited to ~100 bytes
+        self.socket_path = os.path.join(socket_dir, f"{os.getpid()}_{uuid.uuid4().hex[:6]}.sock")
+        self._callbacks: List[Callable[[str, str, int], None]] = []
+        self._closed = False
+
+        self._recv_sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._recv_sock.bind(self.socket_path)
+        self._recv_sock.settimeout(recv_timeout)
+        self._send_sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        ## a full peer queue blocks the send for a while instead of dropping the notification
+        self._send_sock.settimeout(send_timeout)
+        self._send_lock = threading.Lock()
+
+        self._listener = threading.Thread(target=self._listen_loop, name="order_notifier_listener", daemon=True)
+        self._listener.start()
+
+    def subscribe(self, callback: Callable[[str, str, int], None]):
+        self._callbacks.append(callback)
+
+    def publish(self, order_id: str, status: str, version: int = 0):
+        data = json.dumps({"order_id": order_id, "status": status, "version": version}).encode("utf-8")
+        for path in self._peer_paths():
+            try:
+                with self._send_lock:
+                    self._send_sock.sendto(data, path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                ## the worker of this socket exited without cleaning up
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            except OSError as e:
+                logging.error(f"UnixSocketOrderNotifier publish order {order_id} to {path} failed with error {e}")
+
+    def close(self):
+        self._closed = True
+        self._listener.join(timeout=2)
+        self._recv_sock.close()
+        self._send_sock.close()
+        try:
+            os.unlink(self.socket_path)
+        except OSError:
+            pass
+
+    def _peer_paths(self) -> List[str]:
+        try:
+            names = os.listdir(self.socket_dir)
+        except OSError:
+            return []
+        return [os.path.join(self.socket_dir, name) for name in names
+                if name.endswith(".sock") and os.path.join(self.socket_dir, name) != self.socket_path]
+
+    def _listen_loop(self):
+        while not self._closed:
+            try:
+                data = self._recv_sock.recv(65536)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            try:
+                message = json.loads(data.decode("utf-8"))
+                order_id, status, version = message["order_id"], message["status"], message.get("version", 0)
+            except Exception as e:
+                logging.error(f"UnixSocketOrderNotifier dropped malformed message with error {e}")
+                continue
+            for callback in self._callbacks:
+                try:
+                    callback(order_id, status, version)
+                except Exception as e:
+                    logging.error(f"UnixSocketOrderNotifier callback of order {order_id} failed with error {e}")
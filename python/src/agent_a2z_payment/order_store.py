@@ -0,0 +1,715 @@
+import asyncio
+import heapq
+import itertools
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Executor
+from typing import Dict, List, Optional, Any
+
+from .constants import *
+from .order import Order, OrderStatus, can_transition
+from .order_notify import OrderNotifier
+
+# Order fields persisted by the stores, EVENT (asyncio.Event) only lives in the process memory
+PERSISTED_ORDER_FIELDS = [ORDER_ID, AMOUNT, CURRENCY, DESCRIPTION, STATUS, CREATED, EXPIRES, VERSION]
+
+## transitions of different orders do not wait on each other, one lock per stripe of order ids
+ORDER_LOCK_STRIPES = 64
+
+class OrderStore:
+    """
+    Interface of the order store behind PaymentAgent.orders.
+    Orders are Order records, dict-compatible views with keys ORDER_ID, AMOUNT, CURRENCY,
+    DESCRIPTION, STATUS, CREATED, EXPIRES, EVENT, add() also accepts a plain dict. The store
+    also supports the read side of a dict (get, [], in, len), so existing callers of
+    payment_agent.orders keep working, writes go through add(), update() and transition().
+
+    Status changes follow the state machine ORDER_TRANSITIONS and go through transition(), a
+    compare-and-swap on the per order VERSION. Of concurrent or duplicate deliveries of one
+    event only the first changes the order, the others are cheap no-ops. transition() may touch
+    the database, async callers use atransition(), which runs it in an executor.
+
+    Provider object ids (PayPal order id, Stripe PaymentIntent and Checkout Session id) are
+    indexed by add_reference(), so webhooks carrying only the provider id resolve the order
+    with one find_order_id() lookup. The provider payment created per order and method
+    (client_secret, approval url, provider ids) is kept by save_payment(), so a repeated
+    checkout of the order reuses it instead of creating another one.
+
+    Status changes made by transition() are passed to the listeners of add_listener() and, with
+    a notifier, published to the stores of the other workers, which apply the status to
+    their in-memory copy and call their own listeners, e.g. to set the EVENT of a waiting stream.
+
+    Orders with an EXPIRES timestamp are tracked in a min-heap ordered by expiry, sweep() pops
+    the due entries only, expires pending orders with transition() and later drops them from the
+    process memory, so the cost of a sweep does not grow with the number of live orders.
+    """
+
+    def __init__(self, notifier: Optional[OrderNotifier] = None):
+        """
+        :param notifier: Optional OrderNotifier shared with the order stores of the other workers.
+        """
+        self._orders = {}
+        self._expiry_heap = []
+        self._expiry_lock = threading.Lock()
+        self._expired_count = 0
+        self._swept_count = 0
+        self._references = {}
+        self._order_references = {}
+        self._payments = {}
+        self._listeners = []
+        self._transition_locks = [threading.Lock() for _ in range(ORDER_LOCK_STRIPES)]
+        self.notifier = notifier
+        if notifier is not None:
+            notifier.subscribe(self._on_remote_status)
+
+    def add(self, order: Dict) -> Order:
+        raise NotImplementedError
+
+    def get(self, order_id: str, default: Any = None) -> Optional[Order]:
+        raise NotImplementedError
+
+    def update(self, order_id: str, **fields) -> Optional[Order]:
+        """
+        Updates fields of an order, e.g. update(order_id, expires=...).
+        A STATUS field is applied with transition(), see there.
+
+        :return: The updated order, None if the order is not found.
+        """
+        raise NotImplementedError
+
+    def transition(self, order_id: str, status: str, expected_version: Optional[int] = None) -> bool:
+        """
+        Atomically moves an order to status, if ORDER_TRANSITIONS allows it from the current
+        status and the VERSION still equals expected_version (if given). The version is bumped,
+        and the listeners and other workers are notified once, by the caller that won.
+
+        :return: True if this call changed the order, False for an unknown order, a duplicate
+            (the order is already in status) or a transition the state machine does not allow.
+        """
+        to_status = OrderStatus.parse(status)
+        with self._order_lock(order_id):
+            order = self.get(order_id)
+            if order is None:
+                return False
+            version = order.version
+            if not self._compare_and_swap(order, to_status, expected_version):
+                synced = order.version != version
+            else:
+                synced = None
+        if synced is None:
+            self._status_changed(order)
+            return True
+        if synced:
+            ## the copy caught up with a transition of another worker, e.g. paid, its waiters learn it here
+            self._call_listeners(order)
+        return False
+
+    async def atransition(self, order_id: str, status: str, expected_version: Optional[int] = None,
+                          executor: Optional[Executor] = None) -> bool:
+        """
+        transition() in executor (the loop's default if not set), the event loop never waits on the database.
+        """
+        return await asyncio.get_running_loop().run_in_executor(
+            executor, self.transition, order_id, status, expected_version)
+
+    def list_orders(self, status: Optional[str] = None, created_before: Optional[int] = None,
+                    limit: Optional[int] = None) -> List[Order]:
+        """
+        Orders filtered by status and created time, oldest first.
+        """
+        raise NotImplementedError
+
+    def add_reference(self, provider_ref: str, order_id: str, provider: str = ""):
+        """
+        Indexes a provider object id, e.g. add_reference(paypal_order_id, order_id, PAYMENT_METHOD_PAYPAL).
+        """
+        if provider_ref:
+            self._references[provider_ref] = order_id
+            self._order_references.setdefault(order_id, []).append(provider_ref)
+
+    def find_order_id(self, provider_ref: str) -> Optional[str]:
+        """
+        :return: The internal order id of a provider object id, None if it is not indexed.
+        """
+        return self._references.get(provider_ref) if provider_ref else None
+
+    def save_payment(self, order_id: str, method: str, payment: Dict):
+        """
+        Keeps the provider payment created for the order and method, e.g. the create_payment result
+        {"client_secret": ..., "publishable_key": ...} of PAYMENT_METHOD_CREDIT_CARD.
+        """
+        self._payments.setdefault(order_id, {})[method] = dict(payment)
+
+    def get_payment(self, order_id: str, method: str) -> Optional[Dict]:
+        """
+        :return: A copy of the payment saved for the order and method, None if there is none.
+        """
+        payment = self._payments.get(order_id, {}).get(method)
+        return dict(payment) if payment is not None else None
+
+    async def aget(self, order_id: str, executor: Optional[Executor] = None) -> Optional[Order]:
+        """
+        get() for async callers, stores reading a database on a miss run it in executor.
+        """
+        return self.get(order_id)
+
+    async def aget_payment(self, order_id: str, method: str, executor: Optional[Executor] = None) -> Optional[Dict]:
+        """
+        get_payment() for async callers, stores reading a database on a miss run it in executor.
+        """
+        return self.get_payment(order_id, method)
+
+    def sweep(self, now: Optional[int] = None, grace_seconds: int = ORDER_EXPIRE_GRACE_SECONDS) -> List[Order]:
+        """
+        Marks the pending orders whose EXPIRES is passed as expired, and drops the orders whose
+        EXPIRES is passed by more than grace_seconds from the process memory.
+
+        :param now: Unix timestamp, defaults to the current time.
+        :param grace_seconds: Seconds an order is kept in memory after EXPIRES, so late webhooks still find it.
+        :return: The orders moved from pending or approved to expired. The expiry is a transition(),
+            it loses to a concurrent payment, and the listeners and other workers are notified.
+        """
+        now = int(time.time()) if now is None else now
+        expired = []
+        swept = 0
+        while True:
+            with self._expiry_lock:
+                if not self._expiry_heap or self._expiry_heap[0][0] > now:
+                    break
+                due, order_id, evict = heapq.heappop(self._expiry_heap)
+            order = self._orders.get(order_id)
+            if order is None:
+                continue
+            expires = order.expires or 0
+            if not evict:
+                ## stale entry, the expiry was extended and pushed again
+                if expires > due:
+                    continue
+                while order.status in (OrderStatus.PENDING, OrderStatus.APPROVED):
+                    version = order.version
+                    if self.transition(order_id, OrderStatus.EXPIRED, expected_version=version):
+                        expired.append(order)
+                        break
+                    if order.version == version:
+                        break
+                    ## the copy was behind another worker, decide again on its current status
+                with self._expiry_lock:
+                    heapq.heappush(self._expiry_heap, (expires + grace_seconds, order_id, True))
+            elif expires + grace_seconds <= now:
+                self._evict(order_id)
+                swept += 1
+        with self._expiry_lock:
+            self._expired_count += len(expired)
+            self._swept_count += swept
+        return expired
+
+    def stats(self) -> Dict:
+        """
+        Order counters for metrics: live orders in memory, orders expired and swept so far.
+        """
+        with self._expiry_lock:
+            return {"live": len(self._orders), "tracked": len(self._expiry_heap),
+                    "expired": self._expired_count, "swept": self._swept_count}
+
+    def add_listener(self, callback):
+        """
+        :param callback: callback(order), called when the status of an order changes in this or another worker.
+        """
+        self._listeners.append(callback)
+
+    def close(self):
+        if self.notifier is not None:
+            self.notifier.close()
+
+    def _order_lock(self, order_id: str) -> threading.Lock:
+        return self._transition_locks[hash(order_id) % ORDER_LOCK_STRIPES]
+
+    def _compare_and_swap(self, order: Order, to_status: Any, expected_version: Optional[int]) -> bool:
+        """
+        Applies a transition to the order, called under the lock of the order.
+        """
+        if expected_version is not None and order.version != expected_version:
+            return False
+        if not can_transition(order.status, to_status):
+            return False
+        order.status = to_status
+        order.version += 1
+        return True
+
+    def _status_changed(self, order: Order):
+        self._call_listeners(order)
+        if self.notifier is not None:
+            self.notifier.publish(order.order_id, str(order.status), order.version)
+
+    def _on_remote_status(self, order_id: str, status: str, version: int):
+        ## only the workers holding the order in memory have waiters on it
+        order = self._orders.get(order_id)
+        if order is None:
+            return
+        with self._order_lock(order_id):
+            ## an older or already applied transition
+            if version < order.version or (version == order.version and order.status == status):
+                return
+            order.status = OrderStatus.parse(status)
+            order.version = version
+        self._call_listeners(order)
+
+    def _call_listeners(self, order: Order):
+        for callback in self._listeners:
+            try:
+                callback(order)
+            except Exception as e:
+                logging.error(f"OrderStore listener of order {order.order_id} failed with error {e}")
+
+    @staticmethod
+    def _to_order(order: Dict) -> Order:
+        return order if isinstance(order, Order) else Order.from_dict(order)
+
+    def _track_expiry(self, order: Order):
+        if order.expires:
+            with self._expiry_lock:
+                heapq.heappush(self._expiry_heap, (order.expires, order.order_id, False))
+
+    def _evict(self, order_id: str):
+        self._orders.pop(order_id, None)
+        self._evict_references(order_id)
+
+    def _evict_references(self, order_id: str):
+        for provider_ref in self._order_references.pop(order_id, []):
+            self._references.pop(provider_ref, None)
+        self._payments.pop(order_id, None)
+
+    def __getitem__(self, order_id: str) -> Order:
+        order = self.get(order_id)
+        if order is None:
+            raise KeyError(order_id)
+        return order
+
+    def __contains__(self, order_id: str) -> bool:
+        return self.get(order_id) is not None
+
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+class InMemoryOrderStore(OrderStore):
+    """
+    Default store, a plain dict of the process. Orders are lost on restart,
+    and swept orders are gone for good.
+    """
+
+    def __init__(self, notifier: Optional[OrderNotifier] = None):
+        super().__init__(notifier=notifier)
+
+    def add(self, order: Dict) -> Order:
+        order = self._to_order(order)
+        self._orders[order.order_id] = order
+        self._track_expiry(order)
+        return order
+
+    def get(self, order_id: str, default: Any = None) -> Optional[Order]:
+        return self._orders.get(order_id, default)
+
+    def update(self, order_id: str, **fields) -> Optional[Order]:
+        order = self._orders.get(order_id)
+        if order is None:
+            return None
+        status = fields.pop(STATUS, None)
+        order.update(fields)
+        if EXPIRES in fields:
+            self._track_expiry(order)
+        if status is not None:
+            self.transition(order_id, status)
+        return order
+
+    def list_orders(self, status: Optional[str] = None, created_before: Optional[int] = None,
+                    limit: Optional[int] = None) -> List[Order]:
+        orders = [order for order in self._orders.values()
+                  if (status is None or order.get(STATUS) == status)
+                  and (created_before is None or order.get(CREATED, 0) < created_before)]
+        orders.sort(key=lambda order: (order.created or 0, order.order_id))
+        return orders[:limit] if limit is not None else orders
+
+    def __len__(self) -> int:
+        return len(self._orders)
+
+CREATE_ORDERS_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS orders (
+    order_id TEXT PRIMARY KEY,  -- Internal order id, e.g. order_xxx
+    amount REAL NOT NULL,
+    currency TEXT NOT NULL,
+    description TEXT,
+    status TEXT NOT NULL,       -- pending, paid, ...
+    created INTEGER NOT NULL,   -- Unix timestamp of create_order
+    expires INTEGER,            -- Unix timestamp after which a pending order is expired
+    version INTEGER NOT NULL DEFAULT 0,  -- Number of status transitions, compare-and-swap guard
+    updated INTEGER NOT NULL
+);
+"""
+
+CREATE_ORDERS_INDEX_SQL = [
+    "CREATE INDEX IF NOT EXISTS idx_orders_status_created ON orders (status, created);",
+    "CREATE INDEX IF NOT EXISTS idx_orders_created ON orders (created);",
+    "CREATE INDEX IF NOT EXISTS idx_orders_status_expires ON orders (status, expires);",
+]
+
+CREATE_ORDER_REFERENCES_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS order_references (
+    provider_ref TEXT PRIMARY KEY,  -- PayPal order id, Stripe PaymentIntent id (pi_xxx) or Checkout Session id (cs_xxx)
+    order_id TEXT NOT NULL,
+    provider TEXT,
+    created INTEGER NOT NULL
+);
+"""
+
+UPSERT_ORDER_REFERENCE_SQL = """
+INSERT INTO order_references (provider_ref, order_id, provider, created) VALUES (?, ?, ?, ?)
+ON CONFLICT(provider_ref) DO UPDATE SET order_id = excluded.order_id, provider = excluded.provider;
+"""
+
+CREATE_ORDER_PAYMENTS_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS order_payments (
+    order_id TEXT NOT NULL,
+    method TEXT NOT NULL,
+    payment TEXT NOT NULL,  -- JSON of the create_payment result, client_secret, approval url, provider ids
+    created INTEGER NOT NULL,
+    PRIMARY KEY (order_id, method)
+);
+"""
+
+UPSERT_ORDER_PAYMENT_SQL = """
+INSERT INTO order_payments (order_id, method, payment, created) VALUES (?, ?, ?, ?)
+ON CONFLICT(order_id, method) DO UPDATE SET payment = excluded.payment, created = excluded.created;
+"""
+
+## databases created before these columns
+ADD_ORDERS_COLUMNS_SQL = {
+    EXPIRES: "ALTER TABLE orders ADD COLUMN expires INTEGER;",
+    VERSION: "ALTER TABLE orders ADD COLUMN version INTEGER NOT NULL DEFAULT 0;",
+}
+
+## only orders past EXPIRES plus the grace period, which no worker holds in memory any more
+EXPIRE_ORDERS_SQL = """
+UPDATE orders SET status = ?, version = version + 1, updated = ?
+WHERE status IN (?, ?) AND expires IS NOT NULL AND expires <= ?;
+"""
+
+SELECT_ORDER_STATUS_SQL = "SELECT status, version FROM orders WHERE order_id = ?;"
+
+TRANSITION_ORDER_SQL = "UPDATE orders SET status = ?, version = ?, updated = ? WHERE order_id = ? AND version = ?;"
+
+UPSERT_ORDER_SQL = """
+INSERT INTO orders (order_id, amount, currency, description, status, created, expires, version, updated)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT(order_id) DO UPDATE SET
+    amount = excluded.amount,
+    currency = excluded.currency,
+    description = excluded.description,
+    -- only a newer version moves the status, a stale copy of another worker must not undo a transition
+    status = CASE WHEN excluded.version > orders.version THEN excluded.status ELSE orders.status END,
+    version = MAX(orders.version, excluded.version),
+    expires = excluded.expires,
+    updated = excluded.updated;
+"""
+
+class SQLiteOrderStore(OrderStore):
+    """
+    Persistent order store on SQLite in WAL mode, indexed by order_id, status and created time.
+
+    Writes are write-behind: add() and update() change the in-process copy of the order at once
+    and queue the row, a writer thread commits the queued rows in one transaction every
+    flush_interval seconds or once batch_size rows are queued. The request path never waits
+    for a commit, a crash can lose at most the last flush_interval seconds of writes.
+    Orders of this process are served from memory, other orders (e.g. after a restart) are
+    read from the database. Swept orders stay in the table as the archive, only the
+    in-memory copies are dropped.
+    Several workers (uvicorn/gunicorn processes) can share one database, with a notifier a
+    webhook handled by any worker wakes the stream waiting on the order in another worker.
+    """
+
+    def __init__(self, db_path: str, flush_interval: float = 0.2, batch_size: int = 256,
+                 notifier: Optional[OrderNotifier] = None):
+        """
+        :param db_path: Path of the SQLite database file, shared by the workers of one host.
+        :param flush_interval: Maximum seconds a write waits in the queue.
+        :param batch_size: Number of queued rows that triggers a flush before flush_interval.
+        :param notifier: Optional OrderNotifier of the workers sharing db_path, e.g. UnixSocketOrderNotifier.
+        """
+        self.db_path = db_path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        super().__init__(notifier=notifier)
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._flushed = threading.Condition()
+        self._enqueued = 0
+        self._written = 0
+
+        conn = self._connect()
+        conn.execute(CREATE_ORDERS_TABLE_SQL)
+        conn.execute(CREATE_ORDER_REFERENCES_TABLE_SQL)
+        conn.execute(CREATE_ORDER_PAYMENTS_TABLE_SQL)
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(orders);")]
+        for column, sql in ADD_ORDERS_COLUMNS_SQL.items():
+            if column not in columns:
+                conn.execute(sql)
+        for sql in CREATE_ORDERS_INDEX_SQL:
+            conn.execute(sql)
+        conn.commit()
+        conn.close()
+
+        self._read_conn = self._connect()
+        self._read_lock = threading.Lock()
+        self._writer = threading.Thread(target=self._write_loop, name="sqlite_order_store_writer", daemon=True)
+        self._writer.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL;")
+        # WAL + NORMAL: commits do not fsync, the WAL is synced at checkpoints
+        conn.execute("PRAGMA synchronous=NORMAL;")
+        return conn
+
+    def add(self, order: Dict) -> Order:
+        order = self._to_order(order)
+        with self._lock:
+            self._orders[order.order_id] = order
+        self._track_expiry(order)
+        self._enqueue(order)
+        return order
+
+    def get(self, order_id: str, default: Any = None) -> Optional[Order]:
+        order = self._orders.get(order_id)
+        if order is not None:
+            return order
+        order = self._load(order_id)
+        if order is None:
+            return default
+        with self._lock:
+            cached = self._orders.get(order_id)
+            if cached is None:
+                self._orders[order_id] = order
+        if cached is not None:
+            return cached
+        self._track_expiry(order)
+        return order
+
+    def update(self, order_id: str, **fields) -> Optional[Order]:
+        order = self.get(order_id)
+        if order is None:
+            return None
+        status = fields.pop(STATUS, None)
+        if fields:
+            order.update(fields)
+            if EXPIRES in fields:
+                self._track_expiry(order)
+            self._enqueue(order)
+        if status is not None:
+            self.transition(order_id, status)
+        return order
+
+    def list_orders(self, status: Optional[str] = None, created_before: Optional[int] = None,
+                    limit: Optional[int] = None) -> List[Order]:
+        self.flush()
+        sql = f"SELECT {', '.join(PERSISTED_ORDER_FIELDS)} FROM orders WHERE 1 = 1"
+        params = []
+        if status is not None:
+            sql += " AND status = ?"
+            params.append(status)
+        if created_before is not None:
+            sql += " AND created < ?"
+            params.append(created_before)
+        sql += " ORDER BY created ASC, order_id ASC"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        with self._read_lock:
+            rows = self._read_conn.execute(sql, tuple(params)).fetchall()
+        ## prefer the in-process copies, they hold the events
+        return [self._orders.get(row[0]) or self._row_to_order(row) for row in rows]
+
+    def add_reference(self, provider_ref: str, order_id: str, provider: str = ""):
+        if not provider_ref:
+            return
+        super().add_reference(provider_ref, order_id, provider)
+        self._put(UPSERT_ORDER_REFERENCE_SQL, (provider_ref, order_id, provider, int(time.time())))
+
+    def find_order_id(self, provider_ref: str) -> Optional[str]:
+        order_id = super().find_order_id(provider_ref)
+        if order_id is not None or not provider_ref:
+            return order_id
+        ## indexed by another worker or before a restart, the primary key lookup of the table
+        with self._read_lock:
+            row = self._read_conn.execute(
+                "SELECT order_id FROM order_references WHERE provider_ref = ?", (provider_ref,)).fetchone()
+        return row[0] if row is not None else None
+
+    def save_payment(self, order_id: str, method: str, payment: Dict):
+        super().save_payment(order_id, method, payment)
+        self._put(UPSERT_ORDER_PAYMENT_SQL, (order_id, method, json.dumps(payment), int(time.time())))
+
+    def get_payment(self, order_id: str, method: str) -> Optional[Dict]:
+        payment = super().get_payment(order_id, method)
+        if payment is not None:
+            return payment
+        ## saved by another worker or before a restart
+        with self._read_lock:
+            row = self._read_conn.execute(
+                "SELECT payment FROM order_payments WHERE order_id = ? AND method = ?", (order_id, method)).fetchone()
+        if row is None:
+            return None
+        payment = json.loads(row[0])
+        if order_id in self._orders:
+            super().save_payment(order_id, method, payment)
+        return payment
+
+    async def aget(self, order_id: str, executor: Optional[Executor] = None) -> Optional[Order]:
+        ## the in-memory copy without a thread hop, the table lookup of a miss off the event loop
+        order = self._orders.get(order_id)
+        if order is not None:
+            return order
+        return await asyncio.get_running_loop().run_in_executor(executor, self.get, order_id)
+
+    async def aget_payment(self, order_id: str, method: str, executor: Optional[Executor] = None) -> Optional[Dict]:
+        payment = OrderStore.get_payment(self, order_id, method)
+        if payment is not None:
+            return payment
+        return await asyncio.get_running_loop().run_in_executor(executor, self.get_payment, order_id, method)
+
+    def sweep(self, now: Optional[int] = None, grace_seconds: int = ORDER_EXPIRE_GRACE_SECONDS) -> List[Order]:
+        """
+        Sweeps the in-memory orders, then expires in the table the pending orders past EXPIRES by
+        more than grace_seconds, e.g. orders created before a restart. Every worker drops its orders
+        from memory after grace_seconds, so no live worker holds a copy of these rows.
+        """
+        now = int(time.time()) if now is None else now
+        expired = super().sweep(now=now, grace_seconds=grace_seconds)
+        self.flush()
+        with self._read_lock:
+            with self._read_conn:
+                self._read_conn.execute(EXPIRE_ORDERS_SQL, (STATUS_EXPIRED, now, STATUS_PENDING, STATUS_APPROVED,
+                                                            now - grace_seconds))
+        return expired
+
+    def _compare_and_swap(self, order: Order, to_status: Any, expected_version: Optional[int]) -> bool:
+        """
+        Compare-and-swap on the table row, so concurrent transitions of the workers sharing the
+        database serialize on the version: the UPDATE only matches the version it was decided on.
+        Other queued writes are not waited for, an order whose row is still queued is upserted
+        first on the read connection, the queued copy is older and does not move the status back.
+        """
+        while True:
+            with self._read_lock:
+                row = self._read_conn.execute(SELECT_ORDER_STATUS_SQL, (order.order_id,)).fetchone()
+                if row is None:
+                    with self._read_conn:
+                        self._read_conn.execute(UPSERT_ORDER_SQL, self._order_row(order))
+                    row = self._read_conn.execute(SELECT_ORDER_STATUS_SQL, (order.order_id,)).fetchone()
+            if row is None:
+                ## not persisted, e.g. the database failed, decide on the in-process copy
+                if not super()._compare_and_swap(order, to_status, expected_version):
+                    return False
+                self._enqueue(order)
+                return True
+            ## another worker may be ahead of the in-process copy
+            db_status, db_version = OrderStatus.parse(row[0]), row[1]
+            if db_version > order.version:
+                order.status, order.version = db_status, db_version
+            if expected_version is not None and db_version != expected_version:
+                return False
+            if not can_transition(db_status, to_status):
+                return False
+            with self._read_lock:
+                with self._read_conn:
+                    cursor = self._read_conn.execute(TRANSITION_ORDER_SQL, (
+                        str(to_status), db_version + 1, int(time.time()), order.order_id, db_version))
+            if cursor.rowcount == 1:
+                order.status, order.version = to_status, db_version + 1
+                return True
+            ## lost the race to another worker, decide again on its result
+
+    def flush(self):
+        """
+        Blocks until every write queued so far is committed.
+        """
+        with self._flushed:
+            target = self._enqueued
+            while self._written < target and self._writer.is_alive():
+                self._flushed.wait(timeout=self.flush_interval)
+
+    def close(self):
+        self.flush()
+        self._queue.put(None)
+        self._writer.join(timeout=5)
+        with self._read_lock:
+            self._read_conn.close()
+        super().close()
+
+    def __len__(self) -> int:
+        self.flush()
+        with self._read_lock:
+            return self._read_conn.execute("SELECT COUNT(*) FROM orders").fetchone()[0]
+
+    def _enqueue(self, order: Order):
+        self._put(UPSERT_ORDER_SQL, self._order_row(order))
+
+    @staticmethod
+    def _order_row(order: Order) -> tuple:
+        return (order.order_id, order.amount, order.currency, order.description, str(order.status),
+                order.created or int(time.time()), order.expires, order.version, int(time.time()))
+
+    def _put(self, sql: str, params: tuple):
+        with self._flushed:
+            self._enqueued += 1
+        self._queue.put((sql, params))
+
+    def _evict(self, order_id: str):
+        with self._lock:
+            self._orders.pop(order_id, None)
+        ## the tables keep the references and payments, find_order_id() and get_payment() reload them
+        self._evict_references(order_id)
+
+    def _load(self, order_id: str) -> Optional[Order]:
+        with self._read_lock:
+            row = self._read_conn.execute(
+                f"SELECT {', '.join(PERSISTED_ORDER_FIELDS)} FROM orders WHERE order_id = ?", (order_id,)).fetchone()
+        return self._row_to_order(row) if row is not None else None
+
+    @staticmethod
+    def _row_to_order(row) -> Order:
+        return Order.from_dict(dict(zip(PERSISTED_ORDER_FIELDS, row)))
+
+    def _write_loop(self):
+        conn = self._connect()
+        stop = False
+        while not stop:
+            batch = []
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+                deadline = time.time() + self.flush_interval
+                while item is not None:
+                    batch.append(item)
+                    if len(batch) >= self.batch_size or time.time() >= deadline:
+                        break
+                    try:
+                        item = self._queue.get(timeout=max(0.0, deadline - time.time()))
+                    except queue.Empty:
+                        break
+                stop = item is None
+            except queue.Empty:
+                pass
+            if batch:
+                try:
+                    with conn:
+                        ## one executemany per run of the same statement, in queue order
+                        for sql, items in itertools.groupby(batch, key=lambda item: item[0]):
+                            conn.executemany(sql, [params for _, params in items])
+                except Exception as e:
+                    logging.error(f"SQLiteOrderStore write of {len(batch)} rows failed with error {e}")
+            with self._flushed:
+                self._written += len(batch)
+                self._flushed.notify_all()
+        conn.close()
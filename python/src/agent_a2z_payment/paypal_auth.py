@@ -0,0 +1,257 @@
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from typing import Dict, Optional, Set, Tuple
+
+import httpx
+import requests
+
+from .constants import *
+from .http_client import AsyncProviderHttpClient, ProviderHttpClient, get_default_http_client
+
+PAYPAL_BASE_URL_SANDBOX = "https://api-m.sandbox.paypal.com"
+PAYPAL_BASE_URL_LIVE = "https://api-m.paypal.com"
+
+def paypal_base_url(environment: str, base_url: Optional[str] = None) -> str:
+    """
+    :param environment: "sandbox" or "production".
+    :param base_url: Optional override, e.g. a local mock PayPal server.
+    """
+    if base_url:
+        return base_url.rstrip("/")
+    return PAYPAL_BASE_URL_SANDBOX if environment == "sandbox" else PAYPAL_BASE_URL_LIVE
+
+class PayPalTokenCache:
+    """
+    Cache of PayPal OAuth access tokens per (client_id, environment, base_url).
+
+    A token is served until expires_in runs out. Inside the last refresh_ahead_seconds of its
+    life it is still served, and one background thread fetches its successor, so callers do not
+    wait for the token round trip. Concurrent callers without a usable token share a single
+    in-flight token request (single-flight) instead of each requesting one.
+    """
+
+    def __init__(self, refresh_ahead_seconds: float = 300.0, expiry_margin_seconds: float = 30.0,
+                 wait_timeout: float = 30.0):
+        """
+        :param refresh_ahead_seconds: Seconds before expiry a background refresh starts.
+        :param expiry_margin_seconds: Seconds before expires_in a token is no longer served.
+        :param wait_timeout: Seconds a caller waits for the in-flight token request of another caller.
+        """
+        self.refresh_ahead_seconds = refresh_ahead_seconds
+        self.expiry_margin_seconds = expiry_margin_seconds
+        self.wait_timeout = wait_timeout
+        self._tokens: Dict[Tuple, Tuple[str, float]] = {}
+        self._inflight: Dict[Tuple, Future] = {}
+        ## background refreshes of the async callers, referenced until done
+        self._refresh_tasks: Set[asyncio.Task] = set()
+        self._lock = threading.Lock()
+        self._fetch_count = 0
+        self._hit_count = 0
+
+    def get_token(self, client_id: str, client_secret: str, environment: str,
+                  http_client: Optional[ProviderHttpClient] = None, base_url: Optional[str] = None) -> Optional[str]:
+        """
+        :return: A valid access token, None if PayPal did not issue one.
+        """
+        key = (client_id, environment, paypal_base_url(environment, base_url))
+        now = time.time()
+        with self._lock:
+            cached = self._tokens.get(key)
+            if cached is not None and now < cached[1] - self.expiry_margin_seconds:
+                self._hit_count += 1
+                if now >= cached[1] - self.refresh_ahead_seconds and key not in self._inflight:
+                    ## still valid, the successor is fetched in the background
+                    future = self._inflight[key] = Future()
+                    threading.Thread(target=self._fetch, args=(key, client_secret, http_client, future),
+                                     name="paypal_token_refresh", daemon=True).start()
+                return cached[0]
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+        if owner:
+            self._fetch(key, client_secret, http_client, future)
+        try:
+            return future.result(timeout=self.wait_timeout)
+        except Exception as e:
+            logging.error(f"PayPalTokenCache waiting for the token request failed with error {e}")
+            return None
+
+    async def aget_token(self, client_id: str, client_secret: str, environment: str,
+                         http_client: AsyncProviderHttpClient, base_url: Optional[str] = None) -> Optional[str]:
+        """
+        Async get_token, the token request runs on the event loop through the async client.
+        Shares the cached tokens and the in-flight token requests with the sync callers.
+
+        :return: A valid access token, None if PayPal did not issue one.
+        """
+        key = (client_id, environment, paypal_base_url(environment, base_url))
+        now = time.time()
+        with self._lock:
+            cached = self._tokens.get(key)
+            if cached is not None and now < cached[1] - self.expiry_margin_seconds:
+                self._hit_count += 1
+                if now >= cached[1] - self.refresh_ahead_seconds and key not in self._inflight:
+                    future = self._inflight[key] = Future()
+                    task = asyncio.get_running_loop().create_task(self._afetch(key, client_secret, http_client, future))
+                    self._refresh_tasks.add(task)
+                    task.add_done_callback(self._refresh_tasks.discard)
+                return cached[0]
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+        if owner:
+            await self._afetch(key, client_secret, http_client, future)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout=self.wait_timeout)
+        except Exception as e:
+            logging.error(f"PayPalTokenCache waiting for the token request failed with error {e}")
+            return None
+
+    def invalidate(self, client_id: str, environment: str, token: Optional[str] = None, base_url: Optional[str] = None):
+        """
+        Drops the cached token, e.g. after a 401. With token set, only if it is still the cached one,
+        so a token already refreshed by another caller is kept.
+        """
+        key = (client_id, environment, paypal_base_url(environment, base_url))
+        with self._lock:
+            cached = self._tokens.get(key)
+            if cached is not None and (token is None or cached[0] == token):
+                del self._tokens[key]
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"tokens": len(self._tokens), "fetches": self._fetch_count, "hits": self._hit_count,
+                    "inflight": len(self._inflight)}
+
+    def _fetch(self, key: Tuple, client_secret: str, http_client: Optional[ProviderHttpClient], future: Future):
+        client_id, environment, base_url = key
+        token, expires_in = None, 0
+        try:
+            token, expires_in = _fetch_paypal_access_token(client_id, client_secret, base_url, http_client)
+        except Exception as e:
+            ## e.g. a malformed token response, the owner and the waiters fail as on a request error
+            logging.error(f"PayPalTokenCache token request failed with error {e}")
+        finally:
+            self._complete(key, token, expires_in, future)
+
+    async def _afetch(self, key: Tuple, client_secret: str, http_client: AsyncProviderHttpClient, future: Future):
+        client_id, environment, base_url = key
+        token, expires_in = None, 0
+        try:
+            token, expires_in = await _afetch_paypal_access_token(client_id, client_secret, base_url, http_client)
+        except Exception as e:
+            logging.error(f"PayPalTokenCache token request failed with error {e}")
+        finally:
+            self._complete(key, token, expires_in, future)
+
+    def _complete(self, key: Tuple, token: Optional[str], expires_in: float, future: Future):
+        with self._lock:
+            self._fetch_count += 1
+            if token:
+                self._tokens[key] = (token, time.time() + expires_in)
+            self._inflight.pop(key, None)
+        future.set_result(token)
+
+def _fetch_paypal_access_token(client_id: str, client_secret: str, base_url: str,
+                               http_client: Optional[ProviderHttpClient] = None) -> Tuple[Optional[str], float]:
+    """
+    Requests a new access token from PayPal.
+
+    :return: (access_token, expires_in seconds), (None, 0) on failure.
+    """
+    http_client = http_client or get_default_http_client()
+    token_url = f"{base_url}/v1/oauth2/token"
+
+    # PayPal uses Basic Auth for token request
+    try:
+        response = http_client.post(
+            token_url,
+            headers={"Content-Type": "application/x-www-form-urlencoded"},
+            data="grant_type=client_credentials",
+            auth=(client_id, client_secret)
+        )
+        response.raise_for_status()
+        token_data = response.json()
+        return token_data.get(KEY_PAYPAL_ACCESS_TOKEN), float(token_data.get("expires_in", 0) or 0)
+    except requests.exceptions.RequestException as e:
+        logging.error(f"_fetch_paypal_access_token PayPal Token Request Failed: {e}")
+        return None, 0
+
+async def _afetch_paypal_access_token(client_id: str, client_secret: str, base_url: str,
+                                     http_client: AsyncProviderHttpClient) -> Tuple[Optional[str], float]:
+    """
+    Async _fetch_paypal_access_token.
+
+    :return: (access_token, expires_in seconds), (None, 0) on failure.
+    """
+    token_url = f"{base_url}/v1/oauth2/token"
+    try:
+        response = await http_client.post(
+            token_url,
+            headers={"Content-Type": "application/x-www-form-urlencoded"},
+            data="grant_type=client_credentials",
+            auth=(client_id, client_secret)
+        )
+        response.raise_for_status()
+        token_data = response.json()
+        return token_data.get(KEY_PAYPAL_ACCESS_TOKEN), float(token_data.get("expires_in", 0) or 0)
+    except httpx.HTTPError as e:
+        logging.error(f"_afetch_paypal_access_token PayPal Token Request Failed: {e}")
+        return None, 0
+
+# Process wide token cache of the PayPal calls
+PAYPAL_TOKEN_CACHE = PayPalTokenCache()
+
+def paypal_request(method: str, url: str, client_id: str, client_secret: str, environment: str,
+                   http_client: Optional[ProviderHttpClient] = None, base_url: Optional[str] = None,
+                   token_cache: Optional[PayPalTokenCache] = None, **kwargs) -> requests.Response:
+    """
+    Authorized PayPal API call with a cached token. On a 401 the token is invalidated and the
+    call is retried once with a fresh token.
+
+    :param url: Full url of the API, e.g. f"{paypal_base_url(environment)}/v2/checkout/orders".
+    :raise Exception: If no access token is available.
+    """
+    http_client = http_client or get_default_http_client()
+    token_cache = token_cache or PAYPAL_TOKEN_CACHE
+    headers = dict(kwargs.pop("headers", None) or {})
+    response = None
+    for attempt in range(2):
+        token = token_cache.get_token(client_id, client_secret, environment, http_client=http_client, base_url=base_url)
+        if not token:
+            raise Exception("paypal_request Could not retrieve PayPal access token.")
+        headers["Authorization"] = f"Bearer {token}"
+        response = http_client.request(method, url, headers=headers, **kwargs)
+        if response.status_code != 401:
+            return response
+        logging.warning(f"paypal_request {url} returned 401, invalidating the cached access token")
+        token_cache.invalidate(client_id, environment, token=token, base_url=base_url)
+    return response
+
+async def apaypal_request(method: str, url: str, client_id: str, client_secret: str, environment: str,
+                          http_client: AsyncProviderHttpClient, base_url: Optional[str] = None,
+                          token_cache: Optional[PayPalTokenCache] = None, **kwargs) -> httpx.Response:
+    """
+    Async paypal_request on the async client, same 401 handling.
+
+    :raise Exception: If no access token is available.
+    """
+    token_cache = token_cache or PAYPAL_TOKEN_CACHE
+    headers = dict(kwargs.pop("headers", None) or {})
+    response = None
+    for attempt in range(2):
+        token = await token_cache.aget_token(client_id, client_secret, environment, http_client=http_client, base_url=base_url)
+        if not token:
+            raise Exception("apaypal_request Could not retrieve PayPal access token.")
+        headers["Authorization"] = f"Bearer {token}"
+        response = await http_client.request(method, url, headers=headers, **kwargs)
+        if response.status_code != 401:
+            return response
+        logging.warning(f"apaypal_request {url} returned 401, invalidating the cached access token")
+        token_cache.invalidate(client_id, environment, token=token, base_url=base_url)
+    return response
@@ -0,0 +1,292 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from .constants import *
+from .retry_policy import RetryPolicy
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling a provider whose circuit is open.
+    """
+
+    def __init__(self, method: str, retry_in: float):
+        super().__init__(f"Payment method {method} circuit is open, retry in {retry_in:.1f}s")
+        self.method = method
+        self.retry_in = retry_in
+
+class CircuitBreaker:
+    """
+    Circuit breaker of one payment provider over a rolling window of its latest calls.
+
+    closed: calls pass, the circuit opens once the window holds min_calls and the error rate
+        reaches failure_rate. open: calls fail fast for reset_seconds. half_open: one probe call
+        passes, its success closes the circuit and its failure opens it again.
+
+    A call slower than its deadline counts as a failure, the checkout did not get its payment.
+    """
+
+    def __init__(self, name: str, window_size: int = CIRCUIT_WINDOW_SIZE_DEFAULT,
+                 min_calls: int = CIRCUIT_MIN_CALLS_DEFAULT, failure_rate: float = CIRCUIT_FAILURE_RATE_DEFAULT,
+                 reset_seconds: float = CIRCUIT_RESET_SECONDS_DEFAULT):
+        """
+        :param name: Payment method of the provider.
+        :param window_size: Latest calls the error rate and latency are computed over.
+        :param min_calls: Calls in the window before the error rate can open the circuit.
+        :param failure_rate: Error rate opening the circuit, 0.5 is one call in two failing.
+        :param reset_seconds: Seconds an open circuit fails fast before letting a probe call through.
+        """
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.reset_seconds = reset_seconds
+        ## (ok, latency seconds) of the latest calls
+        self._window = deque(maxlen=window_size)
+        self._state = CIRCUIT_CLOSED
+        self._opened_at = 0.0
+        self._probing = False
+        self._calls = 0
+        self._failures = 0
+        self._rejected = 0
+        self._opened = 0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state()
+
+    def allow(self) -> bool:
+        """
+        Whether a call may go to the provider now. In half_open the first caller gets the probe.
+        """
+        with self._lock:
+            state = self._current_state()
+            if state == CIRCUIT_CLOSED:
+                return True
+            if state == CIRCUIT_HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            self._rejected += 1
+            return False
+
+    def retry_in(self) -> float:
+        with self._lock:
+            if self._state != CIRCUIT_OPEN:
+                return 0.0
+            return max(0.0, self._opened_at + self.reset_seconds - time.monotonic())
+
+    def record(self, ok: bool, latency: float):
+        """
+        :param ok: The provider returned a payment in time.
+        :param latency: Seconds the call took.
+        """
+        with self._lock:
+            self._calls += 1
+            self._failures += 0 if ok else 1
+            self._window.append((ok, latency))
+            state = self._current_state()
+            if state == CIRCUIT_OPEN:
+                ## a call started before the circuit opened, the probe decides
+                return
+            if state == CIRCUIT_HALF_OPEN:
+                self._probing = False
+                if ok:
+                    self._state = CIRCUIT_CLOSED
+                    self._window.clear()
+                    self._window.append((ok, latency))
+                else:
+                    self._open()
+                return
+            failures = sum(1 for call_ok, _ in self._window if not call_ok)
+            if len(self._window) >= self.min_calls and failures >= self.failure_rate * len(self._window):
+                logging.warning(f"CircuitBreaker {self.name} opened, {failures} of the last {len(self._window)} calls failed")
+                self._open()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            latencies = sorted(latency for _, latency in self._window)
+            failures = sum(1 for ok, _ in self._window if not ok)
+            state = self._current_state()
+            return {
+                "state": state,
+                "error_rate": round(failures / len(self._window), 3) if self._window else 0.0,
+                "p50_ms": round(latencies[len(latencies) // 2] * 1000, 1) if latencies else 0.0,
+                "p95_ms": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000, 1) if latencies else 0.0,
+                "window": len(self._window),
+                "calls": self._calls,
+                "failures": self._failures,
+                "rejected": self._rejected,
+                "opened": self._opened,
+                "retry_in": round(max(0.0, self._opened_at + self.reset_seconds - time.monotonic()), 1)
+                if state == CIRCUIT_OPEN else 0.0
+            }
+
+    def health_key(self):
+        """
+        Sort key of the healthiest provider first: closed circuits, then lower error rate and latency.
+        """
+        stats = self.stats()
+        return (CIRCUIT_STATES.index(stats["state"]), stats["error_rate"], stats["p50_ms"])
+
+    def _open(self):
+        self._state = CIRCUIT_OPEN
+        self._opened_at = time.monotonic()
+        self._opened += 1
+
+    def _current_state(self) -> str:
+        if self._state == CIRCUIT_OPEN and time.monotonic() - self._opened_at >= self.reset_seconds:
+            self._state = CIRCUIT_HALF_OPEN
+            self._probing = False
+        return self._state
+
+class ProviderRegistry:
+    """
+    Payment providers by payment method, each one behind its CircuitBreaker. PaymentAgent
+    creates every provider payment through create or acreate, an open circuit fails fast
+    with CircuitOpenError instead of waiting for the provider.
+
+    Idempotent providers are called through the RetryPolicy, the async calls hedged after the
+    hedge_quantile latency of the provider. The breaker records the outcome of the whole call.
+    """
+
+    def __init__(self, window_size: int = CIRCUIT_WINDOW_SIZE_DEFAULT, min_calls: int = CIRCUIT_MIN_CALLS_DEFAULT,
+                 failure_rate: float = CIRCUIT_FAILURE_RATE_DEFAULT, reset_seconds: float = CIRCUIT_RESET_SECONDS_DEFAULT,
+                 retry_policy: Optional[RetryPolicy] = None, hedge_quantile: float = PROVIDER_HEDGE_QUANTILE_DEFAULT):
+        """
+        Breaker settings of the registered providers, see CircuitBreaker.
+
+        :param retry_policy: Retries and hedging of the idempotent providers, none if not set.
+        :param hedge_quantile: Latency quantile of a provider's successful calls its async calls are hedged after.
+        """
+        self.breaker_kwargs = {"window_size": window_size, "min_calls": min_calls,
+                               "failure_rate": failure_rate, "reset_seconds": reset_seconds}
+        self.retry_policy = retry_policy
+        self.hedge_quantile = hedge_quantile
+        self._creates = {}
+        self._acreates = {}
+        self._succeeded = {}
+        self._idempotent = {}
+        self._counters = {}
+        ## latencies of the successful calls per method, a window larger than the breaker's for the hedge quantile
+        self._latencies = {}
+        self.breakers = {}
+
+    def register(self, method: str, create: Callable[[str, float, str], Dict],
+                 acreate: Optional[Callable[[str, float, str], Awaitable[Dict]]] = None,
+                 succeeded: Optional[Callable[[Dict], bool]] = None, idempotent: bool = False):
+        """
+        :param method: Payment method, e.g. "paypal".
+        :param create: create(order_id, amount, currency) of the provider payment.
+        :param acreate: Async create, providers without one (static links) run create on the loop.
+        :param succeeded: Whether a returned payment was created at the provider, providers returning
+            a fallback instead of raising count it as a failure. Defaults to every returned payment.
+        :param idempotent: A repeated call returns the payment of the first one (idempotency key),
+            only these are retried and hedged.
+        """
+        self._creates[method] = create
+        self._acreates[method] = acreate
+        self._succeeded[method] = succeeded
+        self._idempotent[method] = idempotent
+        self._counters[method] = {PROVIDER_COUNTER_RETRIES: 0, PROVIDER_COUNTER_HEDGES: 0, PROVIDER_COUNTER_HEDGE_WINS: 0}
+        self._latencies[method] = deque(maxlen=PROVIDER_LATENCY_WINDOW_SIZE)
+        self.breakers[method] = CircuitBreaker(method, **self.breaker_kwargs)
+
+    def available(self, method: str) -> bool:
+        """
+        Whether method is registered and its circuit is not open, without taking the half_open probe.
+        """
+        breaker = self.breakers.get(method)
+        return breaker is not None and breaker.state != CIRCUIT_OPEN
+
+    def ordered(self, methods: List[str]) -> List[str]:
+        """
+        Registered methods of methods, the healthiest first and open circuits last.
+        """
+        return sorted([method for method in methods if method in self.breakers],
+                      key=lambda method: self.breakers[method].health_key())
+
+    def create(self, method: str, order_id: str, amount: float, currency: str,
+               deadline: Optional[float] = None) -> Dict:
+        """
+        :param deadline: Seconds the caller waits for the payment, a slower call counts as a failure
+            and no retry starts after it.
+        :raise CircuitOpenError: If the circuit of method is open.
+        :raise ValueError: If method is not registered.
+        """
+        breaker = self._allow(method)
+        create = self._creates[method]
+        start = time.perf_counter()
+        try:
+            if self._retries(method):
+                payment = self.retry_policy.call(lambda: create(order_id, amount, currency),
+                                                 deadline_at=start + deadline if deadline is not None else None,
+                                                 can_retry=lambda: breaker.state != CIRCUIT_OPEN,
+                                                 counters=self._counters[method])
+            else:
+                payment = create(order_id, amount, currency)
+        except Exception:
+            breaker.record(False, time.perf_counter() - start)
+            raise
+        self._record(method, payment, time.perf_counter() - start, deadline)
+        return payment
+
+    async def acreate(self, method: str, order_id: str, amount: float, currency: str,
+                      deadline: Optional[float] = None) -> Dict:
+        """
+        Async create, a call cancelled at its deadline counts as a failure.
+        """
+        breaker = self._allow(method)
+        acreate = self._acreates[method]
+        start = time.perf_counter()
+        try:
+            if acreate is None:
+                payment = self._creates[method](order_id, amount, currency)
+            elif self._retries(method):
+                payment = await self.retry_policy.acall(lambda: acreate(order_id, amount, currency),
+                                                        deadline_at=start + deadline if deadline is not None else None,
+                                                        can_retry=lambda: breaker.state != CIRCUIT_OPEN,
+                                                        counters=self._counters[method],
+                                                        hedge_delay=self._hedge_delay(method))
+            else:
+                payment = await acreate(order_id, amount, currency)
+        except (Exception, asyncio.CancelledError):
+            breaker.record(False, time.perf_counter() - start)
+            raise
+        self._record(method, payment, time.perf_counter() - start, deadline)
+        return payment
+
+    def stats(self) -> Dict[str, Dict]:
+        """
+        Breaker stats per method, with the retries, hedges and hedge_wins of the method.
+        """
+        return {method: {**breaker.stats(), **self._counters[method]} for method, breaker in self.breakers.items()}
+
+    def _retries(self, method: str) -> bool:
+        return self.retry_policy is not None and self._idempotent[method]
+
+    def _hedge_delay(self, method: str) -> Optional[float]:
+        ## no hedge until the provider has enough successful calls to estimate its tail latency
+        latencies = sorted(self._latencies[method])
+        if len(latencies) < PROVIDER_HEDGE_MIN_SAMPLES:
+            return None
+        latency = latencies[min(len(latencies) - 1, int(len(latencies) * self.hedge_quantile))]
+        return max(latency, PROVIDER_HEDGE_MIN_DELAY_SECONDS)
+
+    def _allow(self, method: str) -> CircuitBreaker:
+        breaker = self.breakers.get(method)
+        if breaker is None:
+            raise ValueError(f"Unknown payment method {method}")
+        if not breaker.allow():
+            raise CircuitOpenError(method, breaker.retry_in())
+        return breaker
+
+    def _record(self, method: str, payment: Dict, latency: float, deadline: Optional[float]):
+        succeeded = self._succeeded[method]
+        ok = (succeeded is None or succeeded(payment)) and (deadline is None or latency <= deadline)
+        self.breakers[method].record(ok, latency)
+        if ok:
+            self._latencies[method].append(latency)
@@ -0,0 +1,246 @@
+import asyncio
+import functools
+import logging
+import math
+from concurrent.futures import Executor
+from typing import Dict, Optional, Tuple
+
+import stripe
+
+from .constants import *
+from .http_client import AsyncProviderHttpClient
+from .order_store import OrderStore
+from .paypal_auth import PAYPAL_TOKEN_CACHE, PayPalTokenCache, apaypal_request, paypal_base_url
+from .retry_policy import ProviderError, is_transient_error
+
+def stripe_idempotency_key(order_id: str, method: str) -> str:
+    """
+    Idempotency key of the Stripe create call of an order and method. A retried or concurrent
+    create of the same order returns the object of the first call instead of a second one.
+    """
+    return f"a2z_{order_id}_{method}"
+
+## Provider request bodies and results shared by the sync calls of PaymentAgent and the async adapters
+
+def stripe_amount_cents(amount: float) -> int:
+    """
+    Stripe amounts are integer values of the minor unit (cents).
+    """
+    return math.ceil(amount * 100.0)
+
+def stripe_checkout_session_params(order_id: str, amount_cents: int, currency: str) -> Dict:
+    """
+    Parameters of stripe.checkout.Session.create of an order.
+    """
+    return dict(
+        payment_method_types=["card"],
+        mode="payment",
+        line_items=[{
+            "price_data": {
+                "currency": currency.lower(),
+                "unit_amount": amount_cents,
+                "product_data": {"name": f"Order {order_id}"}
+            },
+            "quantity": 1
+        }],
+        success_url=f"{SUCCESS_URL}{order_id}",
+        cancel_url=f"{CANCEL_URL}{order_id}",
+        metadata={ORDER_ID: order_id},
+        idempotency_key=stripe_idempotency_key(order_id, PAYMENT_METHOD_STRIPE),
+    )
+
+def stripe_checkout_session_result(orders: OrderStore, order_id: str, session) -> Dict:
+    """
+    Registers the session and its PaymentIntent as references of the order.
+
+    :return: create_payment result of PAYMENT_METHOD_STRIPE.
+    """
+    orders.add_reference(session.id, order_id, PAYMENT_METHOD_STRIPE)
+    if getattr(session, "payment_intent", None):
+        orders.add_reference(session.payment_intent, order_id, PAYMENT_METHOD_STRIPE)
+    return {KEY_PAYMENT_URL: session.url}
+
+def stripe_amount_too_small_result(amount_cents: int) -> Optional[Dict]:
+    """
+    :return: The failed create_payment result of PAYMENT_METHOD_CREDIT_CARD below the Stripe minimum, None otherwise.
+    """
+    if amount_cents >= MIN_PAYMENT_AMOUNT_STRIPE_CENTS:
+        return None
+    return {
+        KEY_SUCCESS: False,
+        KEY_STRIPE_PUBLISHABLE_KEY: "",
+        KEY_STRIPE_CLIENT_SECRET: "",
+        KEY_PAYMENT_METHOD: PAYMENT_METHOD_CREDIT_CARD,
+        KEY_MESSAGE: f"Checkout Stripe Input Amount {amount_cents} cents is too small for Stripe, Minimum should be more than 400 cents"
+    }
+
+def stripe_payment_intent_params(order_id: str, amount_cents: int, currency: str) -> Dict:
+    """
+    Parameters of stripe.PaymentIntent.create of an order.
+    """
+    return dict(
+        amount=amount_cents,
+        currency=currency.lower(),
+        metadata={ORDER_ID: order_id},
+        idempotency_key=stripe_idempotency_key(order_id, PAYMENT_METHOD_CREDIT_CARD),
+    )
+
+def stripe_payment_intent_result(config, orders: OrderStore, order_id: str, intent) -> Dict:
+    """
+    Registers the PaymentIntent as reference of the order.
+
+    :return: create_payment result of PAYMENT_METHOD_CREDIT_CARD.
+    """
+    orders.add_reference(intent.id, order_id, PAYMENT_METHOD_CREDIT_CARD)
+    return {
+        KEY_SUCCESS: True,
+        KEY_STRIPE_PUBLISHABLE_KEY: config.stripe_publishable_key,
+        KEY_STRIPE_CLIENT_SECRET: intent.client_secret,
+        KEY_PAYMENT_METHOD: PAYMENT_METHOD_CREDIT_CARD,
+        KEY_MESSAGE: "Checkout Stripe Successfully!"
+    }
+
+def paypal_order_request(config, order_id: str, amount: float, currency: str) -> Tuple[str, Dict, Dict]:
+    """
+    :return: (url, headers, json payload) of the PayPal create order call of an order.
+    """
+    order_url = f"{paypal_base_url(config.environment.value, config.paypal_base_url)}/v2/checkout/orders"
+    headers = {
+        "Content-Type": "application/json",
+        "PayPal-Request-Id": order_id  # Ensure idempotency
+    }
+    order_payload = {
+        "intent": "CAPTURE",
+        "purchase_units": [{
+            "reference_id": order_id,
+            "amount": {
+                "currency_code": currency,
+                "value": f"{amount:.2f}"
+            },
+            "description": f"Payment for Order {order_id}"
+        }],
+        "application_context": {
+            "return_url": f"{RETURN_URL}{order_id}",
+            "cancel_url": f"{CANCEL_URL}{order_id}",
+            "brand_name": PAYPAL_BRAND_NAME,
+            "shipping_preference": "NO_SHIPPING"
+        }
+    }
+    return order_url, headers, order_payload
+
+def paypal_order_result(orders: OrderStore, order_id: str, order_data: Dict) -> Dict:
+    """
+    Registers the PayPal order id as reference of the order.
+
+    :return: create_payment result of PAYMENT_METHOD_PAYPAL.
+    :raise ProviderError: If the created order has no approval link.
+    """
+    approval_link = next(
+        (link['href'] for link in order_data.get('links', []) if link['rel'] == 'approve'),
+        None
+    )
+    ## PAYMENT.CAPTURE.COMPLETED events carry this id only, not the reference_id
+    orders.add_reference(order_data.get("id"), order_id, PAYMENT_METHOD_PAYPAL)
+    if not approval_link:
+        raise ProviderError("PayPal order created but no approval link found.")
+    return {KEY_PAYMENT_URL: approval_link, KEY_PAYPAL_ORDER_ID: order_data["id"]}
+
+def paypal_order_error(order_id: str, error: Exception) -> ProviderError:
+    """
+    Logs a failed PayPal create order call, the ProviderError to raise is retryable if the failure is transient.
+    """
+    logging.error(f"PayPal Checkout of {order_id} Failed with error {error}")
+    if isinstance(error, ProviderError):
+        return error
+    return ProviderError(f"PayPal order of {order_id} failed with error {error}", retryable=is_transient_error(error))
+
+class AsyncStripeAdapter:
+    """
+    Stripe calls of the async checkout on Stripe's async API surface (create_async), the event
+    loop is never blocked. Results follow PaymentAgent._stripe_create_payment and
+    PaymentAgent._stripe_credit_card_create_payment.
+
+    Stripe versions without create_async run the blocking call in the executor instead.
+    """
+
+    def __init__(self, config, orders: OrderStore, executor: Optional[Executor] = None):
+        """
+        :param config: AgentPaymentConfig
+        :param orders: OrderStore the provider references are registered in.
+        :param executor: Fallback executor of the blocking Stripe calls.
+        """
+        self.config = config
+        self.orders = orders
+        self.executor = executor
+
+    async def create_checkout_session(self, order_id: str, amount: float, currency: str) -> Dict:
+        try:
+            amount_cents = stripe_amount_cents(amount)
+            logging.info(f"AsyncStripeAdapter.create_checkout_session input amount {amount} {currency} converting to cents {amount_cents} cents {currency} for {order_id}")
+            session = await self._call(stripe.checkout.Session, **stripe_checkout_session_params(order_id, amount_cents, currency))
+            return stripe_checkout_session_result(self.orders, order_id, session)
+
+        except Exception as e:
+            logging.error(f"AsyncStripeAdapter.create_checkout_session failed with error {e}")
+            return {KEY_PAYMENT_URL: "", "message": str(e)}
+
+    async def create_payment_intent(self, order_id: str, amount: float, currency: str) -> Dict:
+        """
+        :raise stripe.StripeError: As the sync call, if Stripe rejects the PaymentIntent.
+        """
+        amount_cents = stripe_amount_cents(amount)
+        too_small = stripe_amount_too_small_result(amount_cents)
+        if too_small is not None:
+            return too_small
+
+        logging.info(
+            f"AsyncStripeAdapter.create_payment_intent input amount {amount} {currency} converting to cents {amount_cents} cents {currency} for {order_id}")
+        intent = await self._call(stripe.PaymentIntent, **stripe_payment_intent_params(order_id, amount_cents, currency))
+        return stripe_payment_intent_result(self.config, self.orders, order_id, intent)
+
+    async def _call(self, resource, **params):
+        create_async = getattr(resource, "create_async", None)
+        if create_async is not None:
+            return await create_async(**params)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(resource.create, **params))
+
+class AsyncPayPalAdapter:
+    """
+    PayPal calls of the async checkout on the AsyncProviderHttpClient, token included, the event
+    loop is never blocked. Results follow PaymentAgent._paypal_create_payment.
+    """
+
+    def __init__(self, config, orders: OrderStore, http_client: AsyncProviderHttpClient,
+                 token_cache: Optional[PayPalTokenCache] = None):
+        """
+        :param config: AgentPaymentConfig
+        :param orders: OrderStore the provider references are registered in.
+        :param http_client: Async client of the PayPal API and token calls.
+        :param token_cache: Defaults to the process wide PAYPAL_TOKEN_CACHE, shared with the sync calls.
+        """
+        self.config = config
+        self.orders = orders
+        self.http_client = http_client
+        self.token_cache = token_cache
+
+    async def create_payment(self, order_id: str, amount: float, currency: str) -> Dict:
+        """
+        :raise ProviderError: As the sync call, if the PayPal order was not created, retryable if transient.
+        """
+        token = await (self.token_cache or PAYPAL_TOKEN_CACHE).aget_token(
+            self.config.paypal_client_id, self.config.paypal_secret, self.config.environment.value,
+            http_client=self.http_client, base_url=self.config.paypal_base_url)
+        if not token:
+            raise ProviderError("AsyncPayPalAdapter.create_payment Could not retrieve PayPal access token.", retryable=True)
+        try:
+            order_url, headers, order_payload = paypal_order_request(self.config, order_id, amount, currency)
+            response = await apaypal_request("POST", order_url, self.config.paypal_client_id, self.config.paypal_secret,
+                                             self.config.environment.value, http_client=self.http_client,
+                                             base_url=self.config.paypal_base_url, token_cache=self.token_cache,
+                                             headers=headers, json=order_payload)
+            response.raise_for_status()
+            return paypal_order_result(self.orders, order_id, response.json())
+
+        except Exception as e:
+            raise paypal_order_error(order_id, e) from e
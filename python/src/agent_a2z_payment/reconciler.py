@@ -0,0 +1,215 @@
+import asyncio
+import functools
+import logging
+import threading
+import time
+from concurrent.futures import Executor
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+import stripe
+
+from .constants import *
+from .http_client import AsyncProviderHttpClient
+from .order import Order, OrderStatus
+from .order_store import OrderStore
+from .paypal_auth import PayPalTokenCache, apaypal_request, paypal_base_url
+from .retry_policy import RetryPolicy
+
+## provider payments a reconciliation run can settle
+RECONCILE_METHODS = [PAYMENT_METHOD_CREDIT_CARD, PAYMENT_METHOD_STRIPE, PAYMENT_METHOD_PAYPAL]
+
+class OrderReconciler:
+    """
+    Settles the orders left pending (or approved and not captured) by a lost webhook from the
+    provider side, with bulk list calls instead of one status call per order.
+
+    Stripe: the PaymentIntents and complete Checkout Sessions created since the oldest candidate
+    order are paged with list calls of page_size objects, and matched on their order_id metadata,
+    so a run costs about one call per page_size Stripe payments of the window. PayPal has no list
+    or search API of checkout orders (the transaction search lags by hours), so the PayPal orders
+    of the candidates Stripe did not settle are fetched by id, paypal_concurrency at a time, and
+    an approved one is captured as the paypal webhook does.
+
+    Paid orders go through OrderStore.transition(), the listeners release the waiting streams and
+    the other workers are notified as for a webhook. Run it in one worker of a shared order store.
+    """
+
+    def __init__(self, config, orders: OrderStore, http_client: AsyncProviderHttpClient,
+                 executor: Optional[Executor] = None, retry_policy: Optional[RetryPolicy] = None,
+                 token_cache: Optional[PayPalTokenCache] = None, page_size: int = RECONCILE_STRIPE_PAGE_SIZE,
+                 paypal_concurrency: int = RECONCILE_PAYPAL_CONCURRENCY):
+        """
+        :param config: AgentPaymentConfig
+        :param orders: OrderStore of the candidate orders and their saved provider payments.
+        :param http_client: Async client of the PayPal calls.
+        :param executor: Executor of the order store reads and of the Stripe versions without list_async.
+        :param retry_policy: Retries of the transient failures of each list and get call, none if not set.
+        :param token_cache: Defaults to the process wide PAYPAL_TOKEN_CACHE.
+        :param page_size: Objects per Stripe list call, at most 100.
+        :param paypal_concurrency: PayPal calls in flight.
+        """
+        self.config = config
+        self.orders = orders
+        self.http_client = http_client
+        self.executor = executor
+        self.retry_policy = retry_policy
+        self.token_cache = token_cache
+        self.page_size = max(1, min(100, page_size))
+        self.paypal_concurrency = max(1, paypal_concurrency)
+        self._lock = threading.Lock()
+        self._totals = {"runs": 0, "orders": 0, "checked": 0, "paid": 0, "errors": 0,
+                        "stripe_calls": 0, "paypal_calls": 0, "seconds": 0.0}
+
+    async def reconcile(self, min_age_seconds: int = RECONCILE_MIN_AGE_SECONDS_DEFAULT,
+                        limit: Optional[int] = None) -> Dict:
+        """
+        Checks the pending and approved orders created more than min_age_seconds ago.
+
+        :param limit: Most orders read per status, the oldest first.
+        :return: Report of the run: orders read, checked (with a provider payment), paid, errors,
+            api_calls per provider, api_calls_per_order checked, seconds and orders_per_second.
+        """
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        candidates, created = await loop.run_in_executor(self.executor, self._candidates, min_age_seconds, limit)
+        calls = {"stripe": 0, "paypal": 0}
+        errors = []
+        intent_orders = {order_id for order_id, payments in candidates.items() if PAYMENT_METHOD_CREDIT_CARD in payments}
+        session_orders = {order_id for order_id, payments in candidates.items() if PAYMENT_METHOD_STRIPE in payments}
+        paid = set()
+        if intent_orders or session_orders:
+            since = min(created[order_id] for order_id in intent_orders | session_orders) - RECONCILE_STRIPE_CREATED_MARGIN_SECONDS
+            for found in await asyncio.gather(
+                    self._stripe_paid(stripe.PaymentIntent, intent_orders, since, calls, errors,
+                                      lambda intent: intent["status"] == STRIPE_PAYMENT_INTENT_SUCCEEDED),
+                    self._stripe_paid(stripe.checkout.Session, session_orders, since, calls, errors,
+                                      lambda session: session["payment_status"] == STRIPE_CHECKOUT_SESSION_PAID,
+                                      status=STRIPE_CHECKOUT_SESSION_COMPLETE)):
+                paid |= found
+
+        ## PayPal only for the orders Stripe did not settle
+        semaphore = asyncio.Semaphore(self.paypal_concurrency)
+        paypal_orders = {order_id: payments[PAYMENT_METHOD_PAYPAL].get(KEY_PAYPAL_ORDER_ID)
+                         for order_id, payments in candidates.items()
+                         if PAYMENT_METHOD_PAYPAL in payments and order_id not in paid}
+        for order_id, captured in zip(paypal_orders, await asyncio.gather(
+                *[self._paypal_paid(order_id, paypal_order_id, semaphore, calls, errors)
+                  for order_id, paypal_order_id in paypal_orders.items()])):
+            if captured:
+                paid.add(order_id)
+
+        settled = 0
+        for order_id in paid:
+            ## a webhook may have won meanwhile, then the transition is a no-op
+            if await self.orders.atransition(order_id, OrderStatus.PAID, executor=self.executor):
+                settled += 1
+                logging.info(f"OrderReconciler order {order_id} paid at the provider, its webhook was lost")
+
+        seconds = time.perf_counter() - start
+        api_calls = calls["stripe"] + calls["paypal"]
+        report = {"orders": len(candidates), "checked": sum(1 for payments in candidates.values() if payments),
+                  "paid": settled, "errors": len(errors), "api_calls": dict(calls), "seconds": seconds}
+        report["api_calls_per_order"] = api_calls / report["checked"] if report["checked"] else 0.0
+        report["orders_per_second"] = report["checked"] / seconds if seconds > 0 else 0.0
+        with self._lock:
+            self._totals["runs"] += 1
+            for key in ("orders", "checked", "paid", "errors", "seconds"):
+                self._totals[key] += report[key]
+            self._totals["stripe_calls"] += calls["stripe"]
+            self._totals["paypal_calls"] += calls["paypal"]
+        return report
+
+    def stats(self) -> Dict:
+        """
+        Totals of all runs: runs, orders read, checked, paid, errors, stripe_calls, paypal_calls, seconds.
+        """
+        with self._lock:
+            return dict(self._totals)
+
+    def _candidates(self, min_age_seconds: int, limit: Optional[int]) -> Tuple[Dict[str, Dict[str, Dict]], Dict[str, int]]:
+        ## order id -> the saved provider payments of the order by method (empty for link only orders), and its created time
+        created_before = int(time.time()) - min_age_seconds
+        orders: List[Order] = []
+        for status in (OrderStatus.PENDING, OrderStatus.APPROVED):
+            orders.extend(self.orders.list_orders(status=status, created_before=created_before, limit=limit))
+        candidates = {}
+        for order in orders:
+            payments = {method: self.orders.get_payment(order.order_id, method) for method in RECONCILE_METHODS}
+            candidates[order.order_id] = {method: payment for method, payment in payments.items() if payment}
+        return candidates, {order.order_id: order.created or 0 for order in orders}
+
+    async def _stripe_paid(self, resource, order_ids: Set[str], since: int, calls: Dict[str, int], errors: List,
+                           is_paid: Callable[["stripe.StripeObject"], bool], **filters) -> Set[str]:
+        """
+        :return: The order ids of order_ids with a paid object of resource created since.
+        """
+        paid = set()
+        if not order_ids:
+            return paid
+        params = {"created": {"gte": since}, "limit": self.page_size, **filters}
+        try:
+            for _ in range(RECONCILE_STRIPE_MAX_PAGES):
+                page = await self._call(functools.partial(self._stripe_list, resource, calls, dict(params)))
+                for obj in page.data:
+                    metadata = obj["metadata"] if "metadata" in obj else {}
+                    order_id = metadata[ORDER_ID] if ORDER_ID in metadata else None
+                    if order_id in order_ids and is_paid(obj):
+                        paid.add(order_id)
+                if not page.has_more or not page.data or paid >= order_ids:
+                    break
+                params["starting_after"] = page.data[-1].id
+        except Exception as e:
+            logging.error(f"OrderReconciler listing Stripe {resource.__name__} failed with error {e}")
+            errors.append(e)
+        return paid
+
+    async def _stripe_list(self, resource, calls: Dict[str, int], params: Dict):
+        calls["stripe"] += 1
+        list_async = getattr(resource, "list_async", None)
+        if list_async is not None:
+            return await list_async(**params)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(resource.list, **params))
+
+    async def _paypal_paid(self, order_id: str, paypal_order_id: Optional[str], semaphore: asyncio.Semaphore,
+                           calls: Dict[str, int], errors: List) -> bool:
+        """
+        :return: True if the PayPal order is captured, an approved one is captured first.
+        """
+        if not paypal_order_id:
+            return False
+        order_url = f"{paypal_base_url(self.config.environment.value, self.config.paypal_base_url)}/v2/checkout/orders/{paypal_order_id}"
+        try:
+            async with semaphore:
+                paypal_order = (await self._call(functools.partial(self._paypal_call, "GET", order_url, calls))).json()
+                status = paypal_order.get("status")
+                if status == PAYPAL_ORDER_COMPLETED:
+                    return True
+                if status != PAYPAL_ORDER_APPROVED:
+                    return False
+                ## as CHECKOUT.ORDER.APPROVED: approved, then the capture moves the money
+                await self.orders.atransition(order_id, OrderStatus.APPROVED, executor=self.executor)
+                response = await self._paypal_call("POST", f"{order_url}/capture", calls, json={}, raise_status=False)
+            if response.status_code == 422 and "ORDER_ALREADY_CAPTURED" in response.text:
+                ## captured meanwhile by the webhook of another worker
+                return True
+            response.raise_for_status()
+            return response.json().get("status") == PAYPAL_ORDER_COMPLETED
+        except Exception as e:
+            logging.error(f"OrderReconciler checking PayPal order {paypal_order_id} of {order_id} failed with error {e}")
+            errors.append(e)
+            return False
+
+    async def _paypal_call(self, method: str, url: str, calls: Dict[str, int], raise_status: bool = True, **kwargs):
+        calls["paypal"] += 1
+        response = await apaypal_request(method, url, self.config.paypal_client_id, self.config.paypal_secret,
+                                         self.config.environment.value, http_client=self.http_client,
+                                         base_url=self.config.paypal_base_url, token_cache=self.token_cache, **kwargs)
+        if raise_status:
+            response.raise_for_status()
+        return response
+
+    async def _call(self, fn: Callable[[], Awaitable]):
+        if self.retry_policy is None:
+            return await fn()
+        return await self.retry_policy.acall(fn)
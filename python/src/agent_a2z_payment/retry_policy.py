@@ -0,0 +1,168 @@
+import asyncio
+import logging
+import random
+import time
+from typing import Awaitable, Callable, Dict, Optional
+
+import httpx
+import requests
+import stripe
+
+from .constants import *
+
+class ProviderError(Exception):
+    """
+    A provider did not create the payment.
+
+    :param retryable: The failure is transient (network, 429, 5xx), the same idempotent call may succeed.
+    """
+
+    def __init__(self, message: str, retryable: bool = False):
+        super().__init__(message)
+        self.retryable = retryable
+
+def _stripe_error(name: str) -> type:
+    ## top level stripe.<name> since stripe 8, stripe.error.<name> in the older releases
+    error = getattr(stripe, name, None)
+    return error if error is not None else getattr(stripe.error, name)
+
+STRIPE_ERROR = _stripe_error("StripeError")
+STRIPE_API_CONNECTION_ERROR = _stripe_error("APIConnectionError")
+STRIPE_RATE_LIMIT_ERROR = _stripe_error("RateLimitError")
+STRIPE_IDEMPOTENCY_ERROR = _stripe_error("IdempotencyError")
+
+def is_transient_error(error: BaseException) -> bool:
+    """
+    Whether a failed provider call may succeed when repeated: connection errors, timeouts and
+    the HTTP statuses of PROVIDER_RETRY_HTTP_STATUSES. Card, validation and auth errors are final.
+    """
+    if isinstance(error, ProviderError):
+        return error.retryable
+    if isinstance(error, (STRIPE_API_CONNECTION_ERROR, STRIPE_RATE_LIMIT_ERROR)):
+        return True
+    if isinstance(error, STRIPE_ERROR):
+        ## IdempotencyError is a key reused with other parameters, final
+        return not isinstance(error, STRIPE_IDEMPOTENCY_ERROR) and error.http_status in PROVIDER_RETRY_HTTP_STATUSES
+    if isinstance(error, requests.exceptions.HTTPError):
+        return error.response is not None and error.response.status_code in PROVIDER_RETRY_HTTP_STATUSES
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code in PROVIDER_RETRY_HTTP_STATUSES
+    return isinstance(error, httpx.TransportError)
+
+class RetryPolicy:
+    """
+    Retries of an idempotent provider call: transient failures are retried after a jittered
+    exponential backoff, and the async call is hedged, a second identical request is sent if
+    the first one is not done after hedge_delay and the first result wins. Every attempt
+    carries the same idempotency key (Stripe Idempotency-Key, PayPal-Request-Id), so retries
+    and hedges return the provider object of the first request instead of creating another.
+
+    No retry starts past the deadline of the call.
+    """
+
+    def __init__(self, max_attempts: int = PROVIDER_RETRY_MAX_ATTEMPTS_DEFAULT,
+                 base_delay: float = PROVIDER_RETRY_BASE_DELAY_DEFAULT,
+                 max_delay: float = PROVIDER_RETRY_MAX_DELAY_DEFAULT, hedge: bool = True):
+        """
+        :param max_attempts: Attempts of a call including the first one, 1 disables retries.
+        :param base_delay: Backoff ceiling of the first retry, doubled per retry up to max_delay.
+        :param max_delay: Largest backoff ceiling, seconds.
+        :param hedge: Whether acall sends the hedged request.
+        """
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.hedge = hedge
+
+    def backoff(self, retry: int) -> float:
+        """
+        Seconds before retry number retry (0 based), full jitter: uniform in [0, ceiling].
+        """
+        return random.uniform(0.0, min(self.max_delay, self.base_delay * (2 ** retry)))
+
+    def call(self, fn: Callable[[], Dict], deadline_at: Optional[float] = None,
+             can_retry: Optional[Callable[[], bool]] = None, counters: Optional[Dict[str, int]] = None) -> Dict:
+        """
+        :param fn: The idempotent provider call.
+        :param deadline_at: time.perf_counter() after which no retry starts.
+        :param can_retry: Checked before each retry, e.g. the circuit of the provider is not open.
+        :param counters: "retries" is incremented per retry.
+        :raise Exception: The error of the last attempt.
+        """
+        for retry in range(self.max_attempts):
+            try:
+                return fn()
+            except Exception as e:
+                delay = self._retry_delay(e, retry, deadline_at, can_retry)
+                if delay is None:
+                    raise
+                logging.warning(f"RetryPolicy retry {retry + 1} in {delay * 1000:.0f}ms after error {e}")
+                self._count(counters, PROVIDER_COUNTER_RETRIES)
+                time.sleep(delay)
+
+    async def acall(self, fn: Callable[[], Awaitable[Dict]], deadline_at: Optional[float] = None,
+                    can_retry: Optional[Callable[[], bool]] = None, counters: Optional[Dict[str, int]] = None,
+                    hedge_delay: Optional[float] = None) -> Dict:
+        """
+        Async call, each attempt hedged after hedge_delay seconds if set.
+
+        :param counters: "retries", "hedges" (hedged requests sent) and "hedge_wins" (the hedged
+            request answered first) are incremented.
+        """
+        for retry in range(self.max_attempts):
+            try:
+                if self.hedge and hedge_delay is not None:
+                    return await self._ahedged(fn, hedge_delay, counters)
+                return await fn()
+            except Exception as e:
+                delay = self._retry_delay(e, retry, deadline_at, can_retry)
+                if delay is None:
+                    raise
+                logging.warning(f"RetryPolicy retry {retry + 1} in {delay * 1000:.0f}ms after error {e}")
+                self._count(counters, PROVIDER_COUNTER_RETRIES)
+                await asyncio.sleep(delay)
+
+    async def _ahedged(self, fn: Callable[[], Awaitable[Dict]], hedge_delay: float,
+                       counters: Optional[Dict[str, int]]) -> Dict:
+        first = asyncio.ensure_future(fn())
+        tasks = [first]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=hedge_delay)
+            if not done:
+                self._count(counters, PROVIDER_COUNTER_HEDGES)
+                tasks.append(asyncio.ensure_future(fn()))
+            pending = set(tasks)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not first:
+                            self._count(counters, PROVIDER_COUNTER_HEDGE_WINS)
+                        return task.result()
+                    ## the other request may still succeed, e.g. Stripe answers 409 to a concurrent key
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    def _retry_delay(self, error: Exception, retry: int, deadline_at: Optional[float],
+                     can_retry: Optional[Callable[[], bool]]) -> Optional[float]:
+        ## None if the call is not retried
+        if retry + 1 >= self.max_attempts or not is_transient_error(error):
+            return None
+        if can_retry is not None and not can_retry():
+            return None
+        delay = self.backoff(retry)
+        if deadline_at is not None and time.perf_counter() + delay >= deadline_at:
+            return None
+        return delay
+
+    @staticmethod
+    def _count(counters: Optional[Dict[str, int]], key: str):
+        if counters is not None:
+            counters[key] = counters.get(key, 0) + 1
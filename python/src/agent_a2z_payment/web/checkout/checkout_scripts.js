@@ -1,13 +1,73 @@
 <script src="https://js.stripe.com/v3/" async></script>
 <script>
     const STRIPE_PUBLIC_KEY = "{publishable_key}";
-    const CLIENT_SECRET = "{client_secret}";
+    let CLIENT_SECRET = "{client_secret}";
+    // "lazy": the payment of a method is created when the user selects it, through SELECT_URL
+    const CHECKOUT_MODE = "{checkout_mode}";
+    const ORDER_ID = "{order_id}";
+    const SELECT_URL = "{select_url}";
+    const DEFAULT_METHOD = "{default_method}";
+    const selectedPayments = {{}};
 
     let stripe;
     let elements;
     let card;
 
-    function selectMethod(method) {{
+    /**
+     * Lazy checkout: asks the server to create the payment of a method, once per method.
+     */
+    function selectPayment(paymentMethod) {{
+        if (!selectedPayments[paymentMethod]) {{
+            selectedPayments[paymentMethod] = fetch(SELECT_URL, {{
+                method: 'POST',
+                headers: {{ 'Content-Type': 'application/json' }},
+                body: JSON.stringify({{ order_id: ORDER_ID, payment_method: paymentMethod }})
+            }}).then(res => res.json()).then(payment => {{
+                if (!payment.success) {{
+                    // let a later selection retry
+                    delete selectedPayments[paymentMethod];
+                    throw new Error(payment.message || "Payment could not be created");
+                }}
+                return payment;
+            }});
+        }}
+        return selectedPayments[paymentMethod];
+    }}
+
+    function prepareLazyPayment(method) {{
+        if (method === 'stripe') {{
+            selectPayment('credit_card').then(payment => {{
+                CLIENT_SECRET = payment.client_secret;
+            }}).catch(e => console.error("Credit Card Payment Error:", e));
+        }} else if (method === 'paypal') {{
+            const paypalLink = document.getElementById('paypal-link');
+            if (paypalLink && !paypalLink.onclick) {{
+                // clicked before the PayPal order is ready: open the window now, redirect when it is
+                paypalLink.onclick = async (event) => {{
+                    if (paypalLink.getAttribute('href') !== '#') {{
+                        return;
+                    }}
+                    event.preventDefault();
+                    const paypalWindow = window.open('', '_blank');
+                    try {{
+                        const payment = await selectPayment('paypal');
+                        paypalLink.href = payment.payment_url;
+                        paypalWindow.location = payment.payment_url;
+                    }} catch (e) {{
+                        paypalWindow.close();
+                        alert("Payment Failed: " + e.message);
+                    }}
+                }};
+            }}
+            selectPayment('paypal').then(payment => {{
+                if (paypalLink) {{
+                    paypalLink.href = payment.payment_url;
+                }}
+            }}).catch(e => console.error("PayPal Payment Error:", e));
+        }}
+    }}
+
+    function selectMethod(method, userSelected = true) {{
         document.querySelectorAll('.pm-option').forEach(el => {{
             el.style.border = '1px solid #ddd';
             el.style.background = 'white';
@@ -26,6 +86,11 @@
             actionDiv.style.display = 'block';
         }}
 
+        // Lazy checkout creates the payment of a method the user picked, not of the default one
+        if (CHECKOUT_MODE === 'lazy' && userSelected) {{
+            prepareLazyPayment(method);
+        }}
+
         // If Stripe is selected, and it hasn't been initialized, call the initializer.
         if (method === 'stripe' && !stripe && typeof Stripe !== 'undefined') {{
             initializeStripe();
@@ -64,6 +129,14 @@
             const payBtn = document.querySelector("#pay-btn");
             if (payBtn) {{
                 payBtn.onclick = async () => {{
+                    if (CHECKOUT_MODE === 'lazy' && !CLIENT_SECRET) {{
+                        try {{
+                            CLIENT_SECRET = (await selectPayment('credit_card')).client_secret;
+                        }} catch (e) {{
+                            alert("Payment Failed: " + e.message);
+                            return;
+                        }}
+                    }}
                     const res = await stripe.confirmCardPayment(
                         CLIENT_SECRET,
                         {{
@@ -101,8 +174,8 @@
 
     // Initialize the checkout view on DOM content loaded
     document.addEventListener('DOMContentLoaded', () => {{
-        // Ensure the default method is selected (Stripe is the default in your HTML)
-        selectMethod('stripe');
+        // Select the default method, the offered provider with the healthiest circuit
+        selectMethod(DEFAULT_METHOD, false);
 
         // Start waiting for Stripe.js to load
         runStripeWhenLoaded();